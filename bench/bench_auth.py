@@ -0,0 +1,137 @@
+"""Login storm: LOGIN latency and AUTH_BUSY replies when logins outpace bcrypt.
+
+Starts a ChatServer in this process (in-memory SQLite, one bcrypt worker and
+a small --max-pending), connects --clients users, then has all of them send
+LOGIN at the same moment. The server admits max-pending logins and must turn
+the rest away with AUTH_BUSY straight away rather than queue them. Prints
+how the replies split and how long they took, and exits with status 1 if no
+login was turned away, a turned away one waited for a hash, or any login
+failed outright.
+
+Run from the repository root:
+
+    python bench/bench_auth.py --clients 64 --max-pending 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'server'))
+
+from protocol import FrameDecoder, encode_frame, FRAME_MESSAGE, FRAME_PING, FRAME_PONG
+
+WORK_FACTOR = 10      # ~50 ms a hash, slow enough for the logins to pile up
+CONNECT_BATCH = 4     # connections opened at once, the server's backlog is short
+
+
+class Client:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = FrameDecoder()
+        self.replies = asyncio.Queue()
+
+    @classmethod
+    async def connect(cls, port):
+        client = cls(*await asyncio.open_connection('127.0.0.1', port))
+        client.task = asyncio.get_running_loop().create_task(client.read())
+        return client
+
+    async def read(self):
+        """Queue replies and answer keep-alives, idle clients must not time out"""
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                self.replies.put_nowait('CLOSED')
+                return
+            self.decoder.feed(data)
+            for frame_type, payload in self.decoder.frames():
+                if frame_type == FRAME_MESSAGE:
+                    self.replies.put_nowait(str(payload, 'utf-8'))
+                elif frame_type == FRAME_PING:
+                    self.writer.write(encode_frame(b'', FRAME_PONG))
+
+    async def request(self, payload):
+        """Send a command and return its reply and the seconds it took"""
+        start = time.perf_counter()
+        self.writer.write(encode_frame(payload))
+        await self.writer.drain()
+        return await self.replies.get(), time.perf_counter() - start
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+def start_server(max_pending):
+    from chatserver import ChatServer
+    from database import Database
+    from storage import SQLiteStorage
+
+    db = Database(storage=SQLiteStorage(':memory:'), work_factor=WORK_FACTOR,
+                  hash_workers=1, hash_max_pending=max_pending)
+    server = ChatServer(port=0, db=db)
+    thread = threading.Thread(target=server.start, name='chat-server', daemon=True)
+    thread.start()
+    return server, thread, server.server.getsockname()[1]
+
+
+async def storm(port, clients):
+    credentials = json.dumps({'username': 'storm', 'password': 'storm'})
+    first = await Client.connect(port)
+    reply, _ = await first.request(f'REGISTER:{credentials}')
+    if reply != 'REG_SUCCESS':
+        raise RuntimeError(f"Could not register: {reply}")
+
+    connections = [first]
+    while len(connections) < clients:
+        batch = min(CONNECT_BATCH, clients - len(connections))
+        connections += await asyncio.gather(*(Client.connect(port) for _ in range(batch)))
+    results = await asyncio.gather(*(client.request(f'LOGIN:{credentials}') for client in connections))
+    for client in connections:
+        client.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LOGIN storm against the password hasher's admission limit")
+    parser.add_argument('--clients', type=int, default=64, help="logins sent at once")
+    parser.add_argument('--max-pending', type=int, default=8, help="hash_max_pending of the server")
+    args = parser.parse_args()
+
+    server, thread, port = start_server(args.max_pending)
+    try:
+        results = asyncio.run(storm(port, args.clients))
+    finally:
+        server.stop()
+        thread.join(30)
+
+    replies = Counter(reply.split(':', 1)[0] for reply, _ in results)
+    print(f"{args.clients} logins, max pending {args.max_pending}: {dict(replies)}")
+    for kind in sorted(replies):
+        times = sorted(seconds for reply, seconds in results if reply.split(':', 1)[0] == kind)
+        print(f"{kind:>12}: median {times[len(times) // 2] * 1e3:.1f}ms  max {times[-1] * 1e3:.1f}ms")
+
+    busy = [seconds for reply, seconds in results if reply == 'AUTH_BUSY']
+    fastest_hash = min((seconds for reply, seconds in results if reply.startswith('AUTH_SUCCESS')), default=0)
+    ok = True
+    if not busy:
+        print("FAIL: no login was turned away with AUTH_BUSY")
+        ok = False
+    elif max(busy) >= fastest_hash:
+        print("FAIL: AUTH_BUSY replies waited for a password hash")
+        ok = False
+    if set(replies) - {'AUTH_SUCCESS', 'AUTH_BUSY'}:
+        print("FAIL: some logins neither succeeded nor were turned away")
+        ok = False
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Broadcast send path: per-recipient encoding and writes vs serialize-once with sendmsg.
+
+Every recipient is one end of a local socketpair, a thread drains the other
+ends. The per-recipient path is what broadcast used to do: build the JSON and
+the frame for each recipient and write it with its own send call. The shared
+path encodes the frame once, puts the same bytes object on every recipient's
+OutboundQueue and lets the writer coroutines flush several frames per
+sendmsg() call.
+
+Run from the repository root:
+
+    python bench/bench_broadcast.py
+"""
+import asyncio
+import json
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'server'))
+
+from outbound import OutboundQueue
+from protocol import FRAME_PUSH, encode_frame
+
+MESSAGES = 2000
+BURST = 16  # broadcasts queued between two turns of the event loop
+
+
+class Drain(threading.Thread):
+    """Reads and discards everything sent to the recipients"""
+    def __init__(self, socks):
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        for sock in socks:
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+        self.received = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(0.1):
+                try:
+                    self.received += len(key.fileobj.recv(1 << 20))
+                except BlockingIOError:
+                    pass
+
+    def wait_for(self, total):
+        while self.received < total:
+            time.sleep(0.0005)
+
+
+def message(i):
+    return {'chat_id': 'chat', 'username': 'sender', 'content': f'message number {i} ' + 'x' * 80}
+
+
+async def per_recipient(loop, socks, drain):
+    start = time.perf_counter()
+    sent = 0
+    for i in range(MESSAGES):
+        data = message(i)
+        for sock in socks:
+            frame = encode_frame(json.dumps(data), FRAME_PUSH)
+            await loop.sock_sendall(sock, frame)
+            sent += len(frame)
+    drain.wait_for(sent)
+    return time.perf_counter() - start
+
+
+async def shared_frames(loop, socks, drain):
+    queues = [OutboundQueue(loop, sock, on_slow=lambda: None, on_error=print,
+                            max_queued=1 << 30) for sock in socks]
+    writers = [loop.create_task(queue.run()) for queue in queues]
+    start = time.perf_counter()
+    sent = 0
+    for i in range(MESSAGES):
+        frame = encode_frame(json.dumps(message(i)), FRAME_PUSH)
+        for queue in queues:
+            queue.put(frame)
+        sent += len(frame) * len(queues)
+        if i % BURST == BURST - 1:
+            await asyncio.sleep(0)  # let the writers run
+    while any(queue.frames for queue in queues):
+        await asyncio.sleep(0)
+    drain.wait_for(sent)
+    elapsed = time.perf_counter() - start
+    for writer in writers:
+        writer.cancel()
+    return elapsed
+
+
+async def run(recipients, path):
+    pairs = [socket.socketpair() for _ in range(recipients)]
+    senders = [pair[0] for pair in pairs]
+    for sock in senders:
+        sock.setblocking(False)
+    drain = Drain([pair[1] for pair in pairs])
+    drain.start()
+    try:
+        return await path(asyncio.get_running_loop(), senders, drain)
+    finally:
+        drain.running = False
+        drain.join()
+        for a, b in pairs:
+            a.close()
+            b.close()
+
+
+def main():
+    print(f"{'recipients':>10} {'per-recipient':>15} {'shared+sendmsg':>15} {'speedup':>8}")
+    for recipients in (2, 10, 50, 200):
+        old = asyncio.run(run(recipients, per_recipient))
+        new = asyncio.run(run(recipients, shared_frames))
+        deliveries = MESSAGES * recipients
+        print(f"{recipients:>10} {old / deliveries * 1e6:>13.2f}us {new / deliveries * 1e6:>13.2f}us "
+              f"{old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Reply compression: bytes on the wire and encode/decode time per method.
+
+Encodes a session's worth of GET_MESSAGES history pages and GET_CHATS chat
+lists the way ChatServer replies to them, once uncompressed and once per
+compression method in protocol.py, then decodes them again like the client.
+Each method keeps one Compressor for the whole session, as a connection does.
+
+Run from the repository root:
+
+    python bench/bench_compression.py
+"""
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'server'))
+
+from protocol import (COMPRESSION_METHODS, Compressor, Decompressor, FrameDecoder,
+                      FRAME_REPLY, encode_request)
+from storage import new_object_id
+
+PAGES = 200
+PAGE_SIZE = 50
+CHATS = 30
+WORDS = ('hello', 'are', 'you', 'coming', 'tonight', 'yes', 'no', 'maybe', 'the', 'meeting',
+         'moved', 'to', 'tomorrow', 'thanks', 'see', 'lunch', 'ok', 'great', 'sorry', 'late')
+
+
+def history_page(chat_id, start):
+    return json.dumps([{
+        '_id': new_object_id(),
+        'chat_id': chat_id,
+        'username': random.choice(('alice', 'bob')),
+        'content': ' '.join(random.choices(WORDS, k=random.randint(2, 12))),
+        'timestamp': start + timedelta(seconds=i * random.randint(1, 90))
+    } for i in range(PAGE_SIZE)], default=str)
+
+
+def chat_list(username):
+    return json.dumps([{
+        '_id': str(i),
+        'participants': [username, f'user{i}'],
+        'is_group': False,
+        'chat_name': f'{username}-user{i}',
+        'created_at': datetime(2026, 1, 1) + timedelta(hours=i),
+        'created_by': username
+    } for i in range(CHATS)], default=str)
+
+
+def replies():
+    """What one session is sent, mostly history with the odd chat list"""
+    payloads = []
+    start = datetime(2026, 10, 1)
+    for i in range(PAGES):
+        payloads.append(history_page(str(random.randrange(CHATS)), start + timedelta(hours=i)))
+        if i % 20 == 0:
+            payloads.append(chat_list('alice'))
+    return payloads
+
+
+def run(payloads, method):
+    compressor = Compressor(method) if method else None
+    start = time.perf_counter()
+    frames = [encode_request(i, payload, FRAME_REPLY, compressor) for i, payload in enumerate(payloads)]
+    encoded = time.perf_counter() - start
+
+    decoder = FrameDecoder()
+    if method:
+        decoder.decompressor = Decompressor(method)
+    start = time.perf_counter()
+    for frame in frames:
+        decoder.feed(frame)
+        for _ in decoder.frames():
+            pass
+    decoded = time.perf_counter() - start
+    return sum(map(len, frames)), encoded, decoded
+
+
+def main():
+    random.seed(1)
+    payloads = replies()
+    plain, _, _ = run(payloads, None)
+    print(f"{len(payloads)} replies, {plain} bytes uncompressed")
+    print(f"{'method':>10} {'bytes':>9} {'ratio':>6} {'encode':>10} {'decode':>10}")
+    for method in (None,) + COMPRESSION_METHODS:
+        size, encoded, decoded = run(payloads, method)
+        print(f"{method or 'none':>10} {size:>9} {plain / size:>5.1f}x "
+              f"{encoded / len(payloads) * 1e6:>8.1f}us {decoded / len(payloads) * 1e6:>8.1f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Broadcast fan-out cost: sending to every connection vs the chat subscription index.
+
+Run from the repository root:
+
+    python bench/bench_fanout.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'server'))
+
+from subscriptions import ChatSubscriptions
+
+ROUNDS = 2000
+
+
+class FakeSession:
+    """Stands in for a connected socket, counts the frames it is sent"""
+    def __init__(self):
+        self.sent = 0
+
+    def send_frame(self, frame):
+        self.sent += 1
+
+
+def build(users):
+    """users connected sessions, paired off into two-person chats"""
+    index = ChatSubscriptions()
+    sessions = []
+    for i in range(users):
+        session = FakeSession()
+        index.add_session(session, f'user{i}', [f'chat{i // 2}'])
+        sessions.append(session)
+    return index, sessions
+
+
+def bench_all_clients(sessions, frame):
+    # What broadcast did before: every connected socket gets the message
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for session in sessions:
+            session.send_frame(frame)
+    return (time.perf_counter() - start) / ROUNDS
+
+
+def bench_subscribed(index, frame):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for session in list(index.sessions('chat0')):
+            session.send_frame(frame)
+    return (time.perf_counter() - start) / ROUNDS
+
+
+def main():
+    frame = b'{"chat_id": "chat0", "username": "user0", "content": "hello"}'
+    print(f"{'users':>8} {'all clients':>14} {'subscribed':>14} {'recipients':>11}")
+    for users in (10, 100, 1000, 10000):
+        index, sessions = build(users)
+        everyone = bench_all_clients(sessions, frame)
+        subscribed = bench_subscribed(index, frame)
+        recipients = len(index.sessions('chat0'))
+        print(f"{users:>8} {everyone * 1e6:>12.2f}us {subscribed * 1e6:>12.2f}us {recipients:>11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Latency of the storage engines behind Database.
+
+Times the engine calls the three hot Database methods come down to, with
+the caches and the write-behind queue out of the way:
+
+    save_message       one message written on its own (insert_messages of 1)
+    save_message x100  a write-behind batch of 100, per message
+    get_chat_messages  the newest page of a chat with CHAT_SIZE messages
+    get_user_chats     the chat list of a user in USER_CHATS chats
+
+for SQLite in memory, SQLite on disk (WAL), MongoDB on localhost if one is
+running, and the append-only message log (msglog.py, messages only, the chat
+list stays in SQLite). Run from the repository root:
+
+    python bench/bench_storage.py
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'server'))
+
+from database import now
+from msglog import MessageLog
+from storage import MongoStorage, SQLiteStorage
+
+ROUNDS = 2000
+BATCH = 100
+CHAT_SIZE = 5000
+USER_CHATS = 50
+PAGE = 50
+
+
+def message(storage, chat_id, i):
+    return {'_id': storage.new_id(), 'chat_id': chat_id, 'username': 'bench',
+            'content': f'message number {i} ' + 'x' * 60, 'timestamp': now()}
+
+
+def timed(func, rounds, per=1):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) / per)
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+def run(storage, messages=None):
+    messages = messages or storage
+    storage.delete_all()
+    messages.delete_all()
+    chats = [storage.insert_chat({'participants': ['bench', f'user{i}'], 'is_group': False,
+                                  'chat_name': f'chat {i}', 'created_at': datetime.now(),
+                                  'created_by': 'bench'})
+             for i in range(USER_CHATS)]
+    busy = chats[0]
+    for start in range(0, CHAT_SIZE, 1000):
+        messages.insert_messages([message(messages, busy, i) for i in range(start, start + 1000)])
+
+    counter = iter(range(10 ** 9))
+    results = {
+        'save_message': timed(lambda: messages.insert_messages([message(messages, chats[1], next(counter))]),
+                              ROUNDS),
+        f'save_message x{BATCH}': timed(
+            lambda: messages.insert_messages([message(messages, chats[2], next(counter)) for _ in range(BATCH)]),
+            ROUNDS // 20, per=BATCH),
+        'get_chat_messages': timed(lambda: messages.message_page(busy, PAGE), ROUNDS),
+        'get_user_chats': timed(lambda: storage.user_chats('bench'), ROUNDS),
+    }
+    storage.delete_all()
+    storage.close()
+    if messages is not storage:
+        messages.delete_all()
+        messages.close()
+    return results
+
+
+def engines():
+    yield 'sqlite :memory:', lambda: (SQLiteStorage(':memory:'),)
+    # Removed once main() has run every engine
+    with tempfile.TemporaryDirectory(prefix='bench-storage-') as directory:
+        yield 'sqlite file (WAL)', lambda: (SQLiteStorage(os.path.join(directory, 'bench.db')),)
+        yield 'mongodb', lambda: (MongoStorage(database='chat_bench', serverSelectionTimeoutMS=2000),)
+        yield 'message log', lambda: (SQLiteStorage(':memory:'), MessageLog(os.path.join(directory, 'log')))
+
+
+def main():
+    print(f"{'engine':<18} {'operation':<20} {'p50':>10} {'p99':>10}")
+    for name, open_engine in engines():
+        try:
+            results = run(*open_engine())
+        except Exception as e:
+            print(f"{name:<18} skipped: {e.__class__.__name__}: {str(e)[:60]}")
+            continue
+        for operation, (p50, p99) in results.items():
+            print(f"{name:<18} {operation:<20} {p50 * 1e6:>8.1f}us {p99 * 1e6:>8.1f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""Message throughput of the multi-process server as workers are added.
+
+Starts src/server/supervisor.py with 1, 2, 4, ... workers, logs in pairs of
+users with a chat each, then has every pair's first user send messages as
+fast as the server accepts them while the second user counts the pushes.
+Users are spread over the workers by SO_REUSEPORT, so most messages cross the
+bus to reach their recipient. Throughput should grow close to linearly with
+the worker count until the machine runs out of cores (the load generator
+runs in LOADGEN_PROCESSES processes of its own).
+
+Needs MongoDB on localhost like the server itself, or --storage sqlite for a
+throwaway SQLite file shared by the workers. Run from the repository root:
+
+    python bench/bench_workers.py [max workers] [--storage sqlite]
+
+With --check N it instead starts N workers once and checks that connections
+are spread over them, that pushes reach users on other workers and that a
+session dropped on one worker resumes on another (which lets go of it),
+exiting with status 1 if any of that does not hold:
+
+    python bench/bench_workers.py --check 4 --storage sqlite
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'server'))
+
+from protocol import (FrameDecoder, encode_frame,
+                      FRAME_MESSAGE, FRAME_PUSH, FRAME_PING, FRAME_PONG)
+
+SUPERVISOR = os.path.join(os.path.dirname(__file__), '..', 'src', 'server', 'supervisor.py')
+PAIRS = 32               # sender / receiver pairs, each with its own chat
+MESSAGES = 500           # messages per sender
+WINDOW = 32              # messages a sender may have in flight before waiting for its receiver
+LOADGEN_PROCESSES = max(1, (os.cpu_count() or 1) // 2)
+CHECK_PAIRS = 16         # pairs logged in by --check
+CHECK_MESSAGES = 20      # messages per sender in --check
+CHECK_TIMEOUT = 30.0     # seconds --check waits for the pushes
+
+
+class Client:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = FrameDecoder()
+        self.replies = asyncio.Queue()
+        self.pushes = 0
+        self.pushed = asyncio.Event()
+
+    @classmethod
+    async def connect(cls, port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        client = cls(reader, writer)
+        client.task = asyncio.get_running_loop().create_task(client.read())
+        return client
+
+    def send(self, payload, frame_type=FRAME_MESSAGE):
+        self.writer.write(encode_frame(payload, frame_type))
+
+    async def request(self, payload):
+        self.send(payload)
+        await self.writer.drain()
+        return await self.replies.get()
+
+    async def read(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            self.decoder.feed(data)
+            for frame_type, payload in self.decoder.frames():
+                if frame_type == FRAME_MESSAGE:
+                    self.replies.put_nowait(str(payload, 'utf-8'))
+                elif frame_type == FRAME_PUSH:
+                    if b'"bench ' in bytes(payload):
+                        self.pushes += 1
+                        self.pushed.set()
+                elif frame_type == FRAME_PING:
+                    self.send(b'', FRAME_PONG)
+
+    async def login(self, username):
+        credentials = json.dumps({'username': username, 'password': 'bench'})
+        await self.request(f'REGISTER:{credentials}')
+        reply = await self.request(f'LOGIN:{credentials}')
+        if not reply.startswith('AUTH_SUCCESS'):
+            raise RuntimeError(f"Login failed for {username}: {reply}")
+        self.token = reply.split(':', 1)[1]
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+async def run_pairs(port, pairs, prefix, start_at):
+    sessions = []
+    for i in range(pairs):
+        sender, receiver = await Client.connect(port), await Client.connect(port)
+        await sender.login(f'{prefix}-a{i}')
+        await receiver.login(f'{prefix}-b{i}')
+        reply = await sender.request('CREATE_CHAT:' + json.dumps(
+            {'creator': f'{prefix}-a{i}', 'target': f'{prefix}-b{i}', 'is_group': True}))
+        sessions.append((sender, receiver, reply.split(':', 1)[1], f'{prefix}-a{i}'))
+
+    # Start every load generator process at the same moment
+    await asyncio.sleep(max(0, start_at - time.time()))
+    start = time.perf_counter()
+
+    async def send_all(sender, receiver, chat_id, username):
+        for n in range(MESSAGES):
+            while n - receiver.pushes >= WINDOW:
+                receiver.pushed.clear()
+                await receiver.pushed.wait()
+            sender.send('MESSAGE:' + json.dumps({'chat_id': chat_id, 'username': username,
+                                                 'content': f'bench {n}'}))
+            await sender.writer.drain()
+        while receiver.pushes < MESSAGES:
+            receiver.pushed.clear()
+            await receiver.pushed.wait()
+
+    await asyncio.gather(*(send_all(*session) for session in sessions))
+    elapsed = time.perf_counter() - start
+    for sender, receiver, _, _ in sessions:
+        sender.close()
+        receiver.close()
+    return elapsed
+
+
+def loadgen(port, pairs, prefix, start_at, results):
+    results.put(asyncio.run(run_pairs(port, pairs, prefix, start_at)))
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not come up on port {port}")
+
+
+def start_supervisor(workers, port, storage, directory, metrics_port=None):
+    command = [sys.executable, SUPERVISOR, '--workers', str(workers), '--port', str(port)]
+    if storage:
+        command += ['--storage', storage]
+    if storage == 'sqlite':
+        command += ['--sqlite-path', os.path.join(directory, 'bench.db')]
+    if metrics_port:
+        command += ['--metrics-port', str(metrics_port)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        time.sleep(1.0)  # let every worker bind before the connections are spread
+    except BaseException:
+        stop_supervisor(server)
+        raise
+    return server
+
+
+def stop_supervisor(server):
+    server.terminate()
+    server.wait(30)
+
+
+def measure(workers, storage):
+    port = random.randint(20000, 60000)
+    with tempfile.TemporaryDirectory(prefix='bench-workers-') as directory:
+        server = start_supervisor(workers, port, storage, directory)
+        try:
+            prefix = f'bench{random.randrange(1 << 30):x}'
+            results = multiprocessing.Queue()
+            # Logging in is slow (bcrypt), leave plenty of time before the start line
+            start_at = time.time() + 5 + PAIRS * 0.5
+            procs = [multiprocessing.Process(target=loadgen,
+                                             args=(port, PAIRS // LOADGEN_PROCESSES, f'{prefix}-{i}',
+                                                   start_at, results))
+                     for i in range(LOADGEN_PROCESSES)]
+            for proc in procs:
+                proc.start()
+            elapsed = max(results.get(timeout=start_at - time.time() + 600) for _ in procs)
+            for proc in procs:
+                proc.join()
+            return (PAIRS // LOADGEN_PROCESSES) * LOADGEN_PROCESSES * MESSAGES / elapsed
+        finally:
+            stop_supervisor(server)
+
+
+def worker_gauge(metrics_port, workers, name):
+    """A gauge's value on every worker, from each worker's metrics endpoint"""
+    values = []
+    for n in range(workers):
+        with urllib.request.urlopen(f'http://127.0.0.1:{metrics_port + n}/metrics', timeout=5) as response:
+            for line in response.read().decode('utf-8').splitlines():
+                if line.startswith(name + ' '):
+                    values.append(int(float(line.split()[1])))
+                    break
+    return values
+
+
+async def wait_gauge(metrics_port, workers, name, done, timeout=5.0):
+    """Poll a gauge on every worker until done(values) holds, returns the values"""
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + timeout
+    while True:
+        values = await loop.run_in_executor(None, worker_gauge, metrics_port, workers, name)
+        if done(values) or time.monotonic() > deadline:
+            return values
+        await asyncio.sleep(0.05)
+
+
+async def grown_worker(metrics_port, workers, name, before):
+    """The worker whose gauge went up from before, and the new values"""
+    now = await wait_gauge(metrics_port, workers, name,
+                           lambda values: any(values[n] > before[n] for n in range(workers)))
+    grown = [n for n in range(workers) if now[n] > before[n]]
+    if not grown:
+        raise RuntimeError(f"No worker's {name} went up")
+    return grown[0], now
+
+
+async def check_pairs(port, metrics_port, workers):
+    """Log in CHECK_PAIRS pairs one user at a time, noting which worker took
+    each from the session counts, then send within every pair. Returns the
+    users per worker, the pairs split over two workers and the pairs whose
+    receiver missed pushes"""
+    loop = asyncio.get_running_loop()
+    prefix = f'check{random.randrange(1 << 30):x}'
+    counts = await loop.run_in_executor(None, worker_gauge, metrics_port, workers, 'chat_sessions')
+    pairs = []
+    for i in range(CHECK_PAIRS):
+        pair = []
+        for role in 'ab':
+            client = await Client.connect(port)
+            await client.login(f'{prefix}-{role}{i}')
+            # The session is subscribed just after AUTH_SUCCESS goes out
+            client.worker, counts = await grown_worker(metrics_port, workers, 'chat_sessions', counts)
+            pair.append(client)
+        sender, receiver = pair
+        reply = await sender.request('CREATE_CHAT:' + json.dumps(
+            {'creator': f'{prefix}-a{i}', 'target': f'{prefix}-b{i}', 'is_group': True}))
+        pairs.append((sender, receiver, reply.split(':', 1)[1], f'{prefix}-a{i}'))
+
+    for sender, receiver, chat_id, username in pairs:
+        for n in range(CHECK_MESSAGES):
+            sender.send('MESSAGE:' + json.dumps({'chat_id': chat_id, 'username': username,
+                                                 'content': f'bench {n}'}))
+        await sender.writer.drain()
+
+    deadline = time.monotonic() + CHECK_TIMEOUT
+    while (any(receiver.pushes < CHECK_MESSAGES for _, receiver, _, _ in pairs)
+           and time.monotonic() < deadline):
+        await asyncio.sleep(0.1)
+
+    per_worker = [0] * workers
+    for sender, receiver, _, _ in pairs:
+        per_worker[sender.worker] += 1
+        per_worker[receiver.worker] += 1
+        sender.close()
+        receiver.close()
+    crossing = sum(sender.worker != receiver.worker for sender, receiver, _, _ in pairs)
+    missed = [(sender.worker, receiver.worker, receiver.pushes)
+              for sender, receiver, _, _ in pairs if receiver.pushes < CHECK_MESSAGES]
+    return per_worker, crossing, missed
+
+
+async def check_resume(port, metrics_port, workers):
+    """Drop a session on one worker and RESUME it on another. Returns the
+    RESUME reply and whether the first worker let go of the dropped session"""
+    loop = asyncio.get_running_loop()
+    sessions = await loop.run_in_executor(None, worker_gauge, metrics_port, workers, 'chat_sessions')
+    client = await Client.connect(port)
+    await client.login(f'resume{random.randrange(1 << 30):x}')
+    first, _ = await grown_worker(metrics_port, workers, 'chat_sessions', sessions)
+    detached = await loop.run_in_executor(None, worker_gauge, metrics_port, workers, 'chat_sessions_detached')
+    client.close()
+    detached = await wait_gauge(metrics_port, workers, 'chat_sessions_detached',
+                                lambda values: values[first] > detached[first])
+
+    # Reconnect until SO_REUSEPORT hands the connection to another worker
+    for _ in range(100):
+        connections = await loop.run_in_executor(None, worker_gauge, metrics_port, workers, 'chat_connections')
+        other = await Client.connect(port)
+        worker, _ = await grown_worker(metrics_port, workers, 'chat_connections', connections)
+        if worker != first:
+            break
+        other.close()
+    else:
+        raise RuntimeError(f"Every connection went to worker {first}")
+
+    reply = await other.request('RESUME:' + json.dumps({'token': client.token}))
+    released = await wait_gauge(metrics_port, workers, 'chat_sessions_detached',
+                                lambda values: values[first] < detached[first])
+    other.close()
+    return reply, released[first] < detached[first]
+
+
+def check(workers, storage):
+    """Start the supervisor with workers workers and check it spreads
+    connections over them and relays pushes between them. True if it does"""
+    port = random.randint(20000, 50000)
+    metrics_port = random.randint(50001, 60000)
+    with tempfile.TemporaryDirectory(prefix='bench-workers-') as directory:
+        server = start_supervisor(workers, port, storage, directory, metrics_port)
+        try:
+            per_worker, crossing, missed = asyncio.run(check_pairs(port, metrics_port, workers))
+            if workers > 1:
+                resumed, released = asyncio.run(check_resume(port, metrics_port, workers))
+        finally:
+            stop_supervisor(server)
+
+    print(f"Users per worker: {per_worker}")
+    print(f"Pairs split over two workers: {crossing} of {CHECK_PAIRS}")
+    ok = True
+    if workers > 1 and sum(1 for count in per_worker if count) < 2:
+        print("FAIL: every connection went to the same worker")
+        ok = False
+    if workers > 1 and not crossing:
+        print("FAIL: no pair was split over two workers, the bus was not exercised")
+        ok = False
+    for sender_worker, receiver_worker, pushes in missed:
+        print(f"FAIL: worker {sender_worker} -> worker {receiver_worker}: "
+              f"{pushes} of {CHECK_MESSAGES} messages pushed")
+        ok = False
+    if workers > 1:
+        print(f"Resume on another worker: {resumed.split(':', 1)[0]}")
+        if not resumed.startswith('RESUME_SUCCESS'):
+            print("FAIL: a session dropped on one worker could not be resumed on another")
+            ok = False
+        if not released:
+            print("FAIL: the worker the session was dropped on kept it detached after the resume")
+            ok = False
+    print("OK" if ok else "FAILED")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of the multi-process server by worker count")
+    parser.add_argument('max_workers', type=int, nargs='?', default=os.cpu_count() or 1)
+    parser.add_argument('--storage', choices=('mongodb', 'sqlite'), default=None,
+                        help="storage engine for the workers (default: $CHAT_STORAGE or mongodb)")
+    parser.add_argument('--check', type=int, metavar='WORKERS', default=None,
+                        help="check connection spread and bus fan-out with this many workers instead")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if check(args.check, args.storage) else 1)
+
+    counts = [1]
+    while counts[-1] * 2 <= args.max_workers:
+        counts.append(counts[-1] * 2)
+
+    print(f"{'workers':>7} {'messages/s':>12} {'speedup':>8}")
+    base = None
+    for workers in counts:
+        rate = measure(workers, args.storage)
+        base = base or rate
+        print(f"{workers:>7} {rate:>12.0f} {rate / base:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""Load generator: how many users and messages per second a ChatServer keeps up with.
+
+Simulates --clients users speaking the real protocol. Every user registers,
+logs in and is paired with another user in a chat (CREATE_CHAT), then sends
+MESSAGEs into it at --rate per second for --duration seconds while reading
+the pushed broadcasts. Each message carries its send time, so the receiving
+side measures end-to-end delivery latency: request framing, the server's
+save and broadcast, and the push back out. With --reads every user also
+opens its chat's history (a tagged GET_MESSAGES) that many times a second,
+the way a user switching between chats would, and the reply times are
+reported as well.
+
+By default the server runs in this process on a free port with an in-memory
+SQLite database (and a cheap bcrypt work factor so logins don't dominate),
+no MongoDB needed. --connect points the clients at a server that is already
+running instead. Run from the repository root:
+
+    python bench/loadgen.py --clients 100 --rate 5 --duration 20
+    python bench/loadgen.py --connect 127.0.0.1:55555
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'server'))
+
+from protocol import (FrameDecoder, encode_frame, encode_request, split_request,
+                      FRAME_MESSAGE, FRAME_PUSH, FRAME_PING, FRAME_PONG, FRAME_REPLY)
+
+TAG = 'loadgen'  # first word of every generated message
+
+
+class Client:
+    """One simulated user on its own connection"""
+    def __init__(self, username, reader, writer, stats):
+        self.username = username
+        self.reader = reader
+        self.writer = writer
+        self.stats = stats
+        self.decoder = FrameDecoder()
+        self.replies = asyncio.Queue()
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # {request id: Future} for tagged requests
+        self.chat_id = None
+
+    @classmethod
+    async def connect(cls, host, port, username, stats):
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(username, reader, writer, stats)
+        client.task = asyncio.get_running_loop().create_task(client.read())
+        return client
+
+    def send(self, payload, frame_type=FRAME_MESSAGE):
+        self.writer.write(encode_frame(payload, frame_type))
+
+    async def request(self, payload):
+        self.send(payload)
+        await self.writer.drain()
+        return await self.replies.get()
+
+    async def tagged_request(self, payload):
+        """Send a command tagged with a request id, its reply may overtake others"""
+        request_id = next(self.request_ids)
+        reply = self.pending[request_id] = asyncio.get_running_loop().create_future()
+        self.writer.write(encode_request(request_id, payload))
+        await self.writer.drain()
+        return await reply
+
+    async def read(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            self.decoder.feed(data)
+            for frame_type, payload in self.decoder.frames():
+                if frame_type == FRAME_MESSAGE:
+                    self.replies.put_nowait(str(payload, 'utf-8'))
+                elif frame_type == FRAME_REPLY:
+                    request_id, payload = split_request(payload)
+                    reply = self.pending.pop(request_id, None)
+                    if reply and not reply.done():
+                        reply.set_result(str(payload, 'utf-8'))
+                elif frame_type == FRAME_PUSH:
+                    self.received(json.loads(bytes(payload)))
+                elif frame_type == FRAME_PING:
+                    self.send(b'', FRAME_PONG)
+
+    def received(self, message):
+        # Only count other users' messages, our own come back to us as well
+        words = message['content'].split(' ', 3)
+        if words[0] != TAG or message['username'] == self.username:
+            return
+        self.stats.delivered(float(words[2]), time.perf_counter())
+
+    async def login(self, password='loadgen'):
+        credentials = json.dumps({'username': self.username, 'password': password})
+        await self.request(f'REGISTER:{credentials}')
+        reply = await self.request(f'LOGIN:{credentials}')
+        if not reply.startswith('AUTH_SUCCESS'):
+            raise RuntimeError(f"Login failed for {self.username}: {reply}")
+
+    async def create_chat(self, target):
+        reply = await self.request('CREATE_CHAT:' + json.dumps(
+            {'creator': self.username, 'target': target, 'is_group': False}))
+        if not reply.startswith('CHAT_CREATED:'):
+            raise RuntimeError(f"Chat creation failed for {self.username}: {reply}")
+        return reply.split(':', 1)[1]
+
+    async def send_messages(self, rate, until, padding):
+        """Send rate messages a second until the deadline, on a fixed schedule"""
+        interval = 1.0 / rate
+        next_send = time.perf_counter() + random.random() * interval  # spread the clients out
+        sequence = 0
+        while next_send < until:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # The send time goes in the content, the receiver works out the latency
+            sent = time.perf_counter()
+            self.send('MESSAGE:' + json.dumps({
+                'chat_id': self.chat_id, 'username': self.username,
+                'content': f'{TAG} {sequence} {sent:.9f} {padding}'}))
+            await self.writer.drain()
+            self.stats.sent_at(sent)
+            sequence += 1
+            next_send += interval
+
+    async def read_history(self, rate, until):
+        """Load the chat's history rate times a second until the deadline"""
+        interval = 1.0 / rate
+        next_read = time.perf_counter() + random.random() * interval
+        while next_read < until:
+            delay = next_read - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sent = time.perf_counter()
+            await self.tagged_request(f'GET_MESSAGES:{self.chat_id}')
+            self.stats.read(sent, time.perf_counter())
+            next_read += interval
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+class Stats:
+    """Messages sent and delivery latencies inside the measured window"""
+    def __init__(self):
+        self.start = self.end = None
+        self.sent = 0
+        self.latencies = []
+        self.reads = []  # history reply times
+
+    def measuring(self, sent):
+        return self.start <= sent < self.end
+
+    def sent_at(self, sent):
+        if self.measuring(sent):
+            self.sent += 1
+
+    def delivered(self, sent, now):
+        if self.measuring(sent):
+            self.latencies.append(now - sent)
+
+    def read(self, sent, now):
+        if self.measuring(sent):
+            self.reads.append(now - sent)
+
+    @staticmethod
+    def percentile(values, fraction):
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def start_server(message_store, log_path):
+    """A ChatServer on a free port in a background thread, with in-process storage.
+    With the 'log' message store messages go to a MessageLog in log_path"""
+    from chatserver import ChatServer
+    from database import Database
+    from msglog import MessageLog
+    from storage import SQLiteStorage
+
+    messages = MessageLog(log_path) if message_store == 'log' else None
+    # bcrypt's cheapest work factor, REGISTER / LOGIN aren't what is measured
+    db = Database(storage=SQLiteStorage(':memory:'), message_store=messages, work_factor=4)
+    server = ChatServer(port=0, db=db)
+    thread = threading.Thread(target=server.start, name='chat-server', daemon=True)
+    thread.start()
+    return server, thread, server.server.getsockname()[1]
+
+
+async def run(host, port, args):
+    stats = Stats()
+    prefix = f'lg{random.randrange(1 << 30):x}'
+    clients = []
+    # Connect and log in a batch at a time, the server's backlog is short
+    for start in range(0, args.clients, args.connect_batch):
+        batch = await asyncio.gather(*(Client.connect(host, port, f'{prefix}-{i}', stats)
+                                       for i in range(start, min(start + args.connect_batch, args.clients))))
+        await asyncio.gather(*(client.login() for client in batch))
+        clients.extend(batch)
+
+    # Pair the users off, both members of a pair send into their chat
+    for a, b in zip(clients[::2], clients[1::2]):
+        a.chat_id = b.chat_id = await a.create_chat(b.username)
+    senders = [client for client in clients if client.chat_id]
+    print(f"{len(clients)} clients logged in, {len(senders) // 2} chats")
+
+    padding = 'x' * args.size
+    stats.start = time.perf_counter() + args.warmup
+    stats.end = stats.start + args.duration
+    work = [client.send_messages(args.rate, stats.end, padding) for client in senders]
+    if args.reads:
+        work += [client.read_history(args.reads, stats.end) for client in senders]
+    await asyncio.gather(*work)
+    await asyncio.sleep(args.drain)  # messages still on their way
+    for client in clients:
+        client.close()
+    return stats
+
+
+def report(stats, args):
+    stats.latencies.sort()
+    print(f"sent        {stats.sent} messages in {args.duration:.1f}s ({stats.sent / args.duration:.0f}/s, "
+          f"offered {args.rate * (args.clients // 2 * 2):.0f}/s)")
+    print(f"delivered   {len(stats.latencies)} ({len(stats.latencies) / args.duration:.0f}/s)")
+    if stats.latencies:
+        print(f"latency     {percentiles(stats.latencies)}")
+    if stats.reads:
+        stats.reads.sort()
+        print(f"history     {len(stats.reads)} reads ({len(stats.reads) / args.duration:.0f}/s)")
+        print(f"read time   {percentiles(stats.reads)}")
+
+
+def percentiles(values):
+    return (f"p50 {Stats.percentile(values, 0.50) * 1e3:.2f}ms  p95 {Stats.percentile(values, 0.95) * 1e3:.2f}ms  "
+            f"p99 {Stats.percentile(values, 0.99) * 1e3:.2f}ms  max {values[-1] * 1e3:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server load generator")
+    parser.add_argument('--clients', type=int, default=50, help="simulated users, paired into chats")
+    parser.add_argument('--rate', type=float, default=5.0, help="messages per second per user")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds measured")
+    parser.add_argument('--warmup', type=float, default=2.0, help="seconds of load before measuring")
+    parser.add_argument('--drain', type=float, default=1.0, help="seconds to wait for late deliveries")
+    parser.add_argument('--size', type=int, default=64, help="padding bytes per message")
+    parser.add_argument('--reads', type=float, default=0.0,
+                        help="history loads (tagged GET_MESSAGES) per second per user")
+    parser.add_argument('--connect-batch', type=int, default=50, help="clients connecting at once")
+    parser.add_argument('--connect', default=None, metavar='HOST:PORT',
+                        help="use a running server instead of one in this process")
+    parser.add_argument('--message-store', choices=('storage', 'log'), default='storage',
+                        help="where the in-process server keeps messages")
+    args = parser.parse_args()
+
+    server = None
+    log_directory = tempfile.TemporaryDirectory(prefix='loadgen-')
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        port = int(port)
+    else:
+        server, thread, port = start_server(args.message_store, log_directory.name)
+        host = '127.0.0.1'
+    try:
+        stats = asyncio.run(run(host, port, args))
+    finally:
+        if server:
+            server.stop()
+            thread.join(30)
+        log_directory.cleanup()
+    report(stats, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,55 @@
+import itertools
 import json
+import queue
 import socket
 import threading
 import tkinter as tk
+from concurrent.futures import Future
 from tkinter import ttk, scrolledtext, messagebox
-import time
+from localcache import open_local_cache
+from server.protocol import (FrameDecoder, Compressor, Decompressor, offer_compression,
+                             encode_frame, encode_request, split_request, FRAME_MESSAGE,
+                             FRAME_PUSH, FRAME_PING, FRAME_PONG, FRAME_REPLY, FRAME_HELLO)
 
 host='127.0.0.1'
 port=55555
-poll_port=55556  # New port for polling connection
+REPLY_TIMEOUT = 10.0  # seconds to wait for the server to answer a command
+RESUME_ATTEMPTS = 5   # tries to resume the session after the connection drops
+RESUME_DELAY = 1000   # milliseconds between them
+EVENT_POLL = 20       # milliseconds between checks for replies and pushed messages
+HISTORY_SIZE = 200    # messages kept per chat to show straight away when it is opened
+SYNC_LIMIT = 50       # newest messages to load for a chat we have nothing or too little of
+CACHE_FLUSH = 2000    # milliseconds between writes of changed chats to the local cache
 
 class ChatClient:
     def __init__(self):
-        # Initialize main connection
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Initialize polling connection
-        self.poll_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # A single connection carries commands, replies, pushed chat messages
+        # and keep-alives, told apart by frame type (see server/protocol.py).
+        # Commands are tagged with a request id and never wait on the Tk
+        # thread, the polling thread completes the pending request's Future
+        # and everything for Tk goes through the events queue
+        self.client = None
+        self.decoder = None
+        self.compressor = None  # set when the server accepts our HELLO
+        self.send_lock = threading.Lock()  # the polling thread answers pings
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # {request id: Future}
+        self.pending_lock = threading.Lock()
+        self.events = queue.SimpleQueue()  # callables to run on the Tk thread
         
         self.connected = False
         self.logged_in = False
         self.username = None
+        self.token = None  # from AUTH_SUCCESS, lets us RESUME after a drop
+        self.resuming = False
         self.current_chat_id = None
+        # {chat_id: {'seq': newest sequence number we have every message up to
+        # (None until the first SYNC), 'messages': [...]}}, opening a chat
+        # only SYNCs what is newer
+        self.histories = {}
+        # The same kept on disk between runs, per user, see localcache.py
+        self.cache = None
+        self.dirty = set()  # chats changed since the last write to the cache
         self.running = True  # Flag to control polling thread
 
         # Create main window
@@ -28,19 +58,12 @@ class ChatClient:
         self.root.geometry("800x600")
 
         try:
-            # Connect main socket
-            self.client.connect((host, port))
-            # Connect polling socket
-            self.poll_socket.connect((host, poll_port))
+            self.connect()
             print("Connected to server successfully")
-            self.connected = True
-            
-            # Start polling thread
-            self.poll_thread = threading.Thread(target=self.poll_server)
-            self.poll_thread.daemon = True
-            self.poll_thread.start()
             
             self.show_login()  # Start with login screen
+            self.root.after(EVENT_POLL, self.process_events)
+            self.root.after(CACHE_FLUSH, self.autosave_cache)
             self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
             self.root.mainloop()
         except Exception as e:
@@ -49,46 +72,175 @@ class ChatClient:
             if hasattr(self, 'root'):
                 self.root.destroy()
 
-    def poll_server(self):
-        """Thread function to handle server polling"""
-        while self.running:
+    def connect(self):
+        """Connect to the server and start the polling thread reading from it"""
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.client.connect((host, port))
+        self.decoder = FrameDecoder()
+        self.compressor = None
+        self.connected = True
+        # Ask for compressed replies, servers that don't know HELLO ignore it
+        self.send(offer_compression(), FRAME_HELLO)
+
+        self.poll_thread = threading.Thread(target=self.poll_server,
+                                            args=(self.client, self.decoder))
+        self.poll_thread.daemon = True
+        self.poll_thread.start()
+
+    def send(self, payload, frame_type=FRAME_MESSAGE):
+        """Send one framed message to the server"""
+        with self.send_lock:
+            if self.compressor:
+                self.client.sendall(self.compressor.encode_frame(payload, frame_type))
+            else:
+                self.client.sendall(encode_frame(payload, frame_type))
+
+    def request(self, payload, callback=None):
+        """Send a command without waiting for the reply.
+
+        Returns a Future for the reply text, '' if the connection dropped or
+        the server didn't answer within REPLY_TIMEOUT. callback(reply) is run
+        on the Tk thread once it is done. Any number of requests can be in
+        flight at once.
+        """
+        request_id = next(self.request_ids) & 0xffffffff
+        future = Future()
+        if callback:
+            future.add_done_callback(lambda done: self.events.put(lambda: callback(done.result())))
+        with self.pending_lock:
+            self.pending[request_id] = future
+        try:
+            with self.send_lock:
+                self.client.sendall(encode_request(request_id, payload, compressor=self.compressor))
+        except Exception as e:
+            print(f"Send error: {e}")
+            self.complete(request_id, '')
+            return future
+        self.root.after(int(REPLY_TIMEOUT * 1000), self.complete, request_id, '')
+        return future
+
+    def complete(self, request_id, reply):
+        with self.pending_lock:
+            future = self.pending.pop(request_id, None)
+        if future:
+            future.set_result(reply)
+
+    def fail_pending(self):
+        """The connection is gone, so are the replies to everything in flight"""
+        with self.pending_lock:
+            futures = list(self.pending.values())
+            self.pending.clear()
+        for future in futures:
+            future.set_result('')
+
+    def process_events(self):
+        """Run what the polling thread queued for the Tk thread"""
+        while True:
             try:
-                # Try to receive keepalive message
-                self.poll_socket.settimeout(2.0)  # Set timeout for receiving
-                data = self.poll_socket.recv(1024).decode('utf-8')
-                
-                if data == "KEEP_ALIVE":
-                    # Send acknowledgment
-                    self.poll_socket.send("ALIVE".encode('utf-8'))
-                elif data == "":
-                    # Empty response means server disconnected
-                    self.handle_disconnect()
-                    break
-                    
-            except socket.timeout:
-                # Timeout is normal, just continue
-                pass
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                event()
             except Exception as e:
+                print(f"Event error: {e}")
+        if self.running:
+            self.root.after(EVENT_POLL, self.process_events)
+
+    def poll_server(self, sock, decoder):
+        """Thread function reading everything the server sends on the connection"""
+        try:
+            while self.running:
+                for frame_type, payload in decoder.frames():
+                    if frame_type == FRAME_REPLY:
+                        request_id, reply = split_request(payload)
+                        self.complete(request_id, str(reply, 'utf-8'))
+                    elif frame_type == FRAME_PUSH:
+                        data = json.loads(str(payload, 'utf-8'))
+                        self.events.put(lambda data=data: self.display_message(data))
+                    elif frame_type == FRAME_PING:
+                        self.send(b'', FRAME_PONG)
+                    elif frame_type == FRAME_HELLO:
+                        self.hello(decoder, payload)
+
+                nbytes = sock.recv_into(decoder.writable())
+                if not nbytes:
+                    break  # server disconnected
+                decoder.commit(nbytes)
+        except Exception as e:
+            if self.running:
                 print(f"Polling error: {e}")
-                self.handle_disconnect()
-                break
-                
-            time.sleep(1)  # Sleep for performance
+
+        if sock is self.client:
+            self.fail_pending()
+            self.events.put(self.handle_disconnect)
+
+    def hello(self, decoder, payload):
+        """The server's answer to our HELLO, on the polling thread"""
+        method = json.loads(str(payload, 'utf-8')).get('compression')
+        if method and decoder is self.decoder:  # not a connection we have since dropped
+            decoder.decompressor = Decompressor(method)
+            with self.send_lock:
+                self.compressor = Compressor(method)
 
     def handle_disconnect(self):
-        """Handle server disconnection"""
+        """Handle server disconnection, on the Tk thread"""
         self.connected = False
-        if self.logged_in:
-            # Show error in GUI thread
-            self.root.after(0, lambda: messagebox.showerror("Error", "Lost connection to server"))
-            self.root.after(0, self.show_login)
+        if self.logged_in and self.token:
+            if not self.resuming:
+                self.resuming = True
+                self.root.after(RESUME_DELAY, self.resume, RESUME_ATTEMPTS)
+        elif self.logged_in:
+            self.connection_lost()
+
+    def connection_lost(self):
+        self.close_cache()
+        self.logged_in = False
+        self.resuming = False
+        self.token = None
+        messagebox.showerror("Error", "Lost connection to server")
+        self.show_login()
+
+    def resume(self, attempts):
+        """Reconnect and pick the session back up with its token, no password needed.
+
+        Messages pushed while we were away are replayed by the server and
+        arrive through the polling thread like any others.
+        """
+        if not self.logged_in:
+            self.resuming = False
+            return
+        try:
+            self.connect()
+        except Exception as e:
+            print(f"Resume error: {e}")
+            self.connected = False
+            self.resumed(attempts, '')
+            return
+        self.request(f"RESUME:{json.dumps({'token': self.token})}",
+                     lambda response: self.resumed(attempts, response))
+
+    def resumed(self, attempts, response):
+        if not self.logged_in:
+            self.resuming = False
+        elif response.startswith('RESUME_SUCCESS:'):
+            reply = json.loads(response.split(':', 1)[1])
+            self.token = reply['token']
+            self.resuming = False
+            print(f"Session resumed, {reply['replayed']} messages replayed")
+            if not reply['complete'] and self.current_chat_id and hasattr(self, 'chat_name'):
+                self.show_chat(self.chat_name)  # missed too much, reload the history
+        elif response == 'RESUME_FAIL' or attempts <= 1:
+            self.connection_lost()
+        else:
+            self.root.after(RESUME_DELAY, self.resume, attempts - 1)
 
     def on_closing(self):
         if messagebox.askokcancel("Quit", "Do you want to quit?"):
             self.running = False  # Stop polling thread
+            self.close_cache()
             try:
                 self.client.close()
-                self.poll_socket.close()
             except:
                 pass
             self.root.quit()
@@ -103,11 +255,7 @@ class ChatClient:
             # Try reconnecting if needed
             if not self.connected:
                 try:
-                    self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.poll_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.client.connect((host, port))
-                    self.poll_socket.connect((host, poll_port))
-                    self.connected = True
+                    self.connect()
                 except Exception as e:
                     messagebox.showerror("Connection Error", "Could not connect to server: " + str(e))
                     return
@@ -117,21 +265,28 @@ class ChatClient:
                 'password': password
             }
             message = f"LOGIN:{json.dumps(login_data)}"
-            self.client.send(message.encode('utf-8'))
-            
-            response = self.client.recv(1024).decode('utf-8')
-            print("Response from server: ", response)
-            
-            if response == 'AUTH_SUCCESS':
-                self.logged_in = True
-                self.username = username
-                self.show_chat_selection_screen()
-            else:
-                messagebox.showerror("Error", "Invalid credentials")
+            self.request(message, lambda response: self.logged_in_as(username, response))
         except Exception as e:
             self.connected = False
             messagebox.showerror("Login Error", str(e))
 
+    def logged_in_as(self, username, response):
+        print("Response from server: ", response)
+
+        if response.startswith('AUTH_SUCCESS'):
+            self.token = response.split(':', 1)[1] if ':' in response else None
+            self.logged_in = True
+            self.username = username
+            self.histories = {}
+            self.cache = open_local_cache(host, port, username)
+            self.show_chat_selection_screen()
+        elif response == 'AUTH_BUSY':
+            messagebox.showerror("Error", "Server is busy, please try again")
+        elif not response:
+            messagebox.showerror("Login Error", "No answer from the server")
+        else:
+            messagebox.showerror("Error", "Invalid credentials")
+
     def show_signup(self):
         self.clear_window()
         
@@ -168,23 +323,23 @@ class ChatClient:
                 'password': password
             }
             message = f"REGISTER:{json.dumps(register_data)}"
-            self.client.send(message.encode('utf-8'))
-            
-            # Wait for server response
-            response = self.client.recv(1024).decode('utf-8')
-            print("Response from server: ", response)
-            
-            if response == 'REG_SUCCESS':
-                messagebox.showinfo("Success", "Registration successful!")
-                self.show_login()
-            elif response == 'REG_FAIL':
-                messagebox.showerror("Error", "Username already exists")
-            else:
-                messagebox.showerror("Error", "Registration failed")
-                
+            self.request(message, self.registered)
         except Exception as e:
             messagebox.showerror("Registration Error: ", str(e))
 
+    def registered(self, response):
+        print("Response from server: ", response)
+
+        if response == 'REG_SUCCESS':
+            messagebox.showinfo("Success", "Registration successful!")
+            self.show_login()
+        elif response == 'REG_FAIL':
+            messagebox.showerror("Error", "Username already exists")
+        elif response == 'AUTH_BUSY':
+            messagebox.showerror("Error", "Server is busy, please try again")
+        else:
+            messagebox.showerror("Error", "Registration failed")
+
     def show_chat_selection_screen(self):
         self.clear_window()
         
@@ -300,7 +455,12 @@ class ChatClient:
         ttk.Button(bottom_frame, text="Logout", 
                   command=self.logout).pack(side=tk.RIGHT)
         
-        # Load chats
+        # Show the chat list from last time, then ask the server for it
+        self.shown_chats = None
+        if self.cache:
+            chats = self.cache.load_list('chats')
+            if chats:
+                self.fill_chat_tree(chats)
         self.refresh_chats()
 
     def show_create_chat_dialog(self):
@@ -345,9 +505,9 @@ class ChatClient:
             'is_group': is_group,
             'creator': self.username
         }
-        self.client.send(f'CREATE_CHAT:{json.dumps(data)}'.encode('utf-8'))
-        response = self.client.recv(1024).decode('utf-8')
-        
+        self.request(f'CREATE_CHAT:{json.dumps(data)}', self.chat_created)
+
+    def chat_created(self, response):
         if response.startswith('CHAT_CREATED:'):
             messagebox.showinfo("Success", "Chat created successfully!")
             self.refresh_chats()
@@ -356,30 +516,43 @@ class ChatClient:
 
     def refresh_chats(self):
         try:
-            self.client.send(f'GET_CHATS:{self.username}'.encode('utf-8'))
-            response = self.client.recv(1024).decode('utf-8')
-            
+            self.request(f'GET_CHATS:{self.username}', self.show_chats)
+        except Exception as e:
+            print(f"Refresh chats error: {e}")
+            messagebox.showerror("Error", "Failed to refresh chats")
+
+    def show_chats(self, response):
+        if not hasattr(self, 'chat_tree') or not self.chat_tree.winfo_exists():
+            return  # left the chat list while the request was in flight
+        try:
             try:
                 chats = json.loads(response)
             except json.JSONDecodeError:
                 messagebox.showerror("Error", "Failed to load chats")
                 return
-                
-            # Clear existing items
-            for item in self.chat_tree.get_children():
-                self.chat_tree.delete(item)
-            
-            # Add chats to tree
-            for chat in chats:
-                chat_type = "Group" if chat['is_group'] else "Private"
-                participants = ", ".join(chat['participants'])
-                self.chat_tree.insert('', 'end', 
-                                    values=(chat['chat_name'], chat_type, participants),
-                                    tags=(chat['_id'],))
+
+            if chats != self.shown_chats:  # the cached list may already be right
+                self.fill_chat_tree(chats)
+            if self.cache:
+                self.cache.save_list('chats', chats)
         except Exception as e:
             print(f"Refresh chats error: {e}")
             messagebox.showerror("Error", "Failed to refresh chats")
 
+    def fill_chat_tree(self, chats):
+        # Clear existing items
+        for item in self.chat_tree.get_children():
+            self.chat_tree.delete(item)
+
+        # Add chats to tree
+        for chat in chats:
+            chat_type = "Group" if chat['is_group'] else "Private"
+            participants = ", ".join(chat['participants'])
+            self.chat_tree.insert('', 'end',
+                                values=(chat['chat_name'], chat_type, participants),
+                                tags=(chat['_id'],))
+        self.shown_chats = chats
+
     def on_chat_selected(self, event):
         selection = self.chat_tree.selection()
         if not selection:
@@ -393,6 +566,7 @@ class ChatClient:
         self.show_chat(chat_name)
 
     def show_chat(self, chat_name):
+        self.chat_name = chat_name
         self.clear_window()
         
         # Main container with chat name at top
@@ -426,13 +600,103 @@ class ChatClient:
         ttk.Button(input_frame, text="Send", 
                   command=self.send_message).pack(side=tk.RIGHT)
         
-        # Load chat history
-        self.client.send(f'GET_MESSAGES:{self.current_chat_id}'.encode('utf-8'))
+        # Show what we already have, then ask only for what is newer
+        try:
+            chat_id = self.current_chat_id
+            history = self.history(chat_id)
+            self.show_history(self.chat_text, history['messages'])
+            chat_text = self.chat_text
+            request = {'chat_id': chat_id, 'since': history['seq'], 'limit': SYNC_LIMIT}
+            had = {message['_id'] for message in history['messages']}
+            self.request(f'SYNC:{json.dumps(request)}',
+                         lambda response: self.synced(chat_text, chat_id, had, response))
+        except Exception as e:
+            print(f"Load history error: {e}")
         
         # Bind enter key
         self.message_entry.bind('<Return>', lambda e: self.send_message())
         self.message_entry.focus()
 
+    def synced(self, chat_text, chat_id, had, response):
+        """Merge a SYNC reply into the chat's history and show it if it changed.
+
+        had is the ids of the messages the history held when the SYNC was sent.
+        """
+        try:
+            reply = json.loads(response)
+        except json.JSONDecodeError:
+            print("Load history error: no reply to SYNC")
+            return
+        history = self.history(chat_id)
+        if reply['reset']:
+            # What we had can't be brought up to date and is replaced, except
+            # for messages pushed while the SYNC was on its way
+            kept = [message for message in history['messages'] if message['_id'] not in had]
+            history['seq'] = reply['seq']
+        else:
+            kept = history['messages']
+            history['seq'] = max(history['seq'], reply['seq'])
+        known = {message['_id'] for message in kept}
+        new = [message for message in reply['messages'] if message['_id'] not in known]
+        if not new and not reply['reset']:
+            return  # nothing we didn't have, the chat is already on screen
+        messages = sorted(kept + new, key=lambda message: message.get('seq', 0))
+        history['messages'] = messages[-HISTORY_SIZE:]
+        self.dirty.add(chat_id)
+        if chat_text is self.chat_text and chat_text.winfo_exists():
+            chat_text.delete('1.0', tk.END)
+            self.show_history(chat_text, history['messages'])
+
+    def show_history(self, chat_text, messages):
+        try:
+            chat_text.insert(tk.END, ''.join(f"{message['username']}: {message['content']}\n"
+                                             for message in messages))
+            chat_text.see(tk.END)
+        except Exception as e:
+            print(f"Load history error: {e}")
+
+    def history(self, chat_id):
+        """The chat's history, read from the local cache the first time"""
+        history = self.histories.get(chat_id)
+        if history is None:
+            history = self.cache.load_history(chat_id) if self.cache else None
+            history = self.histories[chat_id] = history or {'seq': None, 'messages': []}
+        return history
+
+    def remember(self, data):
+        """Add a pushed message to its chat's history, if we keep one"""
+        history = self.histories.get(data['chat_id'])
+        if history is None or '_id' not in data:
+            return
+        history['messages'].append(data)
+        del history['messages'][:-HISTORY_SIZE]
+        # Only move on if nothing was missed in between, otherwise the next
+        # SYNC fetches the gap (and this message again, dropped as a duplicate)
+        if history['seq'] is not None and data['seq'] == history['seq'] + 1:
+            history['seq'] = data['seq']
+        self.dirty.add(data['chat_id'])
+
+    def flush_cache(self):
+        """Write the chats changed since the last flush to the local cache"""
+        if not self.cache or not self.dirty:
+            return
+        try:
+            self.cache.save_histories({chat_id: self.histories[chat_id] for chat_id in self.dirty})
+        except Exception as e:
+            print(f"Local cache error: {e}")
+        self.dirty.clear()
+
+    def autosave_cache(self):
+        self.flush_cache()
+        if self.running:
+            self.root.after(CACHE_FLUSH, self.autosave_cache)
+
+    def close_cache(self):
+        self.flush_cache()
+        if self.cache:
+            self.cache.close()
+            self.cache = None
+
     def send_message(self):
         if not self.current_chat_id:
             return
@@ -444,34 +708,40 @@ class ChatClient:
                 'content': message,
                 'username': self.username
             }
-            self.client.send(f'MESSAGE:{json.dumps(data)}'.encode('utf-8'))
+            self.send(f'MESSAGE:{json.dumps(data)}')  # no reply, the message is pushed back
             self.message_entry.delete(0, tk.END)
 
-    def receive_messages(self):
-        while True:
-            try:
-                message = self.client.recv(1024).decode('utf-8')
-                if message.startswith('{'):
-                    # Handle JSON messages
-                    data = json.loads(message)
-                    if 'chat_id' in data and data['chat_id'] == self.current_chat_id:
-                        self.chat_text.insert(tk.END, 
-                                           f"{data['username']}: {data['content']}\n")
-                        self.chat_text.see(tk.END)
-                else:
-                    # Handle system messages
-                    self.chat_text.insert(tk.END, f"System: {message}\n")
-                    self.chat_text.see(tk.END)
-            except Exception as e:
-                if self.logged_in:
-                    messagebox.showerror("Error", "Lost connection to server")
-                    self.root.quit()
-                break
+    def display_message(self, data):
+        """Show a chat message pushed by the server, runs on the Tk thread"""
+        if data.get('chat_id') is not None:
+            self.remember(data)
+        if not hasattr(self, 'chat_text') or not self.chat_text.winfo_exists():
+            return
+        if data.get('chat_id') is None:
+            # Handle system messages
+            self.chat_text.insert(tk.END, f"System: {data['content']}\n")
+        elif data['chat_id'] == self.current_chat_id:
+            self.chat_text.insert(tk.END, 
+                               f"{data['username']}: {data['content']}\n")
+        else:
+            return
+        self.chat_text.see(tk.END)
 
     def logout(self):
+        # The server revokes our token and closes the connection, the next
+        # login connects again
+        if self.connected:
+            try:
+                self.send('LOGOUT:{}')
+            except Exception as e:
+                print(f"Logout error: {e}")
+            self.connected = False
         self.logged_in = False
         self.username = None
+        self.token = None
         self.current_chat_id = None
+        self.close_cache()
+        self.histories = {}
         self.show_login()
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+import json
+import os
+import re
+import sqlite3
+import time
+
+CACHE_DIR_ENV = 'CHAT_CLIENT_CACHE'  # directory for the cache files, default under the user's data dir
+MAX_BYTES = 32 * 1024 * 1024         # cached history per user before the least recently opened chats go
+UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_.-]')
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    seq INTEGER,
+    messages TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chats_by_use ON chats (used_at);
+CREATE TABLE IF NOT EXISTS lists (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+SQL_LOAD_HISTORY = "SELECT seq, messages FROM chats WHERE chat_id = ?"
+SQL_TOUCH = "UPDATE chats SET used_at = ? WHERE chat_id = ?"
+SQL_SAVE_HISTORY = """
+INSERT INTO chats (chat_id, seq, messages, size, used_at) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (chat_id) DO UPDATE SET seq = excluded.seq, messages = excluded.messages, size = excluded.size
+"""
+SQL_TOTAL_SIZE = "SELECT COALESCE(SUM(size), 0) FROM chats"
+SQL_OLDEST = "SELECT chat_id, size FROM chats ORDER BY used_at LIMIT 64"
+SQL_DELETE_CHAT = "DELETE FROM chats WHERE chat_id = ?"
+SQL_LOAD_LIST = "SELECT value FROM lists WHERE name = ?"
+SQL_SAVE_LIST = "INSERT OR REPLACE INTO lists (name, value) VALUES (?, ?)"
+
+
+def data_dir():
+    """Where the client keeps its files: $CHAT_CLIENT_CACHE, or the platform's
+    per-user data directory"""
+    if os.environ.get(CACHE_DIR_ENV):
+        return os.environ[CACHE_DIR_ENV]
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(base, 'chat-client')
+
+
+def open_local_cache(host, port, username, max_bytes=MAX_BYTES):
+    """The cache of one user on one server, or None if it can't be opened.
+
+    The client works the same without it, only slower to show things.
+    """
+    name = UNSAFE_CHARS.sub('_', f'{host}_{port}_{username}')
+    try:
+        directory = data_dir()
+        os.makedirs(directory, exist_ok=True)
+        return LocalCache(os.path.join(directory, f'{name}.db'), max_bytes)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Local cache unavailable: {e}")
+        return None
+
+
+class LocalCache:
+    """Chat histories and the chat list kept on disk between runs.
+
+    Each chat's history is stored as one JSON row with the sequence number
+    it is complete up to (see SYNC on the server), so the client can show it
+    straight away and ask only for what is newer. Once the histories go over
+    max_bytes the chats opened least recently are dropped. Used from the Tk
+    thread only.
+    """
+    def __init__(self, path, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # a lost last write is only a cache miss
+        self.db.executescript(CACHE_SCHEMA)
+
+    def load_history(self, chat_id):
+        """{'seq', 'messages'} as last saved, or None. Marks the chat as used"""
+        row = self.db.execute(SQL_LOAD_HISTORY, (chat_id,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute(SQL_TOUCH, (time.time(), chat_id))
+        seq, messages = row
+        return {'seq': seq, 'messages': json.loads(messages)}
+
+    def save_histories(self, histories):
+        """Store {chat_id: history} in one transaction, then evict if over the cap"""
+        now = time.time()
+        self.db.execute('BEGIN')
+        try:
+            for chat_id, history in histories.items():
+                messages = json.dumps(history['messages'])
+                self.db.execute(SQL_SAVE_HISTORY, (chat_id, history['seq'], messages, len(messages), now))
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.evict()
+
+    def evict(self):
+        total = self.db.execute(SQL_TOTAL_SIZE).fetchone()[0]
+        while total > self.max_bytes:
+            oldest = self.db.execute(SQL_OLDEST).fetchall()
+            if not oldest:
+                return
+            for chat_id, size in oldest:
+                self.db.execute(SQL_DELETE_CHAT, (chat_id,))
+                total -= size
+                if total <= self.max_bytes:
+                    return
+
+    def load_list(self, name):
+        """A saved list (the chat list), or None"""
+        row = self.db.execute(SQL_LOAD_LIST, (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_list(self, name, value):
+        self.db.execute(SQL_SAVE_LIST, (name, json.dumps(value)))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import socket
+from protocol import FrameDecoder, ProtocolError, encode_frame
+from outbound import OutboundQueue
+
+# Messages between the server worker processes, framed like client traffic
+BUS_MESSAGE = 0  # a chat message or server notice to deliver, JSON
+BUS_CHAT = 1     # a chat was created, JSON {"chat_id": ..., "usernames": [...]}
+BUS_REVOKE = 2   # a session token was used up, the session id as text
+
+BUS_MAX_QUEUED = 64 * 1024 * 1024  # a worker this far behind is dropped from the bus
+BUS_RETRY_DELAY = 0.2              # seconds between attempts to reach the broker
+BUS_CONNECT_ATTEMPTS = 50
+
+
+async def _read_frames(loop, sock, decoder):
+    """Yield (frame type, payload) from sock until the peer closes it"""
+    while True:
+        for frame in decoder.frames():
+            yield frame
+        nbytes = await loop.sock_recv_into(sock, decoder.writable())
+        if not nbytes:
+            return
+        decoder.commit(nbytes)
+
+
+class BusBroker:
+    """Local pub/sub relay between server workers over a Unix domain socket.
+
+    Every worker connects once, anything one worker publishes is sent on to
+    all the others. The frame is encoded once and shared by every worker's
+    send queue, like a broadcast to clients.
+    """
+    def __init__(self, path, log=print):
+        self.path = path
+        self.log = log
+        self.peers = {}  # {socket: OutboundQueue}
+        self.loop = None
+        self.server = None
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.setblocking(False)
+        self.server.bind(self.path)
+        self.server.listen(64)
+        try:
+            while True:
+                peer, _ = await self.loop.sock_accept(self.server)
+                self.loop.create_task(self.handle_peer(peer))
+        finally:
+            self.close()
+
+    def close(self):
+        for peer, outbound in list(self.peers.items()):
+            self.drop(peer)
+        if self.server:
+            self.server.close()
+            self.server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    async def handle_peer(self, peer):
+        outbound = OutboundQueue(self.loop, peer,
+                                 on_slow=lambda: self.drop(peer, "too slow"),
+                                 on_error=lambda e: self.drop(peer, e),
+                                 max_queued=BUS_MAX_QUEUED)
+        self.peers[peer] = outbound
+        writer = self.loop.create_task(outbound.run())
+        try:
+            async for frame_type, payload in _read_frames(self.loop, peer, FrameDecoder()):
+                frame = encode_frame(payload, frame_type)
+                for other, queue in list(self.peers.items()):
+                    if other is not peer:
+                        queue.put(frame)
+        except (ConnectionError, OSError, ProtocolError) as e:
+            self.log(f"Bus peer error: {e}")
+        finally:
+            writer.cancel()
+            self.drop(peer)
+
+    def drop(self, peer, reason=None):
+        outbound = self.peers.pop(peer, None)
+        if outbound is None:
+            return
+        if reason:
+            self.log(f"Dropping bus peer: {reason}")
+        outbound.close()
+        self.loop.remove_reader(peer)
+        self.loop.remove_writer(peer)
+        peer.close()
+
+
+class BusClient:
+    """A worker's connection to the BusBroker.
+
+    publish() never blocks, frames are queued like any other outbound
+    traffic. Everything the other workers publish is handed to
+    on_message(frame type, payload bytes) on the event loop. There is no
+    reconnecting, whatever was published meanwhile would be missed: run()
+    returns once the connection is lost, for the worker to shut down.
+    """
+    def __init__(self, path, on_message, log=print):
+        self.path = path
+        self.on_message = on_message
+        self.log = log
+        self.sock = None
+        self.outbound = None
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        for attempt in range(BUS_CONNECT_ATTEMPTS):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                await asyncio.sleep(BUS_RETRY_DELAY)  # the broker is still starting
+        else:
+            raise ConnectionError(f"No message bus at {self.path}")
+
+        self.sock = sock
+        self.outbound = OutboundQueue(loop, sock,
+                                      on_slow=lambda: self.lost("too slow"),
+                                      on_error=lambda e: self.lost(f"error: {e}"),
+                                      max_queued=BUS_MAX_QUEUED)
+
+    def lost(self, reason):
+        """Publishing failed, end run() rather than carry on without the bus"""
+        self.log(f"Message bus {reason}")
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def publish(self, frame_type, payload):
+        if self.outbound is not None:
+            self.outbound.put(encode_frame(payload, frame_type))
+
+    async def run(self):
+        """Connect, then relay frames both ways until cancelled or the broker goes away"""
+        await self.connect()
+        loop = asyncio.get_running_loop()
+        writer = loop.create_task(self.outbound.run())
+        try:
+            async for frame_type, payload in _read_frames(loop, self.sock, FrameDecoder()):
+                try:
+                    self.on_message(frame_type, bytes(payload))
+                except Exception as e:
+                    self.log(f"Bus message error: {e}")
+            self.log("Message bus closed")
+        except (ConnectionError, OSError, ProtocolError) as e:
+            self.log(f"Message bus error: {e}")
+        finally:
+            writer.cancel()
+            self.close()
+
+    def close(self):
+        if self.outbound is not None:
+            self.outbound.close()
+            self.outbound = None
+        if self.sock is not None:
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.sock)
+            loop.remove_writer(self.sock)
+            self.sock.close()
+            self.sock = None
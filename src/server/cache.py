@@ -0,0 +1,234 @@
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Rough per-message cost of the dict, datetime and strings on top of the text
+MESSAGE_OVERHEAD = 300
+# Messages other workers saved into chats we don't cache, kept this long (or
+# until there are this many) in case we load the chat before they are written
+ELSEWHERE_SECONDS = 30.0
+ELSEWHERE_MAX = 4096
+
+
+def message_size(message):
+    return MESSAGE_OVERHEAD + len(message['content']) + len(message['username'])
+
+
+class _History:
+    __slots__ = ('messages', 'size', 'complete', 'loading', 'pending')
+
+    def __init__(self, ring_size):
+        self.messages = deque(maxlen=ring_size)
+        self.size = 0
+        self.complete = False  # ring holds the chat's entire history
+        self.loading = True    # being filled from the database
+        self.pending = []      # messages saved while loading
+
+
+class HistoryCache:
+    """Recent messages per chat, kept in bounded rings with LRU eviction.
+
+    Rings are filled from the database on a miss and kept fresh by write-through
+    from save_message. Chats are evicted least recently used first once the
+    estimated memory use goes over max_bytes. Thread safe, the database is
+    called from several threads.
+    """
+    def __init__(self, ring_size=200, max_bytes=64 * 1024 * 1024):
+        self.ring_size = ring_size
+        self.max_bytes = max_bytes
+        self.chats = OrderedDict()  # {chat_id: _History}, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.elsewhere = deque()  # (expiry, chat_id, message) oldest first, see saved_elsewhere
+        self.lock = threading.Lock()
+
+    def get(self, chat_id, limit):
+        """The newest limit messages oldest first, or None if they are not all cached"""
+        with self.lock:
+            history = self.chats.get(chat_id)
+            if (history is None or history.loading or
+                    (len(history.messages) < limit and not history.complete)):
+                self.misses += 1
+                return None
+            self.chats.move_to_end(chat_id)
+            self.hits += 1
+            if limit >= len(history.messages):
+                return list(history.messages)
+            return list(history.messages)[-limit:]
+
+    def begin_load(self, chat_id):
+        """Mark chat_id as being read from the database so saves are not lost"""
+        with self.lock:
+            if chat_id not in self.chats:
+                self.chats[chat_id] = _History(self.ring_size)
+
+    def finish_load(self, chat_id, messages, complete):
+        """Fill the ring with the newest messages read after begin_load().
+
+        Returns the ring's messages oldest first, or None if it was dropped
+        while loading.
+        """
+        with self.lock:
+            history = self.chats.get(chat_id)
+            if history is None or not history.loading:
+                return None
+            loaded = {message['_id'] for message in messages}
+            # Saved by another worker that may not have written them yet
+            oldest = (messages[0]['timestamp'], messages[0]['_id']) if messages and not complete else None
+            unwritten = [message for _, elsewhere_chat, message in self.elsewhere
+                         if elsewhere_chat == chat_id and message['_id'] not in loaded and
+                         (oldest is None or (message['timestamp'], message['_id']) > oldest)]
+            if unwritten:
+                messages = sorted(messages + unwritten, key=lambda message: (message['timestamp'], message['_id']))
+                loaded.update(message['_id'] for message in unwritten)
+            history.loading = False
+            history.complete = complete
+            for message in messages:
+                self._append(history, message)
+            for message in history.pending:
+                if message['_id'] not in loaded:
+                    self._append(history, message)
+            history.pending = []
+            self.chats.move_to_end(chat_id)
+            self._evict()
+            return list(history.messages)
+
+    def append(self, chat_id, message):
+        """Write-through for a newly saved message, only kept if the chat is cached"""
+        with self.lock:
+            history = self.chats.get(chat_id)
+            if history is None:
+                return
+            if history.loading:
+                history.pending.append(message)
+                return
+            self._append(history, message)
+            self._evict()
+
+    def saved_elsewhere(self, chat_id, message):
+        """Write-through for a message another server worker saved.
+
+        If the chat isn't cached the message is kept aside for a while: that
+        worker writes it behind, and a load of the chat before then would
+        miss it for as long as the ring is cached.
+        """
+        with self.lock:
+            history = self.chats.get(chat_id)
+            if history is not None:
+                if history.loading:
+                    history.pending.append(message)
+                else:
+                    self._append(history, message)
+                    self._evict()
+                return
+            now = time.monotonic()
+            while self.elsewhere and (self.elsewhere[0][0] < now or len(self.elsewhere) >= ELSEWHERE_MAX):
+                self.elsewhere.popleft()
+            self.elsewhere.append((now + ELSEWHERE_SECONDS, chat_id, message))
+
+    def discard(self, chat_id=None):
+        """Drop one chat, or every chat when chat_id is None"""
+        with self.lock:
+            if chat_id is None:
+                self.chats.clear()
+                self.elsewhere.clear()
+                self.size = 0
+            else:
+                history = self.chats.pop(chat_id, None)
+                if history is not None:
+                    self.size -= history.size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'chats': len(self.chats),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def _append(self, history, message):
+        if len(history.messages) == history.messages.maxlen:
+            dropped = message_size(history.messages[0])
+            history.size -= dropped
+            self.size -= dropped
+            history.complete = False
+        history.messages.append(message)
+        added = message_size(message)
+        history.size += added
+        self.size += added
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.chats) > 1:
+            # Least recently used first, skipping rings another thread is filling
+            # and never the most recently used chat
+            newest = next(reversed(self.chats))
+            victim = next((chat_id for chat_id, history in self.chats.items()
+                           if not history.loading and chat_id != newest), None)
+            if victim is None:
+                return
+            history = self.chats.pop(victim)
+            self.size -= history.size
+            self.evictions += 1
+
+
+class ChatListCache:
+    """Each user's chat list, along with its serialized JSON, for GET_CHATS.
+
+    Entries are invalidated for every participant when a chat is created and
+    the least recently used users are dropped past max_users.
+    """
+    def __init__(self, max_users=10000):
+        self.max_users = max_users
+        self.users = OrderedDict()  # {username: (chats, json bytes)}
+        self.generation = 0  # bumped on every invalidation
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, username):
+        """(chats, json bytes) for username, or None"""
+        with self.lock:
+            entry = self.users.get(username)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.users.move_to_end(username)
+            self.hits += 1
+            return entry
+
+    def load_token(self):
+        """Take before reading from the database, pass to put()"""
+        with self.lock:
+            return self.generation
+
+    def put(self, username, chats, token):
+        """Cache a chat list read after load_token() returned token"""
+        entry = (chats, json.dumps(chats, default=str).encode('utf-8'))
+        with self.lock:
+            # A chat may have been created while we were reading, the list
+            # could be missing it so don't keep it
+            if token == self.generation:
+                self.users[username] = entry
+                self.users.move_to_end(username)
+                while len(self.users) > self.max_users:
+                    self.users.popitem(last=False)
+        return entry
+
+    def invalidate(self, usernames=None):
+        """Forget the given users' chat lists, or everyone's when usernames is None"""
+        with self.lock:
+            self.generation += 1
+            if usernames is None:
+                self.users.clear()
+            else:
+                for username in usernames:
+                    self.users.pop(username, None)
+
+    def stats(self):
+        with self.lock:
+            return {'users': len(self.users), 'hits': self.hits, 'misses': self.misses}
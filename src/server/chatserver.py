@@ -1,266 +1,850 @@
+import asyncio
+import os
+import secrets
 import socket
 import threading
-import json
 import time
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from database import Database
-from collections import defaultdict
-import random
-import string
+from passwords import HasherBusy
+from tokens import SessionTokens, TokenError
+from bus import BusClient, BUS_MESSAGE, BUS_CHAT, BUS_REVOKE
+from protocol import (FrameDecoder, ProtocolError, Compressor, Decompressor, accept_compression,
+                      encode_frame, encode_request, split_request, FRAME_MESSAGE, FRAME_PUSH,
+                      FRAME_PING, FRAME_PONG, FRAME_REQUEST, FRAME_REPLY, FRAME_HELLO)
+from subscriptions import ChatSubscriptions
+from metrics import Registry, SIZE_BUCKETS, serve_prometheus
+from heartbeat import HeartbeatManager
+from outbound import (OutboundQueue, HIGH_WATER, LOW_WATER, MAX_QUEUED,
+                      SLOW_CONSUMER_TIMEOUT)
+
+KEEP_ALIVE_INTERVAL = 3.0  # seconds of silence before a client is sent a keep-alive
+KEEP_ALIVE_TIMEOUT = 1.5   # seconds a client then has to send anything back
+HEARTBEAT_TICK = 0.5       # resolution of the heartbeat timer wheel
+DB_WORKERS = 4             # threads running blocking database calls
+READ_WORKERS = 4           # threads running chat list and history reads
+PIPELINE_DEPTH = 16        # commands a session may have in flight at once
+AUTH_WORKERS = 32          # threads waiting on LOGIN / REGISTER password hashes
+RESUME_GRACE = 120.0       # seconds a dropped session can be resumed with its token
+REPLAY_FRAMES = 1000       # pushed messages kept for a dropped session
+METRICS_PORT = 9155        # local port serving Prometheus metrics, when enabled
+STATS_USERS_ENV = 'CHAT_STATS_USERS'  # comma separated users allowed to send STATS
+COMMANDS = ('CREATE_CHAT', 'GET_CHATS', 'GET_MESSAGES', 'LOGOUT', 'MESSAGE', 'STATS', 'SYNC')
+
+
+class Session:
+    """A connected client: its socket and who is logged in on it.
+
+    Commands, replies, pushed chat messages and keep-alives are all multiplexed
+    over the one connection by frame type, see protocol.py.
+    """
+    def __init__(self, client, address):
+        self.client = client
+        self.address = address
+        self.username = None
+        self.session_id = None  # named in the session token, see tokens.py
+        self.decoder = FrameDecoder()
+        self.compressor = None  # compresses large replies once the client's HELLO asked for it
+        self.outbound = None  # OutboundQueue, drained by a writer coroutine
+        self.tasks = set()  # coroutines working on this session
+        self.pipeline = None  # asyncio.Semaphore, PIPELINE_DEPTH commands in flight
+        self.writes = {}  # {ordering key: last write command task}, see ChatServer.pipeline
+
+    def send(self, payload, frame_type=FRAME_MESSAGE):
+        """Queue a frame for this client, never blocks"""
+        if self.compressor:
+            return self.outbound.put(self.compressor.encode_frame(payload, frame_type))
+        return self.outbound.put(encode_frame(payload, frame_type))
+
+    def send_frame(self, frame):
+        return self.outbound.put(frame)
+
+    def reply(self, request_id, payload):
+        """Answer a command, tagged with its request id if it had one"""
+        if request_id is None:
+            return self.send(payload)
+        return self.outbound.put(encode_request(request_id, payload, FRAME_REPLY, self.compressor))
+
+    def close(self):
+        if self.outbound:
+            self.outbound.close()
+        try:
+            self.client.close()
+        except OSError:
+            pass
+
+
+class DetachedSession:
+    """What is left of a logged in session after its connection dropped.
+
+    It stays subscribed to the session's chats for the resume grace period and
+    buffers the latest messages pushed to it, RESUME replays them on the new
+    connection. Server notices to everyone aren't buffered, see deliver().
+    """
+    def __init__(self, session_id, username, max_frames=REPLAY_FRAMES):
+        self.session_id = session_id
+        self.username = username
+        self.frames = deque(maxlen=max_frames)
+        self.dropped = 0  # frames pushed out of the buffer
+        self.expiry = None  # asyncio timer handle
+
+    def send(self, payload, frame_type=FRAME_MESSAGE):
+        return self.send_frame(encode_frame(payload, frame_type))
+
+    def send_frame(self, frame):
+        if len(self.frames) == self.frames.maxlen:
+            self.dropped += 1
+        self.frames.append(frame)
+        return True
+
 
 class ChatServer:
-    def __init__(self, host='127.0.0.1', port=55555, gui_callback=None):
+    def __init__(self, host='127.0.0.1', port=55555, gui_callback=None,
+                 send_high_water=HIGH_WATER, send_low_water=LOW_WATER,
+                 send_max_queued=MAX_QUEUED, slow_consumer_timeout=SLOW_CONSUMER_TIMEOUT,
+                 token_secret=None, resume_grace=RESUME_GRACE, reuse_port=False, bus_path=None,
+                 db=None, metrics_port=None, stats_users=None):
         # Initialize main socket
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setblocking(False)
-        # Initialize polling socket
-        self.poll_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.poll_server.setblocking(False)
+        if reuse_port:
+            # Several worker processes share the port, see supervisor.py
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-        self.clientAccess = threading.Lock()
-        
         try:
             self.server.bind((host, port))
-            self.poll_server.bind((host, port + 1))  # Use port+1 for polling
-            
             self.server.listen(5)
-            self.poll_server.listen(5)
-            
+
             print(f"Main server initialized on {host}:{port}")
-            print(f"Poll server initialized on {host}:{port+1}")
-            
+
             # Initialize other attributes
-            self.clients = {}  # {bind_str: {poll_client: (username, client)}}
-            self.db = Database()
+            self.clients = {}  # {client socket: Session}
+            self.subscriptions = ChatSubscriptions()  # chat_id -> online participants
+            self.heartbeat = HeartbeatManager(
+                self.send_keep_alive,
+                self.heartbeat_timeout,
+                ping_after=KEEP_ALIVE_INTERVAL,
+                dead_after=KEEP_ALIVE_INTERVAL + KEEP_ALIVE_TIMEOUT,
+                tick=HEARTBEAT_TICK
+            )
+            self.db = db or Database()
+            self.db.message_writer.log = self.log_traffic
             self.running = True
+            # Signed tokens let a client that lost its connection RESUME
+            self.tokens = SessionTokens(token_secret)
+            self.resume_grace = resume_grace
+            self.detached = {}  # {session id: DetachedSession}
+            # Chat traffic shared with the other worker processes, if any
+            self.bus = BusClient(bus_path, self.on_bus_message, self.log_traffic) if bus_path else None
+            # Per connection send queue limits, see outbound.py
+            self.send_limits = {
+                'high_water': send_high_water,
+                'low_water': send_low_water,
+                'max_queued': send_max_queued,
+                'slow_timeout': slow_consumer_timeout
+            }
             self.gui_callback = gui_callback
 
-            
-            
+            # Event loop state, set up when start() runs the loop
+            self.loop = None
+            self.stopped = None
+            self.done = threading.Event()  # set once start() has shut everything down
+            # pymongo is blocking, keep it off the event loop
+            self.db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS,
+                                                  thread_name_prefix='db')
+            # A slow history query must not hold up message saves, reads
+            # get their own threads
+            self.read_executor = ThreadPoolExecutor(max_workers=READ_WORKERS,
+                                                    thread_name_prefix='read')
+            # Logins wait on bcrypt for a long time, keep them off the
+            # database threads so a login storm can't hold up chat traffic
+            self.auth_executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS,
+                                                    thread_name_prefix='auth')
+            # LOGIN / REGISTER calls admitted and not done yet, see run_auth
+            self.auth_pending = 0
+
+            # Read by STATS, the GUI and on metrics_port by Prometheus. Only
+            # the stats_users (by default $CHAT_STATS_USERS) may send STATS
+            self.metrics_port = metrics_port
+            if stats_users is None:
+                stats_users = os.environ.get(STATS_USERS_ENV, '').split(',')
+            self.stats_users = {username.strip() for username in stats_users if username.strip()}
+            self.setup_metrics()
+
         except Exception as e:
             print(f"Server initialization error: {e}")
             raise e
 
 
-    def disconnect_user(self, bindString) -> None:
-        # calling this function you should already have the lock
+    def setup_metrics(self):
+        self.metrics = Registry()
+        self.command_seconds = self.metrics.histogram(
+            'chat_command_seconds', "Time to handle a command", ['command'])
+        self.broadcast_recipients = self.metrics.histogram(
+            'chat_broadcast_recipients', "Sessions a message was pushed to", buckets=SIZE_BUCKETS)
+        self.broadcast_seconds = self.metrics.histogram(
+            'chat_broadcast_seconds', "Time to push a message to this process's sessions")
+        self.disconnects = self.metrics.counter(
+            'chat_disconnects_total', "Connections dropped by the server", ['reason'])
+        self.db_in_flight = self.metrics.gauge(
+            'chat_db_requests_in_flight', "Database calls queued or running", ['pool'])
+        self.commands_in_flight = self.metrics.gauge(
+            'chat_commands_in_flight', "Commands waiting or running, every session's pipeline")
+        self.metrics.gauge('chat_connections', "Open client connections",
+                           func=lambda: len(self.clients))
+        self.metrics.gauge('chat_sessions', "Logged in sessions, detached ones included",
+                           func=lambda: len(self.subscriptions.by_session))
+        self.metrics.gauge('chat_sessions_detached', "Dropped sessions waiting for RESUME",
+                           func=lambda: len(self.detached))
+        self.metrics.gauge('chat_send_queue_bytes', "Bytes queued on every connection's send queue",
+                           func=lambda: sum(session.outbound.size for session in list(self.clients.values())))
+        self.metrics.include(self.db.metrics)
+
+    def disconnect_user(self, session) -> None:
+        # Only called from the event loop thread, so no lock is needed
+        if self.clients.pop(session.client, None):
+            chat_ids = self.subscriptions.chats(session)
+            self.subscriptions.remove_session(session)
+            if session.username and self.running:
+                self.detach(session, chat_ids)
+            self.heartbeat.remove(session)
+            current = asyncio.current_task()
+            for task in session.tasks:
+                if task is not current:
+                    task.cancel()
+            # Drop the loop's interest in the socket before closing it, the
+            # cancelled reads and writes would otherwise touch a closed fd
+            self.loop.remove_reader(session.client)
+            self.loop.remove_writer(session.client)
+            session.close()
+
+    def detach(self, session, chat_ids):
+        """Keep a dropped session's chats and pushed messages around for RESUME"""
+        detached = DetachedSession(session.session_id, session.username)
+        # Frames still queued for the old connection are lost with it, they
+        # may be compressed for it so they can't be replayed. Count them as
+        # dropped so the resume is reported incomplete
+        if session.outbound:
+            detached.dropped = session.outbound.discarded + len(session.outbound.frames)
+        self.subscriptions.add_session(detached, session.username, chat_ids)
+        detached.expiry = self.loop.call_later(self.resume_grace, self.expire_detached, detached)
+        self.detached[detached.session_id] = detached
 
-        if self.clients[bindString][self.clients[bindString]]: # will be set to None if GameSocket never connected
-            self.clients[bindString][self.clients[bindString]].close()
-    
-        self.clients[bindString].close()
-    
-        del self.clients[bindString][self.clients[bindString]] # free {bindStr: {poll_client: (username, client)}}
-        del self.clients[bindString] # free {bindStr: {poll_client: None}}
+    def expire_detached(self, detached):
+        if self.detached.get(detached.session_id) is detached:
+            del self.detached[detached.session_id]
+            self.subscriptions.remove_session(detached)
+            # Only now gone for good, a resumed session never left
+            self.broadcast(f"{detached.username} left the chat!")
 
-    def authenticate_client(self, client):
-        """Handle client authentication process"""
+    async def run_db(self, func, *args):
+        """Run a blocking database call on the database thread pool"""
+        in_flight = self.db_in_flight.labels('db')
+        in_flight.inc()
         try:
-            data = client.recv(1024).decode('utf-8')
-            
-            if not data or ':' not in data:
-                self.log_traffic("Invalid authentication message format")
-                return None
-                
-            command, params_str = data.split(':', 1)
-            print(f"Command: {command}, Params: {params_str}")
-            
+            return await self.loop.run_in_executor(self.db_executor, partial(func, *args))
+        finally:
+            in_flight.dec()
+
+    async def run_read(self, func, *args):
+        """Run a blocking database read on the read thread pool"""
+        in_flight = self.db_in_flight.labels('read')
+        in_flight.inc()
+        try:
+            return await self.loop.run_in_executor(self.read_executor, partial(func, *args))
+        finally:
+            in_flight.dec()
+
+    async def run_auth(self, func, *args):
+        """Run a LOGIN / REGISTER database call, these wait on password hashing.
+
+        At most as many as the hasher takes jobs (hash_max_pending) are
+        admitted, further ones raise HasherBusy straight away instead of
+        queueing behind the auth threads.
+        """
+        if self.auth_pending >= self.db.hasher.max_pending:
+            raise HasherBusy(f"{self.auth_pending} logins already pending")
+        self.auth_pending += 1
+        in_flight = self.db_in_flight.labels('auth')
+        in_flight.inc()
+        try:
+            return await self.loop.run_in_executor(self.auth_executor, partial(func, *args))
+        finally:
+            in_flight.dec()
+            self.auth_pending -= 1
+
+    async def recv(self, session):
+        """Return (request id, command) for the next command from the session,
+        the command is '' once the peer has gone.
+
+        The request id is None for an untagged FRAME_MESSAGE command. Every
+        frame received counts as a heartbeat, keep-alive frames are answered
+        here and never reach the caller. The session can only answer our
+        pings while we are reading, so its heartbeat is paused in between.
+        """
+        decoder = session.decoder
+        self.heartbeat.resume(session)
+        try:
+            while True:
+                frame = decoder.next_frame()
+                if frame is None:
+                    nbytes = await self.loop.sock_recv_into(session.client, decoder.writable())
+                    if not nbytes:
+                        return None, ''
+                    decoder.commit(nbytes)
+                    continue
+
+                self.heartbeat.touch(session)
+                frame_type, payload = frame
+                if frame_type == FRAME_REQUEST:
+                    request_id, payload = split_request(payload)
+                    return request_id, str(payload, 'utf-8')
+                if frame_type == FRAME_MESSAGE:
+                    return None, str(payload, 'utf-8')
+                if frame_type == FRAME_PING:
+                    session.send(b'', FRAME_PONG)
+                elif frame_type == FRAME_HELLO:
+                    self.hello(session, payload)
+        finally:
+            self.heartbeat.pause(session)
+
+    def hello(self, session, payload):
+        """Agree on compression with a client that offered it in a FRAME_HELLO.
+
+        Replies are compressed from here on, pushed messages are not: their
+        frame is encoded once and shared by every recipient. The method is
+        fixed after the first HELLO, the client's decompressor depends on it.
+        """
+        if session.compressor:
+            session.send(json.dumps({'compression': session.compressor.method}), FRAME_HELLO)
+            return
+        method = accept_compression(payload)
+        # Answered before the compressor is set, the client can't decompress yet
+        session.send(json.dumps({'compression': method}), FRAME_HELLO)
+        if method:
+            session.compressor = Compressor(method)
+            session.decoder.decompressor = Decompressor(method)
+            self.log_traffic(f"Compression for {session.address}: {method}")
+
+    async def authenticate_client(self, session):
+        """Handle client authentication process, returns the username once logged in"""
+        request_id = None
+        while self.running:
             try:
-                params = json.loads(params_str)
-            except json.JSONDecodeError:
-                self.log_traffic("Invalid JSON in authentication message")
+                request_id, data = await self.recv(session)
+                if not data:
+                    return None
+
+                if ':' not in data:
+                    self.log_traffic("Invalid authentication message format")
+                    continue
+
+                command, params_str = data.split(':', 1)
+                print(f"Command: {command}, Params: {params_str}")
+
+                try:
+                    params = json.loads(params_str)
+                except json.JSONDecodeError:
+                    self.log_traffic("Invalid JSON in authentication message")
+                    continue
+
+                if command == 'LOGIN':
+                    if await self.run_auth(self.db.verify_user, params['username'], params['password']):
+                        session.session_id = secrets.token_urlsafe(12)
+                        token = self.tokens.issue(params['username'], session.session_id)
+                        session.reply(request_id, f'AUTH_SUCCESS:{token}')
+                        self.log_traffic(f"User logged in: {params['username']}")
+                        return params['username']
+                    else:
+                        session.reply(request_id, 'AUTH_FAIL')
+                        self.log_traffic(f"Failed login attempt: {params['username']}")
+
+                elif command == 'REGISTER':
+                    # The client goes back to the login screen after registering,
+                    # so stay in the authentication phase until a LOGIN succeeds
+                    if await self.run_auth(self.db.create_user, params['username'], params['password']):
+                        session.reply(request_id, 'REG_SUCCESS')
+                        self.log_traffic(f"New user registered: {params['username']}")
+                    else:
+                        session.reply(request_id, 'REG_FAIL')
+                        self.log_traffic(f"Failed registration: {params['username']}")
+
+                elif command == 'RESUME':
+                    # Reconnect with the token from AUTH_SUCCESS instead of the password
+                    if await self.resume_session(session, request_id, params.get('token')):
+                        return session.username
+
+            except HasherBusy:
+                # Too many logins in flight, the client may try again
+                session.reply(request_id, 'AUTH_BUSY')
+                self.log_traffic(f"Authentication busy: {params['username']}")
+            except (ConnectionError, OSError, ProtocolError) as e:
+                self.log_traffic(f"Authentication error: {e}")
                 return None
-                
-            if command == 'LOGIN':
-                if self.db.verify_user(params['username'], params['password']):
-                    client.send('AUTH_SUCCESS'.encode('utf-8'))
-                    self.log_traffic(f"User logged in: {params['username']}")
-                    return params['username']
-                else:
-                    client.send('AUTH_FAIL'.encode('utf-8'))
-                    self.log_traffic(f"Failed login attempt: {params['username']}")
-                    
-            elif command == 'REGISTER':
-                if self.db.create_user(params['username'], params['password']):
-                    client.send('REG_SUCCESS'.encode('utf-8'))
-                    self.log_traffic(f"New user registered: {params['username']}")
-                    return params['username']
-                else:
-                    client.send('REG_FAIL'.encode('utf-8'))
-                    self.log_traffic(f"Failed registration: {params['username']}")
-                    
-        except Exception as e:
-            self.log_traffic(f"Authentication error: {e}")
-            try:
-                client.send('AUTH_ERROR'.encode('utf-8'))
-            except:
-                pass
-            return None
+            except Exception as e:
+                self.log_traffic(f"Authentication error: {e}")
+                try:
+                    session.reply(request_id, 'AUTH_ERROR')
+                except:
+                    return None
 
         return None
-    
-    def generate_random_string(length=8):
-        letters = string.ascii_letters + string.digits
-        return ''.join(random.choice(letters) for i in range(length))
+
+    async def resume_session(self, session, request_id, token):
+        """Restore a dropped session from its token without checking the password.
+
+        Within the grace period the detached session still has the user's
+        chats and the messages pushed since the drop, they are replayed after
+        RESUME_SUCCESS. Otherwise the chats are looked up again and the reply
+        says the replay is incomplete so the client reloads its history.
+        """
+        try:
+            username, session_id = self.tokens.verify(token)
+        except TokenError as e:
+            session.reply(request_id, 'RESUME_FAIL')
+            self.log_traffic(f"Failed resume: {e}")
+            return False
+
+        detached = self.detached.pop(session_id, None)
+        if detached is not None:
+            detached.expiry.cancel()
+            chat_ids = self.subscriptions.chats(detached)
+            self.subscriptions.remove_session(detached)
+            frames = list(detached.frames)
+            complete = not detached.dropped
+        else:
+            chats = await self.run_db(self.db.get_user_chats, username)
+            chat_ids = [chat['_id'] for chat in chats]
+            frames = []
+            complete = False
+            if session.client not in self.clients:
+                return False
+            if session_id in self.tokens.revoked:
+                # Another RESUME with the same token finished first
+                session.reply(request_id, 'RESUME_FAIL')
+                return False
+
+        session.username = username
+        session.session_id = secrets.token_urlsafe(12)
+        self.subscriptions.add_session(session, username, chat_ids)
+        # Each token resumes once, the reply carries the next one. Revoked
+        # only now, a RESUME that gave up above leaves the token usable
+        self.revoke_session(session_id)
+        reply = {
+            'token': self.tokens.issue(username, session.session_id),
+            'replayed': len(frames),
+            'complete': complete
+        }
+        session.reply(request_id, f'RESUME_SUCCESS:{json.dumps(reply)}')
+        for frame in frames:
+            session.send_frame(frame)
+        self.log_traffic(f"User resumed: {username} ({len(frames)} messages replayed)")
+        return True
 
     def start(self):
+        """Run the server event loop, blocks until stop() is called"""
         self.log_traffic("Server started")
-        
-        # Start polling socket acceptor thread
-        poll_thread = threading.Thread(target=self.handle_poll_connections)
-        poll_thread.daemon = True
-        poll_thread.start()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.done.set()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if not self.running:  # stop() was called before the loop came up
+            self.stopped.set()
 
-        # check for clients that were not able to send data quick enough
-        check = []
+        tasks = [
+            self.loop.create_task(self.accept_clients()),
+            self.loop.create_task(self.heartbeat.run()),
+        ]
+        if self.bus:
+            tasks.append(self.loop.create_task(self.run_bus()))
+        if self.metrics_port:
+            tasks.append(self.loop.create_task(serve_prometheus(self.metrics, port=self.metrics_port)))
+        try:
+            await self.stopped.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for session in list(self.clients.values()):
+                self.disconnect_user(session)
+            self.server.close()
+            self.auth_executor.shutdown(wait=True, cancel_futures=True)
+            self.read_executor.shutdown(wait=True, cancel_futures=True)
+            self.db_executor.shutdown(wait=True)
+            self.db.close()  # flushes messages still queued for writing
+            self.log_traffic("Server stopped")
+
+    async def run_bus(self):
+        """Relay traffic with the other workers. A worker that lost the bus
+        misses their messages and revoked tokens, so it stops and the
+        supervisor starts a fresh one"""
+        try:
+            await self.bus.run()
+        except ConnectionError as e:
+            self.log_traffic(f"Message bus error: {e}")
+        if self.running:
+            self.log_traffic("Lost the message bus, stopping")
+            self.stop(wait=False)
 
-        # Accecpt both kinds of sockets in the main loop, first accept a poll socket
+    async def accept_clients(self):
+        """Accept message sockets, each one gets its own coroutine"""
         while self.running:
-            
-            client, address = self.poll_server.accept()
-            if client or address:
-                random_string = self.generate_random_string()
-                client.send(("AUTH: " + random_string).encode('utf-8'))
-                with self.clientAccess:
-                    self.clients[random_string] = {client: None}
-                    self.log_traffic(f"Poll client connected: {address} with bind string: {random_string}")
-
-            client, address = self.server.accept()
-            if client or address:
-                data = client.recv(1024).decode('utf-8')
-                if ':' in data:
-                    command, data = data.split(':', 1)
-                    if command == 'AUTH':
-                        if data in self.clients:
-                            with self.clientAccess:
-                                self.clients[data][self.clients[data]] = client   
-                                self.log_traffic(f"Client, pollSocket and messageSocket bound: {data}")         
-    
-            elif client and not data: # connected to server, but was not able to send data quick enough
-                check.append(client)
-
-            for client in check: # check for clients that were not able to send data quick enough
-                data = self.server.recv(1024).decode('utf-8')
-                if ':' in data:
-                    command, data = data.split(':', 1)
-                    if command == 'AUTH':
-                        if data in self.clients:
-                            with self.clientAccess:
-                                self.clients[data][self.clients[data]] = client
-                                self.log_traffic(f"Client, pollSocket and messageSocket bound: {data}")             
-
-            
-            time.sleep(0.25) # run 4 times a second
-
-
-    def handle_poll_connections(self):
-        """Handle incoming polling connections"""
-        while self.running: #! Might change to True
-            check = []
-            
-            with self.clientAccess:
-                for bindString in self.clients.values():
-                    bindString.send("POLL: KEEP-ALIVE".encode('utf-8'))
-                    bindString.append(bindString)
-
-            time.sleep(1.5)
-
-            with self.clientAccess:
-                for bindString in check:
-                    bindString.setBlocking(False)
-                    data = bindString.recv(1024).decode('utf-8')
-                    if data != "ALIVE":
-                        self.disconnect_user(bindString)
-
-            time.sleep(1.5)
-
-                
-
-    def stop(self):
+            client, address = await self.loop.sock_accept(self.server)
+            self.loop.create_task(self.handle_client(client, address))
+
+    async def handle_client(self, client, address):
+        session = Session(client, address)
+        session.outbound = OutboundQueue(
+            self.loop, client,
+            on_slow=partial(self.slow_consumer, session),
+            on_error=partial(self.send_failed, session),
+            **self.send_limits
+        )
+        self.clients[client] = session
+        self.heartbeat.add(session)
+        task = asyncio.current_task()
+        session.tasks.add(task)
+        writer = self.loop.create_task(session.outbound.run())
+        session.tasks.add(writer)
+        self.log_traffic(f"Client connected: {address}")
+        try:
+            username = await self.authenticate_client(session)
+            if username:
+                session.username = username
+                if session not in self.subscriptions:  # RESUME has already subscribed it
+                    chats = await self.run_db(self.db.get_user_chats, username)
+                    if client in self.clients:  # still connected
+                        self.subscriptions.add_session(session, username,
+                                                       [chat['_id'] for chat in chats])
+                await self.handle(session)
+        except (ConnectionError, OSError, ProtocolError):
+            pass
+        finally:
+            session.tasks.discard(task)
+            self.disconnect_user(session)
+
+    async def send_keep_alive(self, session):
+        session.send(b'', FRAME_PING)
+
+    def slow_consumer(self, session):
+        self.log_traffic(f"Disconnecting slow client: {session.username or session.address} "
+                         f"({session.outbound.size} bytes queued)")
+        self.disconnects.labels('slow_consumer').inc()
+        self.disconnect_user(session)
+
+    def send_failed(self, session, error):
+        self.log_traffic(f"Send error for {session.username or session.address}: {error}")
+        self.disconnects.labels('send_error').inc()
+        self.disconnect_user(session)
+
+    def heartbeat_timeout(self, session):
+        self.log_traffic(f"Client timed out: {session.username or session.address}")
+        self.disconnects.labels('heartbeat_timeout').inc()
+        self.disconnect_user(session)
+
+    def stop(self, wait=True, timeout=None):
+        """Stop the server, safe to call from any thread.
+
+        With wait, returns once start() has disconnected everyone and
+        written out the queued messages. Pass wait=False on the thread
+        running start(), from a signal handler say.
+        """
         self.running = False
-        for username in list(self.client_pairs.keys()):
-            self.disconnect_user(username)
-        self.server.close()
-        self.poll_server.close()
-        self.log_traffic("Server stopped")
+        if self.loop and self.stopped:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            if wait:
+                self.done.wait(timeout)
+        else:
+            self.server.close()
+            self.db.close()
+            self.log_traffic("Server stopped")
+            self.done.set()
 
     def log_traffic(self, message):
         if self.gui_callback:
             self.gui_callback(message)
 
-    def broadcast(self, message, chat_id=None, sender=None):
+    def broadcast(self, message, chat_id=None, sender=None, saved=None):
+        """Push a message to the chat's online members on every worker.
+
+        saved is the stored message from Database.save_message, its id and
+        sequence number go out with the push so clients can SYNC from it.
+        Other workers add it to their history caches.
+        """
         message_data = {
             'chat_id': chat_id,
             'username': sender if sender else "Server",
             'content': message if isinstance(message, str) else message.decode('utf-8')
         }
-        json_message = json.dumps(message_data).encode('utf-8')
-        
-        for client in self.clients:
-            client.send(json_message)
-        
+        if saved:
+            message_data['_id'] = saved['_id']
+            message_data['seq'] = saved['seq']
+        self.deliver(message_data)
+        if self.bus:
+            bus_data = message_data
+            if saved:
+                bus_data = dict(message_data, timestamp=saved['timestamp'].isoformat())
+            self.bus.publish(BUS_MESSAGE, json.dumps(bus_data))
+
+    def deliver(self, message_data):
+        """Push a message to the sessions connected to this process"""
+        start = time.perf_counter()
+        # Encoded once, every recipient's send queue shares the same bytes object
+        frame = encode_frame(json.dumps(message_data), FRAME_PUSH)
+
+        chat_id = message_data['chat_id']
+        if chat_id is None:
+            # Server notices go to everyone connected. Not into the replay
+            # buffers of dropped sessions, they would crowd out chat messages
+            sessions = [session for session in self.subscriptions.by_session
+                        if not isinstance(session, DetachedSession)]
+        else:
+            sessions = list(self.subscriptions.sessions(chat_id))
+        for session in sessions:
+            session.send_frame(frame)
+        self.broadcast_seconds.observe(time.perf_counter() - start)
+        self.broadcast_recipients.observe(len(sessions))
+
         self.log_traffic(f"Broadcast: {message_data['username']} -> {message_data['content']}")
 
-    def handle_chat_creation(self, client, data):
+    def on_bus_message(self, frame_type, payload):
+        """Traffic from the other workers, see bus.py"""
+        data = json.loads(payload)
+        if frame_type == BUS_MESSAGE:
+            if '_id' in data:
+                self.db.message_saved_elsewhere(data)
+            data.pop('timestamp', None)  # for the history cache, pushes go without it
+            self.deliver(data)
+        elif frame_type == BUS_CHAT:
+            self.db.chat_created_elsewhere(data['usernames'])
+            self.subscriptions.add_chat(data['chat_id'], data['usernames'])
+        elif frame_type == BUS_REVOKE:
+            self.tokens.revoke(data)
+            # Resumed on another worker, or logged out: forget it without a
+            # "left the chat", the user is still (or was last) seen elsewhere
+            detached = self.detached.pop(data, None)
+            if detached is not None:
+                detached.expiry.cancel()
+                self.subscriptions.remove_session(detached)
+
+    def revoke_session(self, session_id):
+        """Stop session_id's token from resuming it here or on any other worker"""
+        self.tokens.revoke(session_id)
+        if self.bus:
+            self.bus.publish(BUS_REVOKE, json.dumps(session_id))
+
+    async def handle_chat_creation(self, session, request_id, data):
         try:
             data = json.loads(data)
-            chat_id = self.db.create_chat(
+            chat_id = await self.run_db(
+                self.db.create_chat,
                 data['creator'],
                 data['target'],
                 data['is_group']
             )
-            client.send(f'CHAT_CREATED:{chat_id}'.encode('utf-8'))
+            self.subscriptions.add_chat(chat_id, (data['creator'], data['target']))
+            if self.bus:
+                self.bus.publish(BUS_CHAT, json.dumps({'chat_id': chat_id,
+                                                       'usernames': [data['creator'], data['target']]}))
+            session.reply(request_id, f'CHAT_CREATED:{chat_id}')
             self.log_traffic(f"Chat created: {data['creator']} with {data['target']}")
         except Exception as e:
-            client.send('CHAT_ERROR'.encode('utf-8'))
+            session.reply(request_id, 'CHAT_ERROR')
             self.log_traffic(f"Chat creation error: {e}")
 
-    def handle_get_chats(self, client, username):
+    async def handle_get_chats(self, session, request_id, username):
         try:
-            chats = self.db.get_user_chats(username)
-            client.send(json.dumps(chats).encode('utf-8'))
+            # Cached lists are sent straight from the event loop
+            chats = self.db.peek_user_chats_json(username)
+            if chats is None:
+                chats = await self.run_read(self.db.get_user_chats_json, username)
+            session.reply(request_id, chats)
             self.log_traffic(f"Sent chat list to: {username}")
         except Exception as e:
             self.log_traffic(f"Error getting chats: {e}")
 
-    def handle_get_messages(self, client, chat_id):
+    async def handle_get_messages(self, session, request_id, data):
+        """GET_MESSAGES:<chat_id> sends the latest messages as a list.
+
+        GET_MESSAGES:{"chat_id": ..., "before": cursor, "after": cursor, "limit": n}
+        sends one page of history instead, see Database.get_chat_messages_page.
+        """
         try:
-            messages = self.db.get_chat_messages(chat_id)
-            client.send(json.dumps(messages).encode('utf-8'))
+            if data.startswith('{'):
+                params = json.loads(data)
+                chat_id = params['chat_id']
+                reply = await self.run_read(self.db.get_chat_messages_page, chat_id,
+                                          params.get('limit', 50), params.get('before'),
+                                          params.get('after'))
+            else:
+                chat_id = data
+                reply = await self.run_read(self.db.get_chat_messages, chat_id)
+            session.reply(request_id, json.dumps(reply, default=str))
             self.log_traffic(f"Sent message history for chat: {chat_id}")
         except Exception as e:
             self.log_traffic(f"Error getting messages: {e}")
 
-    def handle(self, client):
-        while True:
+    async def handle_message(self, msg_data):
+        saved = await self.run_db(
+            self.db.save_message,
+            msg_data['username'],
+            msg_data['content'],
+            msg_data['chat_id']
+        )
+        self.broadcast(msg_data['content'],
+                       msg_data['chat_id'],
+                       msg_data['username'],
+                       saved)
+
+    async def handle_stats(self, session, request_id):
+        if session.username not in self.stats_users:
+            session.reply(request_id, 'STATS_DENIED')
+            self.log_traffic(f"STATS denied to: {session.username}")
+            return
+        session.reply(request_id, f'STATS:{json.dumps(self.metrics.snapshot())}')
+
+    async def handle_logout(self, session):
+        """LOGOUT:{} ends the session for good, its token can't RESUME it"""
+        username = session.username
+        self.revoke_session(session.session_id)
+        # Let messages sent before the LOGOUT be saved and pushed first
+        if session.writes:
+            await asyncio.wait(list(session.writes.values()))
+        session.username = None  # nothing to keep for RESUME, see disconnect_user
+        self.disconnect_user(session)
+        self.broadcast(f"{username} left the chat!")
+        self.log_traffic(f"User logged out: {username}")
+
+    def dispatch(self, session, request_id, command, data):
+        """(handler, ordering key, is a write) for a command, handler is None
+        if it is unknown.
+
+        Commands on the same chat share an ordering key, as do the ones on
+        the chat list. Reads of a chat or of the chat list wait for the
+        session's writes to it, the rest have no key.
+        """
+        if command == 'MESSAGE':
+            msg_data = json.loads(data)
+            return partial(self.handle_message, msg_data), ('chat', msg_data['chat_id']), True
+        if command == 'CREATE_CHAT':
+            return partial(self.handle_chat_creation, session, request_id, data), ('chats',), True
+        if command == 'GET_CHATS':
+            return partial(self.handle_get_chats, session, request_id, data), ('chats',), False
+        if command == 'GET_MESSAGES':
+            return partial(self.handle_get_messages, session, request_id, data), self.chat_key(data), False
+        if command == 'SYNC':
+            return partial(self.handle_sync, session, request_id, data), self.chat_key(data), False
+        if command == 'STATS':
+            return partial(self.handle_stats, session, request_id), None, False
+        if command == 'LOGOUT':
+            return partial(self.handle_logout, session), None, False
+        return None, None, False
+
+    @staticmethod
+    def chat_key(data):
+        """Ordering key of a GET_MESSAGES / SYNC, None if the chat can't be
+        made out (the handler reports that)"""
+        try:
+            chat_id = json.loads(data)['chat_id'] if data.startswith('{') else data
+        except (ValueError, KeyError, TypeError):
+            return None
+        return ('chat', chat_id)
+
+    def pipeline(self, session, command, handler, key, write):
+        """Run a command alongside the session's others, returns its task.
+
+        A command first waits for the session's previous write with the same
+        key, so messages into a chat are saved and pushed in the order they
+        were sent and a read sees the session's own writes. Reads don't wait
+        for each other.
+        """
+        previous = session.writes.get(key) if key else None
+        task = self.loop.create_task(self.run_command(session, command, handler, previous))
+        session.tasks.add(task)
+        if not write:
+            key = None
+        if key:
+            session.writes[key] = task
+        task.add_done_callback(partial(self.command_done, session, key))
+        self.commands_in_flight.inc()
+        return task
+
+    async def run_command(self, session, command, handler, previous):
+        try:
+            if previous is not None:
+                await asyncio.wait((previous,))
+            start = time.perf_counter()
+            await handler()
+            self.command_seconds.labels(command).observe(time.perf_counter() - start)
+        except Exception as e:
+            self.log_traffic(f"Command error for {session.username}: {e}")
+            self.drop_session(session)
+        finally:
+            session.pipeline.release()
+
+    def command_done(self, session, key, task):
+        session.tasks.discard(task)
+        if key and session.writes.get(key) is task:
+            del session.writes[key]
+        self.commands_in_flight.dec()
+
+    def drop_session(self, session):
+        """Disconnect a logged in session and tell the other users if it can't
+        be resumed, otherwise expire_detached tells them once the grace is over"""
+        if session.client in self.clients:
+            username = session.username
+            self.disconnect_user(session)
+            if session.session_id not in self.detached:
+                self.broadcast(f"{username} left the chat!")
+            self.log_traffic(f"Client disconnected: {username}")
+
+    async def handle_sync(self, session, request_id, data):
+        """SYNC:{"chat_id": ..., "since": seq, "limit": n} sends the messages
+        newer than the client's last seen sequence number, see Database.sync_messages"""
+        try:
+            params = json.loads(data)
+            reply = await self.run_read(self.db.sync_messages, params['chat_id'],
+                                        params.get('since'), params.get('limit', 50))
+            session.reply(request_id, json.dumps(reply, default=str))
+            self.log_traffic(f"Synced chat {params['chat_id']}: {len(reply['messages'])} messages")
+        except Exception as e:
+            self.log_traffic(f"Error syncing messages: {e}")
+
+    async def handle(self, session):
+        """Read the session's commands until it disconnects.
+
+        Tagged commands (and MESSAGE, which has no reply) are pipelined: up to
+        PIPELINE_DEPTH of them run at once and replies go out as each one
+        finishes, the client matches them up by request id. An untagged
+        command with a reply can only be matched up by its order, so the next
+        command is not read until it is done.
+        """
+        session.pipeline = asyncio.Semaphore(PIPELINE_DEPTH)
+        while self.running:
             try:
-                message = client.recv(1024).decode('utf-8')
+                # Stop reading commands while the client is not reading our replies
+                await session.outbound.wait_writable()
+                request_id, message = await self.recv(session)
                 if not message:
                     raise Exception("Client disconnected")
 
                 if ':' in message:
                     command, data = message.split(':', 1)
-                    if command == 'CREATE_CHAT':
-                        self.handle_chat_creation(client, data)
-                    elif command == 'GET_CHATS':
-                        self.handle_get_chats(client, data)
-                    elif command == 'GET_MESSAGES':
-                        self.handle_get_messages(client, data)
-                    elif command == 'MESSAGE':
-                        msg_data = json.loads(data)
-                        self.db.save_message(
-                            msg_data['username'],
-                            msg_data['content'],
-                            msg_data['chat_id']
-                        )
-                        self.broadcast(msg_data['content'], 
-                                     msg_data['chat_id'], 
-                                     msg_data['username'])
+                    handler, key, write = self.dispatch(session, request_id, command, data)
+                    if handler:
+                        # A full pipeline stops reading until a command finishes
+                        await session.pipeline.acquire()
+                        task = self.pipeline(session, command, handler, key, write)
+                        if request_id is None and command != 'MESSAGE':
+                            await asyncio.wait((task,))
                 self.log_traffic(f"Handled message: {message[:50]}...")
             except Exception as e:
-                if client in self.clients:
-                    username = self.clients[client]
-                    del self.clients[client]
-                    client.close()
-                    self.broadcast(f"{username} left the chat!")
-                    self.log_traffic(f"Client disconnected: {username}")
+                self.drop_session(session)
                 break
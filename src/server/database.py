@@ -1,42 +1,154 @@
-from pymongo import MongoClient
-from bson import ObjectId
-import bcrypt
+import threading
+import time
 from datetime import datetime
+from functools import partial, wraps
+from writebehind import WriteBehindQueue, OVERFLOW_BLOCK
+from cache import ChatListCache, HistoryCache
+from passwords import PasswordHasher, WORK_FACTOR, MAX_PENDING, is_hashed
+from storage import StorageEngine, open_storage
+from msglog import MessageLog, open_message_store
+from metrics import Registry
+
+MAX_PAGE_SIZE = 200
+USERS_PAGE_SIZE = 1000
+
+
+def encode_cursor(message):
+    """Opaque history cursor pointing at a message: its timestamp and id"""
+    return f"{message['timestamp'].isoformat()}|{message['_id']}"
+
+
+def decode_cursor(cursor):
+    timestamp, message_id = cursor.split('|', 1)
+    return datetime.fromisoformat(timestamp), message_id
+
+
+def encode_user_cursor(user):
+    return f"{user['created_at'].isoformat()}|{user['username']}"
+
+
+def decode_user_cursor(cursor):
+    created_at, username = cursor.split('|', 1)
+    return datetime.fromisoformat(created_at), username
+
+
+def timed(method):
+    """Record the method's duration, and its errors, in the database metrics"""
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            self.call_errors.labels(name).inc()
+            raise
+        finally:
+            self.call_seconds.labels(name).observe(time.perf_counter() - start)
+    return wrapper
+
+
+def now():
+    # MongoDB keeps millisecond precision, truncate so cursors built from
+    # messages we still hold in memory match what is stored
+    timestamp = datetime.now()
+    return timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
 
 class Database:
-    def __init__(self):
-        self.client = MongoClient('mongodb://localhost:27017/')
-        self.db = self.client['chat_app']
-        self.users = self.db['users']
-        self.messages = self.db['messages']
-        self.chats = self.db['chats']
-        
-        # Create indexes
-        self.users.create_index('username', unique=True)
-        self.messages.create_index('chat_id')
-        self.chats.create_index('participants')
+    def __init__(self, batch_size=100, flush_interval=0.05, max_pending=10000,
+                 overflow=OVERFLOW_BLOCK, history_size=200, history_cache_bytes=64 * 1024 * 1024,
+                 work_factor=WORK_FACTOR, hash_workers=None, hash_max_pending=MAX_PENDING,
+                 storage=None, message_store=None):
+        # A StorageEngine, or the name of one ('mongodb', 'sqlite'), by
+        # default $CHAT_STORAGE or MongoDB on localhost, see storage.py
+        self.storage = storage if isinstance(storage, StorageEngine) else open_storage(storage)
+        # Chat messages go to the storage engine too, or to an append-only
+        # MessageLog ('log', or $CHAT_MESSAGE_STORE=log), see msglog.py
+        self.messages = (message_store if isinstance(message_store, MessageLog)
+                         else open_message_store(message_store, self.storage))
+
+        # Chat messages are written behind the request path in batches, see
+        # writebehind.py for the batch_size / flush_interval / overflow options
+        self.message_writer = WriteBehindQueue(
+            self.messages.insert_messages,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            max_pending=max_pending,
+            overflow=overflow,
+            name='message-writer'
+        )
+        # Recent history per chat, so opening a busy chat rarely touches storage
+        self.history_cache = HistoryCache(history_size, history_cache_bytes)
+        # Held while a message is numbered and queued, see save_message
+        self.sequence_lock = threading.Lock()
+        # Chat list per user, GET_CHATS is sent on every client screen refresh
+        self.chat_list_cache = ChatListCache()
+        # bcrypt runs in worker processes, see passwords.py. Both methods below
+        # block until their hash is done and raise HasherBusy when the queue is full
+        self.hasher = PasswordHasher(work_factor, hash_workers, hash_max_pending)
+
+        self.metrics = Registry()
+        self.call_seconds = self.metrics.histogram(
+            'chat_db_call_seconds', "Database method latency", ['call'])
+        self.call_errors = self.metrics.counter(
+            'chat_db_call_errors_total', "Database methods that raised", ['call'])
+        self.cache_lookups = self.metrics.counter(
+            'chat_db_cache_lookups_total', "History and chat list cache lookups", ['cache', 'result'])
+        self.metrics.gauge('chat_db_write_queue_depth', "Messages waiting to be written",
+                           func=self.message_writer.pending)
+        self.metrics.counter('chat_db_write_dropped_total', "Messages dropped by a full write queue",
+                             func=lambda: self.message_writer.dropped)
+        self.metrics.gauge('chat_db_password_hashes_pending', "Password hashes queued or running",
+                           func=lambda: self.hasher.in_flight)
 
+    @timed
     def create_user(self, username, password):
-        try:
-            user = {
-                'username': username,
-                'password': password,
-                'created_at': datetime.now()
-            }
-            self.users.insert_one(user)
-            return True
-        except:
+        # Don't spend a hash on a name that is already taken
+        if self.user_exists(username):
             return False
+        hashed = self.hasher.hash(password).result()
+        user = {
+            'username': username,
+            'password': hashed,
+            'created_at': datetime.now()
+        }
+        return self.storage.insert_user(user)
 
+    @timed
     def verify_user(self, username, password):
-        user = self.users.find_one({'username': username})
-        if user and user['password'] == password:
-            return True
-        return False
+        user = self.storage.find_user(username)
+        if not user:
+            return False
+        stored = user['password']
+        if is_hashed(stored):
+            return self.hasher.check(password, stored).result()
 
+        # Accounts created before passwords were hashed, upgrade on first login
+        if stored != password:
+            return False
+        hashed = self.hasher.hash(password).result()
+        self.storage.update_password(username, stored, hashed)
+        return True
+
+    @timed
     def get_all_users(self):
-        return list(self.users.find({}, {'username': 1, 'created_at': 1}))
+        return self.storage.all_users()
+
+    @timed
+    def get_users_page(self, limit=USERS_PAGE_SIZE, after=None):
+        """One page of users, oldest first.
 
+        after is the 'after' cursor of the previous page. A page shorter than
+        limit is the last one for now, its cursor picks up users created later.
+        """
+        users = self.storage.users_page(limit, decode_user_cursor(after) if after else None)
+        return {
+            'users': users,
+            'after': encode_user_cursor(users[-1]) if users else after
+        }
+
+    @timed
     def create_chat(self, creator, participant, is_group=False, chat_name=None):
         chat = {
             'participants': [creator, participant],
@@ -45,44 +157,168 @@ class Database:
             'created_at': datetime.now(),
             'created_by': creator
         }
-        result = self.chats.insert_one(chat)
-        return str(result.inserted_id)
+        chat_id = self.storage.insert_chat(chat)
+        self.chat_list_cache.invalidate(chat['participants'])
+        return chat_id
 
+    @timed
     def get_user_chats(self, username):
-        chats = list(self.chats.find({'participants': username}))
-        # Convert ObjectId to string for JSON serialization
-        for chat in chats:
-            chat['_id'] = str(chat['_id'])
-        return chats
+        return self._user_chats(username)[0]
+
+    @timed
+    def get_user_chats_json(self, username):
+        """The user's chat list already serialized to JSON bytes"""
+        return self._user_chats(username)[1]
+
+    def peek_user_chats_json(self, username):
+        """The cached JSON chat list, or None. Never touches storage"""
+        entry = self.chat_list_cache.get(username)
+        return entry[1] if entry else None
 
+    def _user_chats(self, username):
+        entry = self.chat_list_cache.get(username)
+        if entry:
+            self.cache_lookups.labels('chat_list', 'hit').inc()
+            return entry
+        self.cache_lookups.labels('chat_list', 'miss').inc()
+
+        token = self.chat_list_cache.load_token()
+        chats = self.storage.user_chats(username)
+        return self.chat_list_cache.put(username, chats, token)
+
+    @timed
     def get_chat_messages(self, chat_id, limit=50):
-        messages = self.messages.find({'chat_id': chat_id}).sort('timestamp', -1).limit(limit)
-        messages_list = list(messages)
-        # Convert ObjectId to string for JSON serialization
-        for message in messages_list:
-            message['_id'] = str(message['_id'])
-        return list(reversed(messages_list))
+        messages = self.history_cache.get(chat_id, limit)
+        if messages is not None:
+            self.cache_lookups.labels('history', 'hit').inc()
+            return messages
+        self.cache_lookups.labels('history', 'miss').inc()
 
-    def save_message(self, username, content, chat_id):
-        message = {
+        self.history_cache.begin_load(chat_id)
+        try:
+            page = self.get_chat_messages_page(chat_id, self.history_cache.ring_size)
+        except Exception:
+            self.history_cache.discard(chat_id)
+            raise
+        cached = self.history_cache.finish_load(chat_id, page['messages'], complete=page['before'] is None)
+        return (cached if cached is not None else page['messages'])[-limit:]
+
+    @timed
+    def get_chat_messages_page(self, chat_id, limit=50, before=None, after=None):
+        """One page of chat history, oldest message first.
+
+        With no cursor this is the newest page. Pass the page's 'before' cursor to
+        get the page of older messages, or 'after' to get newer ones. A cursor is
+        None when there is nothing further in that direction.
+        """
+        # Make sure messages still waiting in the write-behind queue are readable
+        self.message_writer.flush()
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        # Fetch one extra message to know whether there is another page
+        messages_list = self.messages.message_page(
+            chat_id, limit + 1,
+            before=decode_cursor(before) if before and not after else None,
+            after=decode_cursor(after) if after else None
+        )
+        more = len(messages_list) > limit
+        messages_list = messages_list[:limit]
+        if not after:
+            messages_list.reverse()
+
+        page = {
             'chat_id': chat_id,
-            'username': username,
-            'content': content,
-            'timestamp': datetime.now()
+            'messages': messages_list,
+            'before': None,
+            'after': None
         }
-        self.messages.insert_one(message)
+        if messages_list:
+            if more or after:
+                page['before'] = encode_cursor(messages_list[0])
+            page['after'] = encode_cursor(messages_list[-1])
+        elif after:
+            page['after'] = after
+        return page
 
+    @timed
+    def sync_messages(self, chat_id, since=None, limit=50):
+        """The messages of a chat with a sequence number above since, oldest first.
 
+        Returns {'chat_id', 'messages', 'seq', 'reset'} where seq is the newest
+        sequence number, the since of the next call. reset means the caller's
+        copy can't be brought up to date (since is None, more than limit
+        messages are newer, or the history is gone or was started over,
+        as after delete_all_users): messages is then the
+        newest limit, to replace the copy with. Served from the history cache
+        when the chat is in it.
+        """
+        limit = max(1, min(limit, self.history_cache.ring_size - 1))
+        # One more than asked for, to tell "limit newer messages" from a gap
+        messages = self.get_chat_messages(chat_id, limit + 1)
+        # The largest rather than the newest's, older stores may hold them out of order
+        newest = max((message.get('seq', 0) for message in messages), default=0)
+        if (since is None or not messages or newest < since or
+                not any(message.get('seq', 0) <= since for message in messages)):
+            newer, reset = messages[-limit:], True
+        else:
+            newer, reset = [message for message in messages if message.get('seq', 0) > since], False
+        return {
+            'chat_id': chat_id,
+            'messages': newer,
+            'seq': newest,
+            'reset': reset
+        }
+
+    @timed
+    def save_message(self, username, content, chat_id):
+        # Sequence numbers go up by one per message in each chat, clients
+        # SYNC from the last one they have seen. The storage hands them out,
+        # so server workers sharing it never give out the same one. The id,
+        # timestamp and number are given out under one lock, and the message
+        # is cached and queued for writing under it, so this worker's
+        # (timestamp, _id) order is its sequence order
+        with self.sequence_lock:
+            # Messages saved before there were sequence numbers count as 0
+            seq = self.storage.next_sequence(chat_id, partial(self.messages.last_sequence, chat_id))
+            message = {
+                '_id': self.messages.new_id(),  # assigned up front so the message has a cursor right away
+                'chat_id': chat_id,
+                'username': username,
+                'content': content,
+                'timestamp': now(),
+                'seq': seq
+            }
+            self.history_cache.append(chat_id, message)
+            self.message_writer.put(message)
+        return message
+
+    def message_saved_elsewhere(self, message):
+        """Another server worker saved message, keep our history cache current"""
+        message = dict(message, timestamp=datetime.fromisoformat(message['timestamp']))
+        self.history_cache.saved_elsewhere(message['chat_id'], message)
+
+    def chat_created_elsewhere(self, usernames):
+        """Another server worker created a chat for these users"""
+        self.chat_list_cache.invalidate(usernames)
+
+    def close(self):
+        """Write out any queued messages and close the connection"""
+        self.message_writer.close()
+        self.hasher.close()
+        if self.messages is not self.storage:
+            self.messages.close()
+        self.storage.close()
+
+
+    @timed
     def user_exists(self, username):
-        return self.users.find_one({'username': username}) is not None
-    
-    def get_all_users(self):
-        # Modified to include password field
-        return list(self.users.find())
+        return self.storage.find_user(username) is not None
 
+    @timed
     def delete_all_users(self):
-        # Delete all users from the database
-        self.users.delete_many({})
-        # Optionally, also delete related data
-        self.chats.delete_many({})
-        self.messages.delete_many({})
\ No newline at end of file
+        # Delete all users along with their chats and messages
+        self.storage.delete_all()
+        if self.messages is not self.storage:
+            self.messages.delete_all()
+        self.history_cache.discard()
+        self.chat_list_cache.invalidate()
\ No newline at end of file
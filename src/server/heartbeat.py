@@ -0,0 +1,126 @@
+import asyncio
+import math
+import time
+
+
+class TimerWheel:
+    """Hashed timer wheel.
+
+    Timers go into one of a fixed number of slots by their deadline, so adding
+    or cancelling one is O(1) and each tick only looks at the timers in the
+    slot that just came due. Timers further out than one revolution stay in
+    their slot until the wheel comes round to their deadline.
+    """
+    def __init__(self, tick=0.5, slots=64):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]  # {key: deadline tick}
+        self.where = {}  # {key: slot index}
+        self.current = 0  # ticks elapsed
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, delay):
+        """Fire key after delay seconds, replacing any timer it already had"""
+        self.cancel(key)
+        deadline = self.current + max(1, math.ceil(delay / self.tick))
+        index = deadline % len(self.slots)
+        self.slots[index][key] = deadline
+        self.where[key] = index
+
+    def cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self):
+        """Move the wheel on one tick and return the keys that came due"""
+        self.current += 1
+        slot = self.slots[self.current % len(self.slots)]
+        expired = [key for key, deadline in slot.items() if deadline <= self.current]
+        for key in expired:
+            del slot[key]
+            del self.where[key]
+        return expired
+
+
+class HeartbeatManager:
+    """Tracks when each session was last heard from and pings only idle ones.
+
+    Any inbound traffic counts as a heartbeat, touch() just records the time so
+    it costs nothing on the hot path. The wheel only wakes a session once it
+    may have gone idle: if it was heard from since, it is rescheduled, if it
+    has been quiet for ping_after seconds it is pinged, and after dead_after
+    seconds of silence on_dead is called. Each session costs O(1) per
+    ping_after period whatever the number of connections.
+
+    A paused session is never pinged or timed out: the server is busy on its
+    behalf (hashing a password, running a command) and not reading from it,
+    so its silence says nothing about the client.
+    """
+    def __init__(self, ping, on_dead, ping_after=3.0, dead_after=4.5, tick=0.5):
+        self.ping = ping          # coroutine function(session)
+        self.on_dead = on_dead    # function(session)
+        self.ping_after = ping_after
+        self.dead_after = dead_after
+        self.wheel = TimerWheel(tick, slots=max(8, math.ceil(dead_after / tick) * 2))
+        self.last_seen = {}  # {session: monotonic time}
+        self.pinged = set()
+        self.paused = set()
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    def add(self, session):
+        self.last_seen[session] = time.monotonic()
+        self.wheel.schedule(session, self.ping_after)
+
+    def remove(self, session):
+        self.last_seen.pop(session, None)
+        self.pinged.discard(session)
+        self.paused.discard(session)
+        self.wheel.cancel(session)
+
+    def pause(self, session):
+        """Stop timing the session out until resume()"""
+        if session in self.last_seen:
+            self.paused.add(session)
+
+    def resume(self, session):
+        """Time the session out again, idle from now"""
+        self.paused.discard(session)
+        self.touch(session)
+
+    def touch(self, session):
+        if session in self.last_seen:
+            self.last_seen[session] = time.monotonic()
+            self.pinged.discard(session)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.wheel.tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            self.check(self.wheel.advance())
+
+    def check(self, sessions):
+        now = time.monotonic()
+        for session in sessions:
+            last_seen = self.last_seen.get(session)
+            if last_seen is None:
+                continue
+            if session in self.paused:
+                self.wheel.schedule(session, self.ping_after)
+                continue
+            idle = now - last_seen
+            if idle >= self.dead_after:
+                self.remove(session)
+                self.on_dead(session)
+            elif idle >= self.ping_after:
+                if session not in self.pinged:
+                    self.pinged.add(session)
+                    asyncio.ensure_future(self.ping(session))
+                self.wheel.schedule(session, self.dead_after - idle)
+            else:
+                self.wheel.schedule(session, self.ping_after - idle)
@@ -0,0 +1,258 @@
+"""Counters, gauges and fixed-bucket histograms for the server.
+
+Updating a metric is a lock and an addition, cheap enough for every command
+and database call. Metrics live in a Registry which renders them as a dict for
+the STATS command and the GUI, or as Prometheus text for serve_prometheus.
+
+    requests = registry.counter('chat_requests_total', "Requests handled", ['command'])
+    requests.labels('LOGIN').inc()
+"""
+import asyncio
+import bisect
+import math
+import threading
+import time
+
+# Seconds, for request and database latencies
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Counts, for fan-out sizes
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def _quantile(buckets, counts, count, q):
+    """Estimate of the q quantile, interpolated inside its bucket"""
+    if not count:
+        return 0.0
+    rank = q * count
+    seen = 0
+    for i, n in enumerate(counts):
+        if n and seen + n >= rank:
+            if i == len(buckets):
+                return buckets[-1]  # in the +Inf bucket, the best we can say
+            low = buckets[i - 1] if i else 0.0
+            return low + (buckets[i] - low) * (rank - seen) / n
+        seen += n
+    return buckets[-1]
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class _Value:
+    """One counter or gauge value"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class _Histogram:
+    """Observation counts per bucket, plus their sum"""
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the seconds spent in its block"""
+        return _Timer(self)
+
+    def get(self):
+        with self.lock:
+            return list(self.counts), self.count, self.sum
+
+    def quantile(self, q):
+        counts, count, _ = self.get()
+        return _quantile(self.buckets, counts, count, q)
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    """A named metric, optionally split by labels.
+
+    Without labels the metric updates directly (inc, set, observe, time),
+    with labels labels(*values) returns the child for those values.
+    """
+    def __init__(self, kind, name, help, labelnames=(), buckets=None, func=None):
+        self.kind = kind  # 'counter', 'gauge' or 'histogram'
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.func = func  # read when the metric is collected, instead of updates
+        self.children = {}  # {label values: _Value / _Histogram}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.child = self.labels()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = _Histogram(self.buckets) if self.kind == 'histogram' else _Value()
+                    self.children[values] = child
+        return child
+
+    def inc(self, amount=1):
+        self.child.inc(amount)
+
+    def dec(self, amount=1):
+        self.child.dec(amount)
+
+    def set(self, value):
+        self.child.set(value)
+
+    def observe(self, value):
+        self.child.observe(value)
+
+    def time(self):
+        return self.child.time()
+
+    def samples(self):
+        """[(label dict, value)] where a histogram's value is (counts, count, sum)"""
+        if self.func is not None:
+            try:
+                return [({}, self.func())]
+            except Exception:
+                return []  # what it reads from has gone away
+        return [(dict(zip(self.labelnames, values)), child.get())
+                for values, child in list(self.children.items())]
+
+
+class Registry:
+    """The metrics of one component, other registries can be included"""
+    def __init__(self):
+        self.metrics = {}
+        self.included = []
+
+    def _add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=(), func=None):
+        """A counter, or one read from func() when it is collected"""
+        return self._add(Metric('counter', name, help, labelnames, func=func))
+
+    def gauge(self, name, help, labelnames=(), func=None):
+        """A gauge set by the caller, or read from func() when it is collected"""
+        return self._add(Metric('gauge', name, help, labelnames, func=func))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Metric('histogram', name, help, labelnames, buckets=buckets))
+
+    def include(self, registry):
+        self.included.append(registry)
+
+    def collect(self):
+        yield from self.metrics.values()
+        for registry in self.included:
+            yield from registry.collect()
+
+    def snapshot(self):
+        """Every metric as plain data, for STATS and the GUI.
+
+        Histograms are summarised by count, sum and p50 / p95 / p99 estimates.
+        """
+        result = {}
+        for metric in self.collect():
+            values = []
+            for labels, value in metric.samples():
+                if metric.kind == 'histogram':
+                    counts, count, total = value
+                    value = {'count': count, 'sum': total}
+                    for q in (0.5, 0.95, 0.99):
+                        value[f'p{round(q * 100)}'] = _quantile(metric.buckets, counts, count, q)
+                values.append({'labels': labels, 'value': value})
+            result[metric.name] = {'type': metric.kind, 'help': metric.help, 'values': values}
+        return result
+
+    def prometheus(self):
+        """The Prometheus text exposition format, version 0.0.4"""
+        lines = []
+        for metric in self.collect():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for labels, value in metric.samples():
+                if metric.kind != 'histogram':
+                    lines.append(f'{metric.name}{_labels(labels)} {_number(value)}')
+                    continue
+                counts, count, total = value
+                cumulative = 0
+                for bound, n in zip(metric.buckets + (math.inf,), counts):
+                    cumulative += n
+                    le = '+Inf' if bound == math.inf else _number(bound)
+                    lines.append(f'{metric.name}_bucket{_labels(dict(labels, le=le))} {cumulative}')
+                lines.append(f'{metric.name}_sum{_labels(labels)} {_number(total)}')
+                lines.append(f'{metric.name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+async def serve_prometheus(registry, host='127.0.0.1', port=9155):
+    """Answer every HTTP request on host:port with the registry in Prometheus
+    text format, runs until cancelled"""
+    async def handle(reader, writer):
+        try:
+            # Read the request line and headers, whatever they ask for
+            while (await reader.readline()).strip():
+                pass
+            body = registry.prometheus().encode('utf-8')
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
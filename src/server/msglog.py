@@ -0,0 +1,469 @@
+import bisect
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import threading
+import zlib
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from storage import new_object_id
+
+MESSAGE_STORE_ENV = 'CHAT_MESSAGE_STORE'  # 'log' keeps messages in a MessageLog
+MESSAGE_LOG_ENV = 'CHAT_MESSAGE_LOG'      # directory of the message log
+MESSAGE_LOG_PATH = 'messages'
+
+# A record is [JSON length][crc32 of the rest][key][JSON of username, content, seq]
+# where the key is the timestamp in microseconds and the 12 byte message id,
+# the record's sort key
+RECORD_HEADER = struct.Struct('!II')
+RECORD_KEY = struct.Struct('!q12s')
+# A sparse index entry: record number in the segment, byte offset and key
+INDEX_ENTRY = struct.Struct('!IIq12s')
+
+SEGMENT_SIZE = 16 * 1024 * 1024  # bytes before a chat's log rolls to a new segment
+INDEX_INTERVAL = 64              # records between sparse index entries
+MAX_OPEN_CHATS = 256             # chats with open files and mappings
+RECENT_IDS = 1024                # ids remembered per chat to skip retried writes
+SEQUENCE_SCAN = 256              # newest records looked at for a chat's last sequence number
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+SAFE_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class LogError(Exception):
+    """Raised when the message log can't be opened"""
+
+
+def _key(timestamp, message_id):
+    """Sort key of a message: (microseconds, id bytes)"""
+    return (timestamp - EPOCH) // MICROSECOND, bytes.fromhex(message_id)
+
+
+def open_message_store(kind, storage):
+    """Where Database keeps messages: a MessageLog when kind (by default
+    $CHAT_MESSAGE_STORE) is 'log', otherwise the storage engine itself"""
+    kind = kind or os.environ.get(MESSAGE_STORE_ENV, 'storage')
+    if kind == 'log':
+        return MessageLog()
+    if kind == 'storage':
+        return storage
+    raise ValueError(f"Unknown message store: {kind}")
+
+
+class _Segment:
+    """One file of a chat's log, named after the number of its first record"""
+    def __init__(self, directory, base):
+        self.base = base
+        self.path = os.path.join(directory, f'{base:020d}.log')
+        self.index_path = os.path.join(directory, f'{base:020d}.idx')
+        self.size = 0    # bytes of valid records
+        self.count = 0   # records
+        self.map = None
+        self.mapped = 0
+
+    def view(self):
+        """Read-only mapping of the valid part of the file"""
+        if self.map is None or self.mapped < self.size:
+            self.unmap()
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            self.mapped = self.size
+        return self.map
+
+    def unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.mapped = 0
+
+    def read_index(self):
+        """Index entries as (key, record number, offset), a torn last entry is dropped"""
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        return [((micros, message_id), self.base + record, offset)
+                for record, offset, micros, message_id in INDEX_ENTRY.iter_unpack(data[:usable])]
+
+
+class _ChatLog:
+    """The segments and sparse index of one chat, opened lazily by MessageLog"""
+    def __init__(self, directory, segment_size, index_interval, fsync):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.closed = False
+        self.recent = deque()     # ids of the last RECENT_IDS records, oldest first
+        self.recent_ids = set()
+        self.last_key = None
+        self.data_fd = self.index_fd = None  # opened by _open() on the first append
+
+        if not os.path.isdir(directory):
+            # Nothing saved to this chat yet, its directory waits for the first append
+            self.segments = [_Segment(directory, 0)]
+            self.keys, self.records, self.offsets = [], [], []
+            return
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log'))
+        self.segments = [_Segment(directory, base) for base in bases] or [_Segment(directory, 0)]
+        # Flattened sparse index over every segment, kept sorted by key
+        self.keys, self.records, self.offsets = [], [], []  # offsets are (segment number, byte offset)
+        for i, segment in enumerate(self.segments):
+            entries = segment.read_index()
+            segment.size = os.path.getsize(segment.path) if os.path.exists(segment.path) else 0
+            if i + 1 < len(self.segments):
+                segment.count = self.segments[i + 1].base - segment.base
+                self._add_entries(i, entries)
+            else:
+                self._recover(i, entries)
+        self._open()
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        last = self.segments[-1]
+        self.data_fd = os.open(last.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.index_fd = os.open(last.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _add_entries(self, position, entries):
+        for key, record, offset in entries:
+            self.keys.append(key)
+            self.records.append(record)
+            self.offsets.append((position, offset))
+
+    def _remember(self, message_id):
+        self.recent.append(message_id)
+        self.recent_ids.add(message_id)
+        if len(self.recent) > RECENT_IDS:
+            self.recent_ids.discard(self.recent.popleft())
+
+    def _recover(self, position, entries):
+        """Check the records after the last index entry of the active segment.
+
+        A crash can leave a torn record at the end of the file, or records
+        whose index entries were never written. The file is cut back to the
+        last record whose length and crc check out and the missing index
+        entries are rebuilt.
+        """
+        segment = self.segments[position]
+        entries = [entry for entry in entries if entry[2] < segment.size]
+        while entries and self._check(segment, entries[-1][2]) is None:
+            entries.pop()  # the indexed record itself is torn
+        record, offset = (entries[-1][1], entries[-1][2]) if entries else (segment.base, 0)
+        entries = entries[:-1]
+
+        with open(segment.index_path, 'ab') as index:
+            index.truncate(len(entries) * INDEX_ENTRY.size)
+        self._add_entries(position, entries)
+
+        rebuilt = bytearray()
+        while offset < segment.size:
+            found = self._check(segment, offset)
+            if found is None:
+                break
+            key, end = found
+            if (record - segment.base) % self.index_interval == 0:
+                rebuilt += INDEX_ENTRY.pack(record - segment.base, offset, *key)
+                self._add_entries(position, [(key, record, offset)])
+            self._remember(key[1].hex())
+            self.last_key = key
+            record += 1
+            offset = end
+
+        if offset < segment.size:
+            os.truncate(segment.path, offset)  # drop the torn tail
+            segment.unmap()
+        segment.size = offset
+        segment.count = record - segment.base
+        with open(segment.index_path, 'ab') as index:
+            index.write(rebuilt)
+        if self.last_key is None and self.keys:
+            self.last_key = self.keys[-1]
+
+    def _check(self, segment, offset):
+        """Key and end of the record at offset, or None if it is torn or damaged"""
+        end = segment.size
+        if offset + RECORD_HEADER.size + RECORD_KEY.size > end:
+            return None
+        view = segment.view()
+        length, crc = RECORD_HEADER.unpack_from(view, offset)
+        start = offset + RECORD_HEADER.size
+        stop = start + RECORD_KEY.size + length
+        if stop > end or zlib.crc32(view[start:stop]) != crc:
+            return None
+        return RECORD_KEY.unpack_from(view, start), stop
+
+    def close(self):
+        self.closed = True
+        if self.data_fd is not None:
+            os.close(self.data_fd)
+            os.close(self.index_fd)
+        for segment in self.segments:
+            segment.unmap()
+
+    def append(self, messages):
+        """Append messages in one write, skipping any already stored by a retried batch.
+
+        Nothing about the records (ids, counts, index entries) is kept until
+        their write succeeded, so if it raises the whole batch can be retried.
+        """
+        segment = self.segments[-1]
+        data = bytearray()
+        index = bytearray()
+        entries = []  # (key, record number, offset) of the new index entries
+        ids = []
+        last_key = self.last_key
+        for message in messages:
+            if message['_id'] in self.recent_ids:
+                continue
+            key = _key(message['timestamp'], message['_id'])
+            if last_key is not None and key < last_key:
+                # The clock went backwards, keep the log sorted. Only the
+                # record moves, the message dict is shared with the history
+                # cache and readers and is left alone
+                timestamp = EPOCH + timedelta(microseconds=last_key[0])
+                key = _key(timestamp, message['_id'])
+                if key < last_key:
+                    timestamp += timedelta(milliseconds=1)
+                    key = _key(timestamp, message['_id'])
+            body = RECORD_KEY.pack(*key) + json.dumps(
+                [message['username'], message['content'], message.get('seq', 0)]).encode('utf-8')
+            length = len(body) - RECORD_KEY.size
+
+            if (segment.count or ids) and segment.size + len(data) + RECORD_HEADER.size + len(body) > self.segment_size:
+                self._write(segment, data, index, entries, ids, last_key)
+                data, index, entries, ids = bytearray(), bytearray(), [], []
+                segment = self._roll()
+
+            offset = segment.size + len(data)
+            record = segment.count + len(ids)
+            if record % self.index_interval == 0:
+                index += INDEX_ENTRY.pack(record, offset, *key)
+                entries.append((key, segment.base + record, offset))
+            data += RECORD_HEADER.pack(length, zlib.crc32(body))
+            data += body
+            ids.append(message['_id'])
+            last_key = key
+        self._write(segment, data, index, entries, ids, last_key)
+
+    def _write(self, segment, data, index, entries, ids, last_key):
+        """Write the records and index entries of one segment, then keep them.
+
+        On failure both files are cut back to where they were, the retry
+        writes the records again.
+        """
+        if not data:
+            return
+        if self.data_fd is None:
+            self._open()
+        index_size = os.lseek(self.index_fd, 0, os.SEEK_END)
+        try:
+            # Records first, an index entry never points past the end of the data
+            if os.write(self.data_fd, data) != len(data):
+                raise OSError("Short write to the message log")
+            if index and os.write(self.index_fd, index) != len(index):
+                raise OSError("Short write to the message log index")
+            if self.fsync:
+                os.fsync(self.data_fd)
+        except OSError:
+            try:
+                os.ftruncate(self.data_fd, segment.size)
+                os.ftruncate(self.index_fd, index_size)
+            except OSError as e:
+                print(f"Message log: could not undo a failed write: {e}")
+            raise
+        segment.size += len(data)
+        segment.count += len(ids)
+        self._add_entries(len(self.segments) - 1, entries)
+        for message_id in ids:
+            self._remember(message_id)
+        self.last_key = last_key
+
+    def _roll(self):
+        last = self.segments[-1]
+        if self.fsync:
+            os.fsync(self.index_fd)
+        os.close(self.data_fd)
+        os.close(self.index_fd)
+        segment = _Segment(self.directory, last.base + last.count)
+        self.segments.append(segment)
+        self.data_fd = os.open(segment.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.index_fd = os.open(segment.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return segment
+
+    def _scan(self, entry):
+        """Yield (key, view, start, stop) of every record from the entry'th
+        index entry on, where view[start:stop] is the record's JSON"""
+        position, offset = self.offsets[entry]
+        header = RECORD_HEADER.size + RECORD_KEY.size
+        for segment in self.segments[position:]:
+            # Everything up to size was checked by _recover or written by us
+            end = segment.size
+            view = segment.view() if end else b''
+            while offset < end:
+                length = RECORD_HEADER.unpack_from(view, offset)[0]
+                key = RECORD_KEY.unpack_from(view, offset + RECORD_HEADER.size)
+                start = offset + header
+                offset = start + length
+                yield key, view, start, offset
+            offset = 0
+
+    def total(self):
+        last = self.segments[-1]
+        return last.base + last.count
+
+    def page(self, limit, before=None, after=None):
+        if not self.keys:
+            return []
+        if after:
+            after = _key(*after)
+            start = max(bisect.bisect_right(self.keys, after) - 1, 0)
+            found = []
+            for record in self._scan(start):
+                if record[0] > after:
+                    found.append(record)
+                    if len(found) == limit:
+                        break
+        else:
+            if before:
+                before = _key(*before)
+                j = bisect.bisect_left(self.keys, before)
+                if j == 0:
+                    return []
+                first = self.records[j - 1] - limit
+            else:
+                first = self.total() - limit
+            start = max(bisect.bisect_right(self.records, first) - 1, 0)
+            found = deque(maxlen=limit)
+            for record in self._scan(start):
+                if before and record[0] >= before:
+                    break
+                found.append(record)
+            found.reverse()
+        # Only the records on the page are decoded, in one go
+        bodies = json.loads(b'[' + b','.join(view[start:stop] for _, view, start, stop in found) + b']')
+        # Records written before messages had sequence numbers have no seq
+        return [{'_id': message_id.hex(), 'username': body[0], 'content': body[1],
+                 'timestamp': EPOCH + timedelta(microseconds=micros),
+                 'seq': body[2] if len(body) > 2 else 0}
+                for ((micros, message_id), _, _, _), body in zip(found, bodies)]
+
+
+class MessageLog:
+    """Append-only store for chat messages, an alternative to keeping them
+    in the storage engine.
+
+    Every chat gets a directory of segment files holding length, crc and
+    key prefixed JSON records in the order they were saved, plus a sparse index
+    of every INDEX_INTERVAL'th record's offset and sort key. A write-behind
+    batch is a single sequential write per chat. Reads bisect the index and
+    scan forward through a read-only mmap of the segment, so the newest page
+    of a chat only touches its last few kilobytes. When a chat is opened its
+    active segment is checked and a torn record left by a crash is cut off.
+
+    Offers the message half of StorageEngine (new_id, insert_messages,
+    message_page). Only one process may use a log directory at a time.
+    """
+    def __init__(self, path=None, segment_size=SEGMENT_SIZE, index_interval=INDEX_INTERVAL,
+                 max_open_chats=MAX_OPEN_CHATS, fsync=False):
+        self.path = path or os.environ.get(MESSAGE_LOG_ENV, MESSAGE_LOG_PATH)
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.max_open_chats = max_open_chats
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.chats = OrderedDict()  # {chat_id: _ChatLog}, least recently used first
+
+        os.makedirs(self.path, exist_ok=True)
+        self.lock_file = open(os.path.join(self.path, 'LOCK'), 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            raise LogError(f"Message log {self.path} is in use by another process")
+
+    def new_id(self):
+        return new_object_id()
+
+    def _directory(self, chat_id):
+        if SAFE_NAME.match(chat_id):
+            return os.path.join(self.path, chat_id)
+        return os.path.join(self.path, hashlib.sha1(chat_id.encode('utf-8')).hexdigest())
+
+    def _chat(self, chat_id):
+        """The chat's log with its lock held, opening it if needed"""
+        while True:
+            with self.lock:
+                chat = self.chats.get(chat_id)
+                if chat is None:
+                    chat = _ChatLog(self._directory(chat_id), self.segment_size,
+                                    self.index_interval, self.fsync)
+                    self.chats[chat_id] = chat
+                    while len(self.chats) > self.max_open_chats:
+                        _, evicted = self.chats.popitem(last=False)
+                        with evicted.lock:
+                            evicted.close()
+                else:
+                    self.chats.move_to_end(chat_id)
+            chat.lock.acquire()
+            if not chat.closed:
+                return chat
+            chat.lock.release()  # evicted while we waited, open it again
+
+    def insert_messages(self, messages):
+        by_chat = OrderedDict()
+        for message in messages:
+            by_chat.setdefault(message['chat_id'], []).append(message)
+        for chat_id, chat_messages in by_chat.items():
+            chat = self._chat(chat_id)
+            try:
+                chat.append(chat_messages)
+            finally:
+                chat.lock.release()
+
+    def message_page(self, chat_id, limit, before=None, after=None):
+        if chat_id not in self.chats and not os.path.isdir(self._directory(chat_id)):
+            return []  # nothing was ever saved to it, don't open it
+        chat = self._chat(chat_id)
+        try:
+            messages = chat.page(limit, before, after)
+        finally:
+            chat.lock.release()
+        for message in messages:
+            message['chat_id'] = chat_id
+        return messages
+
+    def last_sequence(self, chat_id):
+        """The largest sequence number among the chat's newest records.
+
+        Records are appended in the order Database.save_message numbers
+        them, so the newest SEQUENCE_SCAN hold the largest.
+        """
+        messages = self.message_page(chat_id, SEQUENCE_SCAN)
+        return max((message['seq'] for message in messages), default=0)
+
+    def delete_all(self):
+        with self.lock:
+            for chat in self.chats.values():
+                with chat.lock:
+                    chat.close()
+            self.chats.clear()
+            for name in os.listdir(self.path):
+                if name != 'LOCK':
+                    shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def close(self):
+        with self.lock:
+            for chat in self.chats.values():
+                with chat.lock:
+                    chat.close()
+            self.chats.clear()
+        self.lock_file.close()
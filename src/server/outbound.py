@@ -0,0 +1,181 @@
+import asyncio
+import socket
+import time
+from collections import deque
+from itertools import islice
+
+HIGH_WATER = 256 * 1024          # bytes queued before a connection counts as congested
+LOW_WATER = 64 * 1024            # bytes queued before it stops counting as congested
+MAX_QUEUED = 4 * 1024 * 1024     # bytes queued before the connection is dropped outright
+SLOW_CONSUMER_TIMEOUT = 10.0     # seconds a connection may stay congested
+MAX_WRITE = 256 * 1024           # most bytes handed to the kernel in one write
+MAX_IOV = 512                    # most frames gathered into one sendmsg call
+
+# Scatter/gather writes need sendmsg, which Windows does not have
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class OutboundQueue:
+    """Frames waiting to be written to one connection.
+
+    put() never blocks: frames are queued and a writer coroutine (run) drains
+    them. Frames are never copied on the way out, a broadcast frame is one
+    bytes object shared by every recipient's queue and several queued frames
+    are handed to the kernel in a single sendmsg() scatter/gather call,
+    resuming from a memoryview after a partial write. A connection that stays
+    above the high watermark for slow_timeout seconds, or goes over max_queued
+    bytes, is reported through on_slow so one stalled reader cannot hold up
+    delivery to anyone else. The timeout runs on a timer, so it fires even if
+    nothing more is queued while the writer waits on the socket.
+    """
+    def __init__(self, loop, sock, on_slow, on_error, high_water=HIGH_WATER,
+                 low_water=LOW_WATER, max_queued=MAX_QUEUED,
+                 slow_timeout=SLOW_CONSUMER_TIMEOUT, max_write=MAX_WRITE):
+        self.loop = loop
+        self.sock = sock
+        self.on_slow = on_slow      # function(), the consumer is too slow
+        self.on_error = on_error    # function(exception), the write failed
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_queued = max_queued
+        self.slow_timeout = slow_timeout
+        self.max_write = max_write
+
+        self.frames = deque()
+        self.size = 0               # bytes queued, including a write in progress
+        self.congested_since = None
+        self.slow_timer = None      # fires slow_timeout after congestion starts
+        self.closed = False
+        self.discarded = 0          # frames thrown away unsent by close()
+        self.wakeup = asyncio.Event()
+        self.writable = asyncio.Event()  # set while below the high watermark
+        self.writable.set()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame):
+        """Queue a frame, returns False if the connection is closed or too slow"""
+        if self.closed:
+            return False
+        self.frames.append(frame)
+        self.size += len(frame)
+        self.wakeup.set()
+
+        if self.size > self.max_queued:
+            self._too_slow()
+            return False
+        if self.size > self.high_water:
+            now = time.monotonic()
+            if self.congested_since is None:
+                self.congested_since = now
+                self.writable.clear()
+                self.slow_timer = self.loop.call_later(self.slow_timeout, self._check_slow)
+            elif now - self.congested_since > self.slow_timeout:
+                self._too_slow()
+                return False
+        return True
+
+    def _check_slow(self):
+        self.slow_timer = None
+        if not self.closed and self.congested_since is not None:
+            self._too_slow()
+
+    def _too_slow(self):
+        self.close()
+        self.on_slow()
+
+    async def wait_writable(self):
+        """Wait until the queue is back under the low watermark (backpressure)"""
+        await self.writable.wait()
+
+    def close(self):
+        self.closed = True
+        if self.slow_timer is not None:
+            self.slow_timer.cancel()
+            self.slow_timer = None
+        self.discarded += len(self.frames)
+        self.frames.clear()
+        self.wakeup.set()
+        self.writable.set()  # let anyone waiting on backpressure find out
+
+    async def run(self):
+        """Writer coroutine, drains the queue until close()"""
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.frames and not self.closed:
+                    if HAS_SENDMSG:
+                        await self._send_vectored()
+                    else:
+                        data = self._next_write()
+                        await self.loop.sock_sendall(self.sock, data)
+                        self._written(len(data))
+        except OSError as e:
+            self.closed = True
+            self.on_error(e)
+
+    async def _send_vectored(self):
+        buffers = []
+        size = 0
+        for frame in islice(self.frames, MAX_IOV):
+            buffers.append(frame)
+            size += len(frame)
+            if size >= self.max_write:
+                break
+
+        try:
+            sent = self.sock.sendmsg(buffers)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+
+        self._written(sent)
+        remaining = sent
+        while remaining:
+            frame = self.frames[0]
+            if remaining < len(frame):
+                # Partial write, resume from the rest of this frame next time
+                self.frames[0] = memoryview(frame)[remaining:]
+                break
+            remaining -= len(frame)
+            self.frames.popleft()
+
+        if sent < size:
+            await self._wait_for_socket()
+
+    async def _wait_for_socket(self):
+        """Wait until the kernel send buffer has room again"""
+        ready = self.loop.create_future()
+
+        def on_writable():
+            if not ready.done():
+                ready.set_result(None)
+
+        self.loop.add_writer(self.sock, on_writable)
+        try:
+            await ready
+        finally:
+            if self.sock.fileno() != -1:  # not already closed by a disconnect
+                self.loop.remove_writer(self.sock)
+
+    def _next_write(self):
+        frame = self.frames.popleft()
+        if not self.frames or len(frame) >= self.max_write:
+            return frame
+        batch = [frame]
+        size = len(frame)
+        while self.frames and size + len(self.frames[0]) <= self.max_write:
+            frame = self.frames.popleft()
+            batch.append(frame)
+            size += len(frame)
+        return b''.join(batch)
+
+    def _written(self, nbytes):
+        self.size -= nbytes
+        if self.congested_since is not None and self.size <= self.low_water:
+            self.congested_since = None
+            if self.slow_timer is not None:
+                self.slow_timer.cancel()
+                self.slow_timer = None
+            self.writable.set()
@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+WORK_FACTOR = 12          # bcrypt cost, every +1 doubles the time per hash
+MAX_PENDING = 256         # hashing jobs queued or running before callers are turned away
+SUBMIT_TIMEOUT = 5.0      # seconds to wait for a free slot before giving up
+
+
+class HasherBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed"""
+
+
+def hash_password(password, work_factor):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(work_factor)).decode('utf-8')
+
+
+def check_password(password, hashed):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def is_hashed(stored):
+    return stored.startswith(('$2a$', '$2b$', '$2y$'))
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded process pool.
+
+    A hash takes on the order of 100 ms of CPU, running it in worker processes
+    keeps it off the server's threads and lets a login storm use every core.
+    At most max_pending jobs are accepted at once, further callers wait up to
+    submit_timeout seconds for a slot and then get HasherBusy.
+    """
+    def __init__(self, work_factor=WORK_FACTOR, workers=None, max_pending=MAX_PENDING,
+                 submit_timeout=SUBMIT_TIMEOUT):
+        self.work_factor = work_factor
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        # The server is full of threads by the time we hash, don't fork it
+        self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.in_flight = 0  # jobs submitted and not done yet
+
+    def hash(self, password):
+        """Future for the bcrypt hash of password"""
+        return self._submit(hash_password, password, self.work_factor)
+
+    def check(self, password, hashed):
+        """Future for whether password matches the stored hash"""
+        return self._submit(check_password, password, hashed)
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def _submit(self, func, *args):
+        if not self.slots.acquire(timeout=self.submit_timeout):
+            raise HasherBusy(f"{self.max_pending} password hashes already pending")
+        with self.lock:
+            self.in_flight += 1
+        try:
+            future = self.pool.submit(func, *args)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
@@ -0,0 +1,234 @@
+import json
+import struct
+import zlib
+
+# Every message on the wire is a frame: a 4 byte big-endian payload length
+# and a 1 byte frame type, followed by the payload. Commands and their replies
+# are still the usual COMMAND:json text.
+HEADER = struct.Struct('!IB')
+
+# Frame types, everything for a session is multiplexed over one connection
+FRAME_MESSAGE = 0  # commands from the client and the server's replies
+FRAME_PUSH = 1     # chat messages the server pushes to the client
+FRAME_PING = 2     # keep-alive, answered with FRAME_PONG
+FRAME_PONG = 3
+FRAME_REQUEST = 4  # a command tagged with a request id, see encode_request
+FRAME_REPLY = 5    # the reply to a FRAME_REQUEST, tagged with the same id
+FRAME_HELLO = 6    # capabilities, see offer_compression and accept_compression
+
+# Set on the frame type of a frame whose payload is compressed, see Compressor
+FLAG_COMPRESSED = 0x80
+
+# Tagged frames start with a 4 byte request id chosen by the client, so it
+# can have several commands in flight and match up the replies
+REQUEST_ID = struct.Struct('!I')
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+BUFFER_SIZE = 64 * 1024
+MIN_RECV_SIZE = 4096
+
+# Compression methods in order of preference
+COMPRESSION_METHODS = ('zlib',)
+COMPRESSION_THRESHOLD = 256  # smaller payloads are sent as they are
+# Replies are compressed on the server's event loop, level 1 gets most of
+# the saving for a third of the time level 6 takes (bench/bench_compression.py)
+COMPRESSION_LEVEL = 1
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends something that is not a valid frame"""
+
+
+def encode_frame(payload=b'', frame_type=FRAME_MESSAGE):
+    """Frame a single payload (str or bytes)"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame too large: {len(payload)} bytes")
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+def encode_request(request_id, payload, frame_type=FRAME_REQUEST, compressor=None):
+    """Frame a command or reply (frame_type=FRAME_REPLY) tagged with a request id"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    payload = REQUEST_ID.pack(request_id) + payload
+    if compressor:
+        return compressor.encode_frame(payload, frame_type)
+    return encode_frame(payload, frame_type)
+
+
+def split_request(payload):
+    """(request id, rest of the payload) of a tagged frame"""
+    if len(payload) < REQUEST_ID.size:
+        raise ProtocolError("Tagged frame without a request id")
+    return REQUEST_ID.unpack_from(payload)[0], payload[REQUEST_ID.size:]
+
+
+def encode_frames(payloads, frame_type=FRAME_MESSAGE):
+    """Frame several payloads into one buffer so they go out in a single send"""
+    return b''.join(encode_frame(payload, frame_type) for payload in payloads)
+
+
+def offer_compression(methods=COMPRESSION_METHODS):
+    """The FRAME_HELLO payload a client sends right after connecting"""
+    return json.dumps({'compression': list(methods)})
+
+
+def accept_compression(hello, methods=COMPRESSION_METHODS):
+    """The method to use for a peer's FRAME_HELLO, the first of ours it offers.
+
+    None if there is none in common. Peers that never send FRAME_HELLO,
+    or ignore it, never see a compressed frame.
+    """
+    try:
+        offered = json.loads(bytes(hello)).get('compression') or []
+    except (ValueError, AttributeError):
+        return None
+    for method in methods:
+        if method in offered:
+            return method
+    return None
+
+
+class Compressor:
+    """Compresses the frames sent on one connection.
+
+    A single zlib stream runs for the life of the connection, flushed at the
+    end of every frame, so later frames are compressed against what earlier
+    ones sent. The peer's Decompressor must see the compressed frames in the
+    order they were encoded.
+    """
+    def __init__(self, method, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL):
+        if method not in COMPRESSION_METHODS:
+            raise ProtocolError(f"Unknown compression method: {method}")
+        self.method = method
+        self.threshold = threshold
+        self._zlib = zlib.compressobj(level)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def encode_frame(self, payload=b'', frame_type=FRAME_MESSAGE):
+        """Frame a payload, compressed if it is at least threshold bytes"""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        if len(payload) < self.threshold:
+            return encode_frame(payload, frame_type)
+        compressed = self._zlib.compress(payload) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_in += len(payload)
+        self.bytes_out += len(compressed)
+        return encode_frame(compressed, frame_type | FLAG_COMPRESSED)
+
+
+class Decompressor:
+    """The receiving end of a connection's Compressor"""
+    def __init__(self, method, max_size=MAX_FRAME_SIZE):
+        if method not in COMPRESSION_METHODS:
+            raise ProtocolError(f"Unknown compression method: {method}")
+        self.max_size = max_size
+        self._zlib = zlib.decompressobj()
+
+    def decompress(self, payload):
+        try:
+            data = self._zlib.decompress(payload, self.max_size)
+        except zlib.error as e:
+            raise ProtocolError(f"Bad compressed frame: {e}")
+        if self._zlib.unconsumed_tail:
+            raise ProtocolError(f"Compressed frame larger than {self.max_size} bytes")
+        return data
+
+
+class FrameDecoder:
+    """Incremental decoder for length-prefixed frames.
+
+    Data is received straight into a reusable bytearray with recv_into() and
+    frames are handed out as memoryview slices of that buffer, so nothing is
+    copied between the kernel and the caller. A frame is only valid until the
+    next call to writable() or feed(), decode it before reading more data.
+
+    Once a Decompressor is set, compressed frames are handed out decompressed
+    with FLAG_COMPRESSED cleared from their type.
+    """
+    def __init__(self, size=BUFFER_SIZE, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.decompressor = None  # set once compression has been negotiated
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first byte not yet handed out as a frame
+        self._end = 0    # end of the data received so far
+        self._needed = HEADER.size  # bytes the next frame needs in total
+
+    def __len__(self):
+        return self._end - self._start
+
+    def writable(self, min_size=MIN_RECV_SIZE):
+        """Return a memoryview of free buffer space to recv_into()"""
+        pending = self._end - self._start
+        if pending == 0:
+            self._start = self._end = 0
+
+        wanted = max(self._needed, pending + min_size)
+        if wanted > len(self._buffer):
+            # Frames handed out earlier may still reference the old buffer,
+            # so grow into a new one instead of resizing in place
+            size = len(self._buffer)
+            while size < wanted:
+                size *= 2
+            buffer = bytearray(size)
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+            self._start, self._end = 0, pending
+        elif len(self._buffer) - self._end < min_size and self._start:
+            # Move the partial frame to the front to make room
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+        return self._view[self._end:]
+
+    def commit(self, nbytes):
+        """Record that nbytes were received into the last writable() view"""
+        self._end += nbytes
+
+    def feed(self, data):
+        """Copy data into the buffer, for callers that cannot use recv_into()"""
+        data = memoryview(data)
+        while data:
+            view = self.writable(len(data))
+            count = min(len(view), len(data))
+            view[:count] = data[:count]
+            self.commit(count)
+            data = data[count:]
+
+    def next_frame(self):
+        """Return the next complete frame as (frame type, payload memoryview), or None"""
+        available = self._end - self._start
+        if available < HEADER.size:
+            self._needed = HEADER.size
+            return None
+
+        length, frame_type = HEADER.unpack_from(self._buffer, self._start)
+        if length > self.max_frame_size:
+            raise ProtocolError(f"Frame too large: {length} bytes")
+
+        self._needed = HEADER.size + length
+        if available < self._needed:
+            return None
+
+        start = self._start + HEADER.size
+        self._start = start + length
+        self._needed = HEADER.size
+        if frame_type & FLAG_COMPRESSED:
+            if self.decompressor is None:
+                raise ProtocolError("Compressed frame before compression was negotiated")
+            payload = self.decompressor.decompress(self._view[start:self._start])
+            return frame_type & ~FLAG_COMPRESSED, memoryview(payload)
+        return frame_type, self._view[start:self._start]
+
+    def frames(self):
+        """Yield (frame type, payload) for every complete frame currently buffered"""
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
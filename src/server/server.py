@@ -1,14 +1,27 @@
-import json
-from bson import ObjectId
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 from datetime import datetime
+import bisect
+import queue
 import threading
-from chatserver import ChatServer
+import time
+from chatserver import ChatServer, METRICS_PORT
+from database import USERS_PAGE_SIZE
+
+METRICS_REFRESH = 2000  # ms between Metrics tab updates
+USERS_REFRESH = 5000    # ms between checks for new users
+USERS_RESYNC = 60.0     # seconds between full reloads, they pick up deleted and changed users
+USERS_POLL = 200        # ms between applying loaded users to the Users tab
+USERS_ROW_HEIGHT = 20   # pixels, the Users tab only creates the rows that fit
+USERS_WHEEL_ROWS = 3    # rows scrolled per mouse wheel notch
+LOG_DRAIN = 100         # ms between traffic log updates
+LOG_MAX_LINES = 5000    # lines kept in the traffic log, the oldest are dropped
+LOG_RATE = 500          # lines a second shown in the traffic log, the rest are skipped
+LOG_SAMPLE = True       # above LOG_RATE show an even sample of the lines, not just the first ones
 
 
 class ServerGUI:
-    def __init__(self):
+    def __init__(self, log_max_lines=LOG_MAX_LINES, log_rate=LOG_RATE, log_sample=LOG_SAMPLE):
         self.root = tk.Tk()
         self.root.title("Chat Server Monitor")
         self.root.geometry("800x600")
@@ -23,14 +36,26 @@ class ServerGUI:
         
         self.traffic_log = scrolledtext.ScrolledText(self.traffic_frame, wrap=tk.WORD)
         self.traffic_log.pack(expand=True, fill='both', padx=5, pady=5)
+
+        # log_traffic is called from the server's threads, the lines wait here
+        # until the Tk thread takes them in batches, see drain_log
+        self.log_queue = queue.SimpleQueue()
+        self.log_max_lines = log_max_lines
+        self.log_batch = max(1, log_rate * LOG_DRAIN // 1000)  # lines shown per drain
+        self.log_sample = log_sample
+        self.log_lines = 0  # lines in the widget
         
         # Users Tab
         self.users_frame = ttk.Frame(self.notebook)
         self.notebook.add(self.users_frame, text='Users')
         
-        # Users treeview
+        # Users treeview, it only ever holds the rows on screen. The users
+        # are loaded in pages on a background thread, see load_users, and
+        # kept sorted by (created_at, username) in user_keys
+        ttk.Style().configure('Users.Treeview', rowheight=USERS_ROW_HEIGHT)
         columns = ('username', 'password', 'created_at')
-        self.users_tree = ttk.Treeview(self.users_frame, columns=columns, show='headings')
+        self.users_tree = ttk.Treeview(self.users_frame, columns=columns, show='headings',
+                                       style='Users.Treeview')
         self.users_tree.heading('username', text='Username')
         self.users_tree.heading('password', text='Password Hash')
         self.users_tree.heading('created_at', text='Created At')
@@ -40,13 +65,45 @@ class ServerGUI:
         self.users_tree.column('password', width=300)  # Wider for hash
         self.users_tree.column('created_at', width=150)
         
-        # Add scrollbar to users tree
-        users_scroll = ttk.Scrollbar(self.users_frame, orient='vertical', 
-                                   command=self.users_tree.yview)
-        self.users_tree.configure(yscrollcommand=users_scroll.set)
-        
+        # The scrollbar moves through user_keys, not through the widget
+        self.users_scroll = ttk.Scrollbar(self.users_frame, orient='vertical',
+                                          command=self.scroll_users)
+
         self.users_tree.pack(side='left', fill='both', expand=True)
-        users_scroll.pack(side='right', fill='y')
+        self.users_scroll.pack(side='right', fill='y')
+        self.users_tree.bind('<Configure>', lambda event: self.render_users())
+        self.users_tree.bind('<MouseWheel>', self.wheel_users)
+        self.users_tree.bind('<Button-4>', self.wheel_users)
+        self.users_tree.bind('<Button-5>', self.wheel_users)
+
+        self.user_rows = {}      # {username: (created_at, password)}
+        self.user_keys = []      # [(created_at, username)], sorted
+        self.users_top = 0       # index in user_keys of the first row shown
+        self.user_items = []     # Treeview items, one per visible row
+        self.user_shown = []     # values currently in those items
+        self.user_updates = queue.SimpleQueue()  # loaded users, from load_users
+        self.users_wake = threading.Event()      # load now
+        self.users_resync = threading.Event()    # make the next load a full one
+
+        # Metrics Tab
+        self.metrics_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.metrics_frame, text='Metrics')
+
+        columns = ('metric', 'labels', 'value')
+        self.metrics_tree = ttk.Treeview(self.metrics_frame, columns=columns, show='headings')
+        self.metrics_tree.heading('metric', text='Metric')
+        self.metrics_tree.heading('labels', text='Labels')
+        self.metrics_tree.heading('value', text='Value')
+        self.metrics_tree.column('metric', width=250)
+        self.metrics_tree.column('labels', width=200)
+        self.metrics_tree.column('value', width=300)
+
+        metrics_scroll = ttk.Scrollbar(self.metrics_frame, orient='vertical',
+                                       command=self.metrics_tree.yview)
+        self.metrics_tree.configure(yscrollcommand=metrics_scroll.set)
+
+        self.metrics_tree.pack(side='left', fill='both', expand=True)
+        metrics_scroll.pack(side='right', fill='y')
         
         # Control Panel
         self.control_frame = ttk.Frame(self.root)
@@ -64,15 +121,20 @@ class ServerGUI:
         self.server_status.pack(side='right', padx=5)
         
         # Start server
-        self.server = ChatServer(gui_callback=self.log_traffic)
+        self.server = ChatServer(gui_callback=self.log_traffic, metrics_port=METRICS_PORT)
         self.server_thread = threading.Thread(target=self.server.start)
         self.server_thread.daemon = True
         self.server_thread.start()
         
         self.server_status.config(text="Server Status: Running")
+
+        self.users_thread = threading.Thread(target=self.load_users, name='users-loader', daemon=True)
+        self.users_thread.start()
         
         # Set up periodic refresh
-        self.root.after(5000, self.refresh_users)
+        self.root.after(USERS_POLL, self.apply_user_updates)
+        self.root.after(METRICS_REFRESH, self.refresh_metrics)
+        self.root.after(LOG_DRAIN, self.drain_log)
         
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.root.mainloop()
@@ -87,32 +149,192 @@ class ServerGUI:
                 messagebox.showerror("Error", f"Failed to delete users: {e}")
 
     def refresh_users(self):
-        for item in self.users_tree.get_children():
-            self.users_tree.delete(item)
-            
-        users = self.server.db.get_all_users()
-        for user in users:
-            created_at = user['created_at'].strftime("%Y-%m-%d %H:%M:%S")
+        """Reload every user in the background, the Users tab updates when done"""
+        self.users_resync.set()
+        self.users_wake.set()
+
+    def load_users(self):
+        """Background thread feeding the Users tab.
+
+        Every USERS_REFRESH it asks for the users created after the last one
+        it has seen, a cheap indexed query. Every USERS_RESYNC, and when asked
+        by refresh_users, it walks all users page by page instead so removed
+        and changed users are noticed too.
+        """
+        after = None
+        last_full = None
+        while True:
+            try:
+                if self.users_resync.is_set() or last_full is None or \
+                        time.monotonic() - last_full >= USERS_RESYNC:
+                    self.users_resync.clear()
+                    last_full = time.monotonic()
+                    users, after = self.fetch_users(None)
+                    self.user_updates.put(('full', users))
+                else:
+                    users, after = self.fetch_users(after)
+                    if users:
+                        self.user_updates.put(('new', users))
+            except Exception as e:
+                self.log_traffic(f"Error loading users: {e}")
+            self.users_wake.wait(USERS_REFRESH / 1000)
+            self.users_wake.clear()
+
+    def fetch_users(self, after):
+        users = {}
+        while True:
+            page = self.server.db.get_users_page(USERS_PAGE_SIZE, after)
+            for user in page['users']:
+                users[user['username']] = (user['created_at'], user['password'])
+            after = page['after']
+            if len(page['users']) < USERS_PAGE_SIZE:
+                return users, after
+
+    def apply_user_updates(self):
+        """Merge what load_users found into the Users tab, on the Tk thread"""
+        changed = False
+        try:
+            while True:
+                kind, users = self.user_updates.get_nowait()
+                changed = self.merge_users(kind, users) or changed
+        except queue.Empty:
+            pass
+        if changed:
+            self.render_users()
+        self.root.after(USERS_POLL, self.apply_user_updates)
+
+    def merge_users(self, kind, users):
+        """Apply only the differences to the model, returns whether there were any"""
+        resort = False
+        changed = False
+        if kind == 'full':
+            for username in self.user_rows.keys() - users.keys():
+                del self.user_rows[username]
+                resort = True
+        for username, row in users.items():
+            old = self.user_rows.get(username)
+            if old == row:
+                continue
+            self.user_rows[username] = row
+            changed = True
+            if old is None and not resort:
+                bisect.insort(self.user_keys, (row[0], username))
+            elif old is None or old[0] != row[0]:
+                resort = True
+        if resort:
+            self.user_keys = sorted((row[0], username) for username, row in self.user_rows.items())
+        return changed or resort
+
+    def visible_users(self):
+        # Minus one row for the headings
+        return max(1, self.users_tree.winfo_height() // USERS_ROW_HEIGHT - 1)
+
+    def render_users(self):
+        """Show the users from users_top on, only touching rows whose values changed"""
+        visible = self.visible_users()
+        total = len(self.user_keys)
+        self.users_top = max(0, min(self.users_top, total - visible))
+        rows = []
+        for created_at, username in self.user_keys[self.users_top:self.users_top + visible]:
+            password = self.user_rows[username][1]
             # Show password hash in the middle column
-            self.users_tree.insert('', 'end', values=(
-                user['username'],
-                user['password'],
-                created_at
-            ))
-        
-        # Schedule next refresh
-        self.root.after(5000, self.refresh_users)
+            rows.append((username, password, created_at.strftime("%Y-%m-%d %H:%M:%S")))
+
+        while len(self.user_items) > len(rows):
+            self.users_tree.delete(self.user_items.pop())
+            self.user_shown.pop()
+        for i, values in enumerate(rows):
+            if i == len(self.user_items):
+                self.user_items.append(self.users_tree.insert('', 'end', values=values))
+                self.user_shown.append(values)
+            elif self.user_shown[i] != values:
+                self.users_tree.item(self.user_items[i], values=values)
+                self.user_shown[i] = values
+
+        if total:
+            self.users_scroll.set(self.users_top / total, min(1.0, (self.users_top + visible) / total))
+        else:
+            self.users_scroll.set(0.0, 1.0)
+
+    def scroll_users(self, action, amount, unit=None):
+        visible = self.visible_users()
+        if action == 'moveto':
+            self.users_top = int(float(amount) * len(self.user_keys))
+        else:
+            self.users_top += int(amount) * (visible if unit == 'pages' else 1)
+        self.render_users()
+
+    def wheel_users(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.users_top -= USERS_WHEEL_ROWS
+        else:
+            self.users_top += USERS_WHEEL_ROWS
+        self.render_users()
+
+    def refresh_metrics(self):
+        for item in self.metrics_tree.get_children():
+            self.metrics_tree.delete(item)
+
+        for name, metric in self.server.metrics.snapshot().items():
+            for sample in metric['values']:
+                labels = ', '.join(f"{key}={value}" for key, value in sample['labels'].items())
+                value = sample['value']
+                if metric['type'] == 'histogram':
+                    if name.endswith('_seconds'):
+                        value = (f"n={value['count']}  p50={value['p50'] * 1e3:.2f}ms  "
+                                 f"p95={value['p95'] * 1e3:.2f}ms  p99={value['p99'] * 1e3:.2f}ms")
+                    else:
+                        value = (f"n={value['count']}  p50={value['p50']:.1f}  "
+                                 f"p95={value['p95']:.1f}  p99={value['p99']:.1f}")
+                self.metrics_tree.insert('', 'end', values=(name, labels, value))
+
+        self.root.after(METRICS_REFRESH, self.refresh_metrics)
 
     def log_traffic(self, message):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.traffic_log.insert(tk.END, f"[{timestamp}] {message}\n")
-        self.traffic_log.see(tk.END)
-        
-        # Schedule next refresh
-        self.root.after(5000, self.refresh_users)
+        # Any thread, Tk is only touched by drain_log
+        self.log_queue.put((time.time(), message))
+
+    def drain_log(self):
+        """Move the queued log lines into the traffic log, one widget update per batch"""
+        events = []
+        try:
+            while True:
+                events.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        skipped = len(events) - self.log_batch
+        if skipped > 0:
+            if self.log_sample:
+                step = len(events) / self.log_batch
+                events = [events[int(i * step)] for i in range(self.log_batch)]
+            else:
+                events = events[:self.log_batch]
+
+        if events:
+            lines = []
+            for when, message in events:
+                timestamp = datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M:%S")
+                text = str(message).replace('\n', ' ')  # one line per event, the cap counts lines
+                lines.append(f"[{timestamp}] {text}\n")
+            if skipped > 0:
+                lines.append(f"[... {skipped} more events not shown]\n")
+            at_end = self.traffic_log.yview()[1] >= 1.0
+            self.traffic_log.insert(tk.END, ''.join(lines))
+            self.log_lines += len(lines)
+            # Drop the oldest lines past the cap
+            excess = self.log_lines - self.log_max_lines
+            if excess > 0:
+                self.traffic_log.delete('1.0', f'{excess + 1}.0')
+                self.log_lines -= excess
+            if at_end:  # don't yank the view away from someone reading back
+                self.traffic_log.see(tk.END)
+
+        self.root.after(LOG_DRAIN, self.drain_log)
 
     def on_closing(self):
         if messagebox.askokcancel("Quit", "Do you want to close the server?"):
+            # Waits for queued messages to be written, the server thread is a daemon
             self.server.stop()
             self.root.destroy()
 
@@ -0,0 +1,508 @@
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+try:
+    from pymongo import MongoClient, ReturnDocument
+    from pymongo.errors import DuplicateKeyError
+    from bson import ObjectId
+except ImportError:  # SQLite-only installs don't need pymongo
+    MongoClient = None
+
+STORAGE_ENV = 'CHAT_STORAGE'          # 'mongodb' (the default) or 'sqlite'
+SQLITE_PATH_ENV = 'CHAT_SQLITE_PATH'  # database file for the sqlite engine
+SQLITE_PATH = 'chat.db'
+MONGO_URI = 'mongodb://localhost:27017/'
+BUSY_TIMEOUT = 10.0                   # seconds SQLite waits on another writer
+
+
+class StorageEngine:
+    """Where Database keeps users, chats and messages.
+
+    Database does the caching, batching and password hashing on top, an
+    engine only reads and writes. Rows are plain dicts shaped like the
+    MongoDB documents the rest of the server already knows: '_id' is a
+    string, 'created_at' and 'timestamp' are datetimes.
+    """
+    name = None
+
+    def new_id(self):
+        """A unique message id that sorts roughly by creation time"""
+        raise NotImplementedError
+
+    def find_user(self, username):
+        raise NotImplementedError
+
+    def insert_user(self, user):
+        """Store a new user, returns False if the username is taken"""
+        raise NotImplementedError
+
+    def update_password(self, username, old, new):
+        """Replace the stored password, unless it is no longer old"""
+        raise NotImplementedError
+
+    def all_users(self):
+        raise NotImplementedError
+
+    def users_page(self, limit, after=None):
+        """Up to limit users oldest first, keyset paged on (created_at, username).
+
+        after is a (created_at, username) tuple.
+        """
+        raise NotImplementedError
+
+    def insert_chat(self, chat):
+        """Store a new chat, returns its id"""
+        raise NotImplementedError
+
+    def user_chats(self, username):
+        raise NotImplementedError
+
+    def insert_messages(self, messages):
+        """Store a batch of messages that already have their _id and timestamp"""
+        raise NotImplementedError
+
+    def message_page(self, chat_id, limit, before=None, after=None):
+        """Up to limit messages of a chat, keyset paged on (timestamp, _id).
+
+        before / after are (timestamp, _id) tuples. With after the messages
+        come oldest first, otherwise newest first.
+        """
+        raise NotImplementedError
+
+    def last_sequence(self, chat_id):
+        """The largest sequence number stored for a chat, 0 if there is none"""
+        raise NotImplementedError
+
+    def next_sequence(self, chat_id, start):
+        """Take the chat's next sequence number, atomically for every process
+        sharing the storage. A chat's counter is created on first use at
+        start(), the largest number already stored for it"""
+        raise NotImplementedError
+
+    def delete_all(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def open_storage(kind=None, **options):
+    """Open the engine named by kind, or by $CHAT_STORAGE"""
+    kind = kind or os.environ.get(STORAGE_ENV, 'mongodb')
+    if kind == 'mongodb':
+        return MongoStorage(**options)
+    if kind == 'sqlite':
+        return SQLiteStorage(**options)
+    raise ValueError(f"Unknown storage engine: {kind}")
+
+
+class MongoStorage(StorageEngine):
+    name = 'mongodb'
+
+    def __init__(self, uri=MONGO_URI, database='chat_app', **client_options):
+        if MongoClient is None:
+            raise RuntimeError("The mongodb storage engine needs pymongo installed")
+        self.client = MongoClient(uri, **client_options)
+        self.db = self.client[database]
+        self.users = self.db['users']
+        self.messages = self.db['messages']
+        self.chats = self.db['chats']
+        self.sequences = self.db['sequences']  # {_id: chat_id, seq: last number given out}
+
+        # Create indexes
+        self.users.create_index('username', unique=True)
+        self.users.create_index([('created_at', 1), ('username', 1)])
+        # Serves both the chat_id lookup and the history sort / keyset paging
+        self.messages.create_index([('chat_id', 1), ('timestamp', 1), ('_id', 1)])
+        self.messages.create_index([('chat_id', 1), ('seq', -1)])
+        self.chats.create_index('participants')
+
+    def new_id(self):
+        return str(ObjectId())
+
+    def find_user(self, username):
+        return self.users.find_one({'username': username})
+
+    def insert_user(self, user):
+        try:
+            self.users.insert_one(user)
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def update_password(self, username, old, new):
+        self.users.update_one({'username': username, 'password': old},
+                              {'$set': {'password': new}})
+
+    def all_users(self):
+        return list(self.users.find())
+
+    def users_page(self, limit, after=None):
+        query = {}
+        if after:
+            created_at, username = after
+            query['$or'] = [{'created_at': {'$gt': created_at}},
+                            {'created_at': created_at, 'username': {'$gt': username}}]
+        return list(self.users.find(query)
+                    .sort([('created_at', 1), ('username', 1)])
+                    .limit(limit))
+
+    def insert_chat(self, chat):
+        return str(self.chats.insert_one(chat).inserted_id)
+
+    def user_chats(self, username):
+        chats = list(self.chats.find({'participants': username}))
+        # Convert ObjectId to string for JSON serialization
+        for chat in chats:
+            chat['_id'] = str(chat['_id'])
+        return chats
+
+    def insert_messages(self, messages):
+        self.messages.insert_many([dict(message, _id=ObjectId(message['_id']))
+                                   for message in messages], ordered=False)
+
+    def message_page(self, chat_id, limit, before=None, after=None):
+        query = {'chat_id': chat_id}
+        if after:
+            timestamp, message_id = after
+            query['$or'] = [{'timestamp': {'$gt': timestamp}},
+                            {'timestamp': timestamp, '_id': {'$gt': ObjectId(message_id)}}]
+            order = 1
+        else:
+            if before:
+                timestamp, message_id = before
+                query['$or'] = [{'timestamp': {'$lt': timestamp}},
+                                {'timestamp': timestamp, '_id': {'$lt': ObjectId(message_id)}}]
+            order = -1
+
+        messages = list(self.messages.find(query)
+                        .sort([('timestamp', order), ('_id', order)])
+                        .limit(limit))
+        for message in messages:
+            message['_id'] = str(message['_id'])
+        return messages
+
+    def last_sequence(self, chat_id):
+        newest = self.messages.find_one({'chat_id': chat_id}, {'seq': 1}, sort=[('seq', -1)])
+        return newest.get('seq', 0) if newest else 0
+
+    def next_sequence(self, chat_id, start):
+        counter = self.sequences.find_one_and_update(
+            {'_id': chat_id}, {'$inc': {'seq': 1}}, return_document=ReturnDocument.AFTER)
+        if counter is None:
+            # $max, so a worker seeding the same chat can't move it backwards
+            self.sequences.update_one({'_id': chat_id}, {'$max': {'seq': start()}}, upsert=True)
+            counter = self.sequences.find_one_and_update(
+                {'_id': chat_id}, {'$inc': {'seq': 1}}, return_document=ReturnDocument.AFTER)
+        return counter['seq']
+
+    def delete_all(self):
+        self.users.delete_many({})
+        self.chats.delete_many({})
+        self.messages.delete_many({})
+        self.sequences.delete_many({})
+
+    def close(self):
+        self.client.close()
+
+
+# Fixed SQL text, the sqlite3 module keeps each one compiled in its
+# per-connection statement cache so they are prepared once
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_by_created ON users (created_at, username);
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    is_group INTEGER NOT NULL,
+    chat_name TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    created_by TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_participants (
+    username TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (username, chat_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS participants_by_chat ON chat_participants (chat_id, position);
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_by_chat ON messages (chat_id, timestamp, id);
+CREATE TABLE IF NOT EXISTS sequences (
+    chat_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+# After SQL_ADD_SEQ on older databases, so not part of the schema script
+SQL_SEQ_INDEX = "CREATE INDEX IF NOT EXISTS messages_by_seq ON messages (chat_id, seq)"
+# Databases from before messages had sequence numbers
+SQL_ADD_SEQ = "ALTER TABLE messages ADD COLUMN seq INTEGER NOT NULL DEFAULT 0"
+SQL_FIND_USER = "SELECT username, password, created_at FROM users WHERE username = ?"
+SQL_INSERT_USER = "INSERT INTO users (username, password, created_at) VALUES (?, ?, ?)"
+SQL_UPDATE_PASSWORD = "UPDATE users SET password = ? WHERE username = ? AND password = ?"
+SQL_ALL_USERS = "SELECT username, password, created_at FROM users"
+SQL_USERS_FIRST = "SELECT username, password, created_at FROM users ORDER BY created_at, username LIMIT ?"
+SQL_USERS_AFTER = """
+SELECT username, password, created_at FROM users
+WHERE (created_at, username) > (?, ?) ORDER BY created_at, username LIMIT ?
+"""
+SQL_INSERT_CHAT = "INSERT INTO chats (is_group, chat_name, created_at, created_by) VALUES (?, ?, ?, ?)"
+SQL_INSERT_PARTICIPANT = "INSERT OR IGNORE INTO chat_participants (username, chat_id, position) VALUES (?, ?, ?)"
+SQL_USER_CHATS = """
+SELECT c.id, c.is_group, c.chat_name, c.created_at, c.created_by,
+       (SELECT group_concat(username, char(31)) FROM
+            (SELECT username FROM chat_participants WHERE chat_id = c.id ORDER BY position))
+FROM chat_participants p JOIN chats c ON c.id = p.chat_id
+WHERE p.username = ?
+ORDER BY c.id
+"""
+# OR IGNORE: a batch retried by the write-behind queue may already be stored
+SQL_INSERT_MESSAGE = """
+INSERT OR IGNORE INTO messages (id, chat_id, username, content, timestamp, seq) VALUES (?, ?, ?, ?, ?, ?)
+"""
+SQL_MESSAGES_NEWEST = """
+SELECT id, chat_id, username, content, timestamp, seq FROM messages
+WHERE chat_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?
+"""
+SQL_MESSAGES_BEFORE = """
+SELECT id, chat_id, username, content, timestamp, seq FROM messages
+WHERE chat_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?
+"""
+SQL_LAST_SEQUENCE = "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE chat_id = ?"
+SQL_NEXT_SEQUENCE = "UPDATE sequences SET seq = seq + 1 WHERE chat_id = ? RETURNING seq"
+SQL_START_SEQUENCE = "INSERT INTO sequences (chat_id, seq) VALUES (?, ?)"
+SQL_MESSAGES_AFTER = """
+SELECT id, chat_id, username, content, timestamp, seq FROM messages
+WHERE chat_id = ? AND (timestamp, id) > (?, ?) ORDER BY timestamp, id LIMIT ?
+"""
+
+_id_counter = itertools.count()
+_id_process = os.urandom(5).hex()
+
+
+def _new_id_process():
+    global _id_process
+    _id_process = os.urandom(5).hex()
+
+
+# Supervisor workers are forked after this module is imported, each needs
+# its own random part or their ids collide and INSERT OR IGNORE drops messages
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_new_id_process)
+
+
+def new_object_id():
+    """24 hex digits laid out like an ObjectId: seconds, per process random, counter"""
+    return f"{int(time.time()):08x}{_id_process}{next(_id_counter) & 0xffffff:06x}"
+
+
+def _timestamp(value):
+    # Fixed width so the text sorts like the datetime
+    return value.isoformat(timespec='microseconds')
+
+
+class SQLiteStorage(StorageEngine):
+    """Embedded storage in a single SQLite file, no server to run.
+
+    The file is in WAL mode so readers never wait for the writer. Every
+    thread gets its own connection, the statements are fixed strings so each
+    connection prepares them once and reuses them, and a batch of messages
+    from the write-behind queue is inserted in one transaction. ':memory:'
+    gives a private in-memory database, shared by all threads through one
+    locked connection.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path=None, busy_timeout=BUSY_TIMEOUT):
+        self.path = path or os.environ.get(SQLITE_PATH_ENV, SQLITE_PATH)
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        if self.path == ':memory:':
+            self.shared = self._connect()
+            self.lock = threading.RLock()
+        else:
+            self.shared = None
+            self.lock = nullcontext()
+        with self.lock:
+            db = self._db()
+            db.executescript(SQLITE_SCHEMA)
+            if 'seq' not in [row[1] for row in db.execute('PRAGMA table_info(messages)')]:
+                db.execute(SQL_ADD_SEQ)
+            db.execute(SQL_SEQ_INDEX)
+
+    def _connect(self):
+        # Autocommit, batches open their own transaction
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                               check_same_thread=False, cached_statements=64)
+        if self.path != ':memory:':
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')  # durable at checkpoints, safe with WAL
+        with self.connections_lock:
+            self.connections.append(conn)
+        return conn
+
+    def _db(self):
+        if self.shared is not None:
+            return self.shared
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return conn
+
+    def new_id(self):
+        return new_object_id()
+
+    def find_user(self, username):
+        with self.lock:
+            row = self._db().execute(SQL_FIND_USER, (username,)).fetchone()
+        return self._user(row) if row else None
+
+    def insert_user(self, user):
+        try:
+            with self.lock:
+                self._db().execute(SQL_INSERT_USER, (user['username'], user['password'],
+                                                     _timestamp(user['created_at'])))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def update_password(self, username, old, new):
+        with self.lock:
+            self._db().execute(SQL_UPDATE_PASSWORD, (new, username, old))
+
+    def all_users(self):
+        with self.lock:
+            rows = self._db().execute(SQL_ALL_USERS).fetchall()
+        return [self._user(row) for row in rows]
+
+    def users_page(self, limit, after=None):
+        if after:
+            sql, args = SQL_USERS_AFTER, (_timestamp(after[0]), after[1], limit)
+        else:
+            sql, args = SQL_USERS_FIRST, (limit,)
+        with self.lock:
+            rows = self._db().execute(sql, args).fetchall()
+        return [self._user(row) for row in rows]
+
+    def insert_chat(self, chat):
+        with self.lock:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                chat_id = db.execute(SQL_INSERT_CHAT, (int(chat['is_group']), chat['chat_name'],
+                                                       _timestamp(chat['created_at']),
+                                                       chat['created_by'])).lastrowid
+                db.executemany(SQL_INSERT_PARTICIPANT,
+                               [(username, chat_id, position)
+                                for position, username in enumerate(chat['participants'])])
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        return str(chat_id)
+
+    def user_chats(self, username):
+        with self.lock:
+            rows = self._db().execute(SQL_USER_CHATS, (username,)).fetchall()
+        return [{
+            '_id': str(chat_id),
+            'participants': participants.split('\x1f'),
+            'is_group': bool(is_group),
+            'chat_name': chat_name,
+            'created_at': datetime.fromisoformat(created_at),
+            'created_by': created_by
+        } for chat_id, is_group, chat_name, created_at, created_by, participants in rows]
+
+    def insert_messages(self, messages):
+        rows = [(message['_id'], message['chat_id'], message['username'], message['content'],
+                 _timestamp(message['timestamp']), message.get('seq', 0)) for message in messages]
+        with self.lock:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.executemany(SQL_INSERT_MESSAGE, rows)
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def message_page(self, chat_id, limit, before=None, after=None):
+        if after:
+            sql, args = SQL_MESSAGES_AFTER, (chat_id, _timestamp(after[0]), after[1], limit)
+        elif before:
+            sql, args = SQL_MESSAGES_BEFORE, (chat_id, _timestamp(before[0]), before[1], limit)
+        else:
+            sql, args = SQL_MESSAGES_NEWEST, (chat_id, limit)
+        with self.lock:
+            rows = self._db().execute(sql, args).fetchall()
+        return [{
+            '_id': message_id,
+            'chat_id': chat_id,
+            'username': username,
+            'content': content,
+            'timestamp': datetime.fromisoformat(timestamp),
+            'seq': seq
+        } for message_id, chat_id, username, content, timestamp, seq in rows]
+
+    def last_sequence(self, chat_id):
+        with self.lock:
+            return self._db().execute(SQL_LAST_SEQUENCE, (chat_id,)).fetchone()[0]
+
+    def next_sequence(self, chat_id, start):
+        with self.lock:
+            db = self._db()
+            # IMMEDIATE takes the write lock up front, other processes wait
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = db.execute(SQL_NEXT_SEQUENCE, (chat_id,)).fetchall()
+                if rows:
+                    seq = rows[0][0]
+                else:
+                    seq = start() + 1
+                    db.execute(SQL_START_SEQUENCE, (chat_id, seq))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            return seq
+
+    def delete_all(self):
+        with self.lock:
+            self._db().executescript("""
+                BEGIN;
+                DELETE FROM users;
+                DELETE FROM chat_participants;
+                DELETE FROM chats;
+                DELETE FROM messages;
+                DELETE FROM sequences;
+                COMMIT;
+            """)
+
+    def close(self):
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+    @staticmethod
+    def _user(row):
+        username, password, created_at = row
+        return {'username': username, 'password': password,
+                'created_at': datetime.fromisoformat(created_at)}
@@ -0,0 +1,63 @@
+from collections import defaultdict
+
+
+class ChatSubscriptions:
+    """Index of which connected sessions take part in which chat.
+
+    Lets a chat message go only to that chat's online participants instead of
+    every connected socket.
+    """
+    def __init__(self):
+        self.by_chat = defaultdict(set)     # {chat_id: {session}}
+        self.by_user = defaultdict(set)     # {username: {session}}
+        self.by_session = {}                # {session: (username, {chat_id})}
+
+    def __len__(self):
+        return len(self.by_session)
+
+    def __contains__(self, session):
+        return session in self.by_session
+
+    def add_session(self, session, username, chat_ids):
+        """Register a logged in session and subscribe it to its chats"""
+        self.by_user[username].add(session)
+        chats = set(chat_ids)
+        self.by_session[session] = (username, chats)
+        for chat_id in chats:
+            self.by_chat[chat_id].add(session)
+
+    def remove_session(self, session):
+        entry = self.by_session.pop(session, None)
+        if entry is None:
+            return
+        username, chats = entry
+        for chat_id in chats:
+            members = self.by_chat.get(chat_id)
+            if members is not None:
+                members.discard(session)
+                if not members:
+                    del self.by_chat[chat_id]
+        sessions = self.by_user.get(username)
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del self.by_user[username]
+
+    def add_chat(self, chat_id, usernames):
+        """Subscribe the online sessions of every participant to a new chat"""
+        for username in usernames:
+            for session in self.by_user.get(username, ()):
+                self.by_session[session][1].add(chat_id)
+                self.by_chat[chat_id].add(session)
+
+    def chats(self, session):
+        """Copy of the chat ids session is subscribed to"""
+        entry = self.by_session.get(session)
+        return set(entry[1]) if entry else set()
+
+    def sessions(self, chat_id):
+        """Sessions currently subscribed to chat_id"""
+        return self.by_chat.get(chat_id, ())
+
+    def sessions_for_user(self, username):
+        return self.by_user.get(username, ())
@@ -0,0 +1,140 @@
+"""Run the chat server as several worker processes sharing one port.
+
+Each worker is a full ChatServer with its own event loop and database
+connection, the kernel spreads incoming connections across them through
+SO_REUSEPORT. Chat messages, server notices and new chats are relayed between
+workers by a BusBroker on a Unix domain socket run by this process, so the
+members of a chat can be connected to different workers. Workers that die are
+restarted.
+
+    python supervisor.py --workers 4 --port 55555
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import tempfile
+from bus import BusBroker
+from chatserver import ChatServer
+from msglog import MESSAGE_STORE_ENV
+from storage import STORAGE_ENV, SQLITE_PATH_ENV
+
+RESTART_DELAY = 1.0  # seconds before a crashed worker is replaced
+
+
+def run_worker(host, port, bus_path, token_secret, metrics_port):
+    # A restarted worker is forked from the running supervisor loop, don't
+    # let its signals wake that loop up
+    signal.set_wakeup_fd(-1)
+    server = ChatServer(host=host, port=port, gui_callback=print, reuse_port=True,
+                        bus_path=bus_path, token_secret=token_secret, metrics_port=metrics_port)
+    # Let the worker flush its queued writes when the supervisor stops it
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop(wait=False))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server.start()
+
+
+class Supervisor:
+    def __init__(self, workers=None, host='127.0.0.1', port=55555, bus_path=None, metrics_port=None):
+        self.workers = workers or os.cpu_count() or 1
+        # A MessageLog directory is locked by the one process using it
+        if self.workers > 1 and os.environ.get(MESSAGE_STORE_ENV) == 'log':
+            raise ValueError(f"The 'log' message store can't be shared by {self.workers} workers, "
+                             "run with --workers 1 or keep messages in the storage engine")
+        self.host = host
+        self.port = port
+        self.bus_path = bus_path or os.path.join(tempfile.gettempdir(), f'chat-bus-{port}.sock')
+        # Worker n serves its metrics on metrics_port + n
+        self.metrics_port = metrics_port
+        # Every worker must accept every other worker's session tokens
+        self.token_secret = os.urandom(32)
+        # Workers are forked before this process starts any threads
+        self.context = multiprocessing.get_context('fork')
+        self.processes = []
+        self.running = False
+
+    def spawn(self, slot):
+        metrics_port = self.metrics_port + slot if self.metrics_port else None
+        process = self.context.Process(target=run_worker, name='chat-worker', daemon=False,
+                                       args=(self.host, self.port, self.bus_path, self.token_secret,
+                                             metrics_port))
+        process.start()
+        return process
+
+    def start(self):
+        """Fork the workers and run the message bus, blocks until SIGINT / SIGTERM"""
+        self.running = True
+        self.processes = [self.spawn(slot) for slot in range(self.workers)]
+        print(f"Started {self.workers} workers on {self.host}:{self.port}, bus at {self.bus_path}")
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.stop_workers()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+
+        broker = BusBroker(self.bus_path)
+        tasks = [loop.create_task(broker.serve()), loop.create_task(self.watch_workers())]
+        try:
+            await stopped.wait()
+        finally:
+            self.running = False
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def watch_workers(self):
+        while self.running:
+            await asyncio.sleep(RESTART_DELAY)
+            for i, process in enumerate(self.processes):
+                if not process.is_alive() and self.running:
+                    print(f"Worker {process.pid} exited with {process.exitcode}, restarting")
+                    self.processes[i] = self.spawn(i)
+
+    def stop_workers(self, timeout=10.0):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+        print("Supervisor stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process chat server")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=55555)
+    parser.add_argument('--bus', default=None, help="Unix socket path for the message bus")
+    parser.add_argument('--storage', choices=('mongodb', 'sqlite'), default=None,
+                        help="storage engine (default: $CHAT_STORAGE or mongodb)")
+    parser.add_argument('--sqlite-path', default=None, help="database file for --storage sqlite")
+    parser.add_argument('--message-store', choices=('storage', 'log'), default=None,
+                        help="where messages are kept (default: $CHAT_MESSAGE_STORE or storage), "
+                             "'log' needs --workers 1")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve Prometheus metrics, worker n on this port + n")
+    args = parser.parse_args()
+    # The workers open their storage from the environment, see storage.py
+    if args.storage:
+        os.environ[STORAGE_ENV] = args.storage
+    if args.sqlite_path:
+        os.environ[SQLITE_PATH_ENV] = args.sqlite_path
+    if args.message_store:
+        os.environ[MESSAGE_STORE_ENV] = args.message_store
+    try:
+        supervisor = Supervisor(args.workers, args.host, args.port, args.bus, args.metrics_port)
+    except ValueError as e:
+        parser.error(str(e))
+    supervisor.start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+TOKEN_TTL = 24 * 3600  # seconds a session token stays valid
+
+
+class TokenError(Exception):
+    """Raised for a session token that is malformed, forged, expired or revoked"""
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class SessionTokens:
+    """Issues and checks signed, expiring session tokens.
+
+    A token is base64(json [username, session id, expiry]) and an HMAC-SHA256
+    of it, so checking one needs no database lookup. Without a secret a random
+    one is made, tokens then only work against this server process. Set
+    CHAT_TOKEN_SECRET to share them across restarts and workers.
+
+    A session id is revoked once its token has been used to RESUME or the
+    user logged out, so each token works once. Revoked ids are remembered
+    until their tokens would have expired anyway.
+    """
+    def __init__(self, secret=None, ttl=TOKEN_TTL):
+        secret = secret or os.environ.get('CHAT_TOKEN_SECRET') or os.urandom(32)
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.ttl = ttl
+        self.revoked = {}  # {session id: time its tokens expire by}, oldest first
+
+    def issue(self, username, session_id):
+        body = _b64encode(json.dumps([username, session_id, int(time.time() + self.ttl)]).encode('utf-8'))
+        return f"{body}.{self._sign(body)}"
+
+    def verify(self, token):
+        """Return (username, session id) for a valid token, raises TokenError otherwise"""
+        try:
+            body, signature = token.split('.', 1)
+        except (AttributeError, ValueError):
+            raise TokenError("Malformed token")
+        if not hmac.compare_digest(signature, self._sign(body)):
+            raise TokenError("Bad token signature")
+        try:
+            username, session_id, expires = json.loads(_b64decode(body))
+        except ValueError:
+            raise TokenError("Malformed token")
+        if expires < time.time():
+            raise TokenError("Token expired")
+        if session_id in self.revoked:
+            raise TokenError("Token revoked")
+        return username, session_id
+
+    def revoke(self, session_id):
+        """Stop accepting tokens issued for session_id"""
+        now = time.time()
+        while self.revoked:
+            oldest = next(iter(self.revoked))
+            if self.revoked[oldest] >= now:
+                break
+            del self.revoked[oldest]
+        self.revoked[session_id] = now + self.ttl
+
+    def _sign(self, body):
+        return _b64encode(hmac.new(self.secret, body.encode('ascii'), hashlib.sha256).digest())
@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+
+# What put() does when the queue is full
+OVERFLOW_BLOCK = 'block'  # wait for the writer to make room
+OVERFLOW_SYNC = 'sync'    # write the document inline on the caller's thread
+OVERFLOW_DROP = 'drop'    # discard the document and count it in dropped
+
+# A failed batch is retried until it is written, backing off up to this long
+RETRY_DELAY = 0.1
+RETRY_MAX_DELAY = 5.0
+
+_STOP = object()
+
+
+class _Flush:
+    """Queued by flush(), set once everything queued before it is written"""
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class WriteBehindQueue:
+    """Buffers documents and writes them in batches on a background thread.
+
+    A batch is written once it holds batch_size documents or flush_interval
+    seconds after its first document arrived, whichever comes first. A batch
+    that fails is retried until it is written or close() is called; meanwhile
+    the queue fills up and the overflow policy pushes back on put().
+    """
+    def __init__(self, write_batch, batch_size=100, flush_interval=0.05,
+                 max_pending=10000, overflow=OVERFLOW_BLOCK, name='write-behind', log=print):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_SYNC, OVERFLOW_DROP):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.queue = queue.Queue(max_pending)
+        self.dropped = 0
+        self.closed = False
+        self.log = log
+        self.stopping = threading.Event()  # set by close(), ends the retries
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, document):
+        if self.closed:
+            raise RuntimeError("Write-behind queue is closed")
+        if self.overflow == OVERFLOW_BLOCK:
+            self.queue.put(document)
+            return
+        try:
+            self.queue.put_nowait(document)
+        except queue.Full:
+            if self.overflow == OVERFLOW_SYNC:
+                self.write([document])
+            else:
+                self.dropped += 1
+
+    def flush(self):
+        """Block until every document queued so far has been written.
+
+        Documents queued after the call aren't waited for, so a flush returns
+        even while writers keep the queue busy.
+        """
+        if self.closed:
+            return
+        marker = _Flush()
+        self.queue.put(marker)
+        while not marker.done.wait(0.5):
+            if not self.thread.is_alive():
+                return  # raced close(), which wrote everything
+
+    def close(self):
+        """Write everything still queued and stop the writer thread"""
+        if self.closed:
+            return
+        self.closed = True
+        self.stopping.set()
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def write(self, batch):
+        delay = RETRY_DELAY
+        attempt = 1
+        while True:
+            try:
+                self.write_batch(batch)
+                return
+            except Exception as e:
+                self.log(f"Write-behind error (attempt {attempt}): {e}")
+            if self.stopping.is_set():
+                # Closing, one last try was made after the final wait
+                self.log(f"Write-behind gave up on {len(batch)} documents")
+                return
+            self.stopping.wait(delay)
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+            attempt += 1
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            batch = []
+            flushes = []
+            if item is _STOP:
+                stopping = True
+            elif isinstance(item, _Flush):
+                flushes.append(item)
+            else:
+                batch.append(item)
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if isinstance(item, _Flush):
+                        flushes.append(item)
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+            if batch:
+                self.write(batch)
+            for flush in flushes:
+                flush.done.set()